@@ -0,0 +1,102 @@
+"""
+Measure the import time of chatmanager and the overhead of a call with
+runtime type checking off and on, no network or key needed
+
+    python bench/bench_import.py
+    python bench/bench_import.py --runs 20 --calls 20000
+
+Each measurement runs in a fresh interpreter, as the import time and
+CHATMANAGER_TYPECHECK only count before chatmanager is imported.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY = ['openai', 'tiktoken', 'typeguard', 'aiohttp', 'requests']
+
+IMPORT = """
+import json, sys, time
+start = time.perf_counter()
+import chatmanager
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [_ for _ in HEAVY if _ in sys.modules]]))
+"""
+
+CALL = """
+import json, time
+import openai
+from chatmanager import ChatManager, ChatMessage
+
+response = {
+    'id': 'bench', 'created': 0, 'model': 'bench',
+    'choices': [{'index': 0, 'finish_reason': 'stop',
+                 'message': {'role': 'assistant', 'content': 'ok'}}],
+    'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+}
+openai.ChatCompletion.create = lambda **kwargs: response
+
+cm = ChatManager()
+cm.coalesce = False
+cm.add_key('key', 'sk-bench')
+cm.set_session('bench', window=0)
+
+msg = ChatMessage()
+start = time.perf_counter()
+for i in range(CALLS):
+    msg.push_user(str(i))
+push = (time.perf_counter() - start) / CALLS
+
+msg = ChatMessage()
+msg.push_user('bench')
+cm.send(msg)
+start = time.perf_counter()
+for i in range(CALLS // 10):
+    cm.send(msg)
+send = (time.perf_counter() - start) / (CALLS // 10)
+print(json.dumps([push, send]))
+"""
+
+
+def run(code: str, typecheck: bool) -> list:
+    env = dict(os.environ, CHATMANAGER_TYPECHECK='1' if typecheck else '0')
+    out = subprocess.run([sys.executable, '-c', code],
+                         env=env,
+                         check=True,
+                         capture_output=True,
+                         text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--calls', type=int, default=10000)
+    args = parser.parse_args()
+
+    code = f'HEAVY = {HEAVY!r}\n' + IMPORT
+    results = [run(code, False) for _ in range(args.runs)]
+    elapsed = statistics.median(_[0] for _ in results)
+    print(f"import chatmanager: {elapsed * 1000:.1f} ms (median of "
+          f"{args.runs}), loaded: {', '.join(results[0][1]) or 'none'}")
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import openai'], check=True)
+    print(f"import openai alone: "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms (interpreter "
+          f"start included)")
+
+    print(f"{'typecheck':>10}{'push_msg us':>14}{'send us':>10}")
+    code = f'CALLS = {args.calls}\n' + CALL
+    for typecheck in (False, True):
+        push, send = run(code, typecheck)
+        print(f"{'on' if typecheck else 'off':>10}{push * 1e6:>14.2f}"
+              f"{send * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
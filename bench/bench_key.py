@@ -0,0 +1,38 @@
+"""
+Measure the cost of KeyGroup.get_key as the number of keys grows
+
+    python bench/bench_key.py
+"""
+
+import time
+
+from chatmanager.core.key import KeyGroup
+
+STRATEGIES = ['roll-polling', 'random', 'least-used', 'rest-time']
+KEY_NUMS = [10, 100, 1000, 10000]
+CALLS = 20000
+
+
+def bench(strategy: str, key_num: int) -> float:
+    """ Return the average cost of get_key in microseconds """
+
+    group = KeyGroup()
+    for i in range(key_num):
+        group.add_key(f'key{i}', f'sk-{i}')
+    group.set_strategy(strategy)
+
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        group.get_key()
+    return (time.perf_counter() - start) / CALLS * 1e6
+
+
+def main() -> None:
+    print(f"{'strategy':<14}" + ''.join(f'{n:>10}' for n in KEY_NUMS))
+    for strategy in STRATEGIES:
+        costs = [bench(strategy, n) for n in KEY_NUMS]
+        print(f'{strategy:<14}' + ''.join(f'{c:>8.2f}us' for c in costs))
+
+
+if __name__ == '__main__':
+    main()
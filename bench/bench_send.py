@@ -0,0 +1,113 @@
+"""
+Measure the throughput and latency of ChatManager.send(msgs, thread_num=...)
+against the local mock server, no network or key needed
+
+    python bench/bench_send.py
+    python bench/bench_send.py --latency 0.2 --requests 2000 --memory
+
+Pass --api-base to drive a mock server started in another process
+(python -m chatmanager.util.mock_server), so it does not share the GIL
+with the client.
+"""
+
+import argparse
+import time
+import tracemalloc
+from typing import List, Dict, Any
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.util.mock_server import MockServer, lognormal, constant
+
+THREAD_NUMS = [1, 8, 32]
+KEY_NUMS = [1, 10]
+# words per message
+MESSAGE_SIZES = [10, 1000]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def bench(thread_num: int, key_num: int, size: int, requests: int,
+          memory: bool) -> Dict[str, Any]:
+    cm = ChatManager()
+    cm.coalesce = False
+    for i in range(key_num):
+        cm.add_key(f'key{i}', f'sk-{i}')
+    cm.set_session('bench')
+
+    msgs = []
+    for i in range(requests):
+        msg = ChatMessage()
+        msg.push_user(f'{i} ' + 'word ' * size)
+        msgs.append(msg)
+
+    # per-request latency from the traces, queueing in the fan-out excluded
+    latencies: List[float] = []
+    assert cm.telemetry is not None
+    cm.telemetry.add_hook(lambda trace: latencies.append(trace.total or 0.0))
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    responses = cm.send(msgs, thread_num=thread_num)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    cm.clients.close()
+    assert isinstance(responses, list) and all(responses)
+
+    return {
+        'rps': requests / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'peak': peak / (1 << 20),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--api-base', default=None)
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.05,
+                        help='median seconds of the mock server')
+    parser.add_argument('--sigma', type=float, default=0.0)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--memory',
+                        action='store_true',
+                        help='trace the peak memory, slows the client down')
+    args = parser.parse_args()
+
+    mock = None
+    if args.api_base is None:
+        latency = lognormal(
+            args.latency, args.sigma) if args.sigma else constant(args.latency)
+        mock = MockServer(latency=latency).start()
+        ChatSetup.api_base = mock.api_base
+    else:
+        ChatSetup.api_base = args.api_base
+
+    print(f"{'threads':>8}{'keys':>6}{'words':>7}{'req/s':>10}"
+          f"{'p50':>10}{'p99':>10}{'peak':>10}")
+    try:
+        for thread_num in THREAD_NUMS:
+            for key_num in KEY_NUMS:
+                for size in MESSAGE_SIZES:
+                    r = bench(thread_num, key_num, size, args.requests,
+                              args.memory)
+                    print(f"{thread_num:>8}{key_num:>6}{size:>7}"
+                          f"{r['rps']:>10.1f}{r['p50']:>8.1f}ms"
+                          f"{r['p99']:>8.1f}ms" +
+                          (f"{r['peak']:>8.1f}MB" if args.
+                           memory else f"{'-':>10}"))
+    finally:
+        if mock is not None:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Measure the throughput of ShardedRunner at varying numbers of processes
+against the local mock server, no network or key needed
+
+    python bench/bench_shard.py --requests 20000
+
+Pass --api-base to drive a mock server started in another process
+(python -m chatmanager.util.mock_server), so it does not share the GIL
+with the parent.
+"""
+
+import argparse
+import asyncio
+import time
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.shard import ShardedRunner
+from chatmanager.util.mock_server import MockServer, constant
+
+PROCESS_NUMS = [1, 2, 4, 8]
+
+
+def messages(requests: int, size: int):
+    for i in range(requests):
+        msg = ChatMessage()
+        msg.push_user(f'{i} ' + 'word ' * size)
+        yield msg
+
+
+def manager(key_num: int) -> ChatManager:
+    cm = ChatManager()
+    cm.coalesce = False
+    for i in range(key_num):
+        cm.add_key(f'key{i}', f'sk-{i}', rpm=10**7)
+    cm.set_key_strategy('rate-limit')
+    cm.set_session('bench', window=0)
+    return cm
+
+
+async def asend(cm: ChatManager, args: argparse.Namespace) -> None:
+    """ The baseline, every message sent from this process """
+
+    try:
+        await cm.asend(list(messages(args.requests, args.words)),
+                       args.concurrency)
+    finally:
+        await cm.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--api-base', default=None)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--words', type=int, default=200)
+    parser.add_argument('--keys', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    mock = None
+    if args.api_base is None:
+        mock = MockServer(latency=constant(args.latency)).start()
+        ChatSetup.api_base = mock.api_base
+    else:
+        ChatSetup.api_base = args.api_base
+
+    print(f"{'processes':>10}{'req/s':>10}")
+    try:
+        start = time.perf_counter()
+        asyncio.run(asend(manager(args.keys), args))
+        elapsed = time.perf_counter() - start
+        print(f"{'asend':>10}{args.requests / elapsed:>10.1f}")
+
+        for processes in PROCESS_NUMS:
+            runner = ShardedRunner(manager(args.keys), processes,
+                                   args.concurrency)
+            start = time.perf_counter()
+            for _ in runner.imap(messages(args.requests, args.words)):
+                pass
+            elapsed = time.perf_counter() - start
+            print(f"{processes:>10}{args.requests / elapsed:>10.1f}")
+    finally:
+        if mock is not None:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    main()
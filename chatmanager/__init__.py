@@ -1,3 +1,3 @@
 from .core import ChatManager
 from .core import ChatResponse, ChatMessage, Session
-from .config import ChatSetup
+from .config import ChatSetup, ChatConfig
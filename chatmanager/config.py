@@ -1,12 +1,97 @@
-from typing import Optional
+import dataclasses
+from typing import Optional, Dict, Any, List, Union
 
 
 class ChatSetup:
     """ Setup openai interface
 
+    The process-wide defaults. A ChatConfig given to a ChatManager or to a
+    single request takes precedence over them.
     """
 
     model: str = "gpt-3.5-turbo"
     api_base: str = "https://api.openai.com/v1"
     temperature: Optional[float] = None
     top_p: Optional[float] = None
+    # ask streamed responses to report usage, turn off for servers that
+    # reject stream_options (usage is then counted locally)
+    stream_usage: bool = True
+
+
+@dataclasses.dataclass(frozen=True)
+class ChatConfig:
+    """ Immutable parameters of chat completion requests
+
+    A field left None falls back to the layer below: the request config
+    over the manager config over ChatSetup. Configs are never modified, use
+    replace to derive a new one.
+
+    https://platform.openai.com/docs/api-reference/chat/create
+
+    Attributes:
+        model: The model to use
+        api_base: The api base url, not sent in the body
+        stream_usage: Whether a streamed request sends stream_options to
+            get the usage reported, not sent in the body
+        extra: Other fields sent in the body as they are
+    """
+
+    model: Optional[str] = None
+    api_base: Optional[str] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    n: Optional[int] = None
+    max_tokens: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
+    response_format: Optional[Dict[str, Any]] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    logit_bias: Optional[Dict[str, float]] = None
+    logprobs: Optional[bool] = None
+    top_logprobs: Optional[int] = None
+    tools: Optional[List[Dict[str, Any]]] = None
+    tool_choice: Optional[Union[str, Dict[str, Any]]] = None
+    user: Optional[str] = None
+    stream_usage: Optional[bool] = None
+    extra: Optional[Dict[str, Any]] = None
+
+    def replace(self, **changes: Any) -> 'ChatConfig':
+        return dataclasses.replace(self, **changes)
+
+    def merge(self, over: Optional['ChatConfig']) -> 'ChatConfig':
+        """ A config with the fields set in over taking precedence """
+
+        if over is None:
+            return self
+        changes = {
+            _.name: getattr(over, _.name)
+            for _ in dataclasses.fields(over)
+            if getattr(over, _.name) is not None
+        }
+        if self.extra is not None and over.extra is not None:
+            changes['extra'] = {**self.extra, **over.extra}
+        return dataclasses.replace(self, **changes) if changes else self
+
+    def resolve(self) -> 'ChatConfig':
+        """ Fill the fields left None from ChatSetup """
+
+        defaults = ChatConfig(model=ChatSetup.model,
+                              api_base=ChatSetup.api_base,
+                              temperature=ChatSetup.temperature,
+                              top_p=ChatSetup.top_p,
+                              stream_usage=ChatSetup.stream_usage)
+        return defaults.merge(self)
+
+    def body(self) -> Dict[str, Any]:
+        """ The fields sent in the request body """
+
+        body = {
+            _.name: getattr(self, _.name)
+            for _ in dataclasses.fields(self)
+            if _.name not in ('api_base', 'stream_usage',
+                              'extra') and getattr(self, _.name) is not None
+        }
+        if self.extra is not None:
+            body.update(self.extra)
+        return body
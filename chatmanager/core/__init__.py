@@ -1,2 +1,12 @@
-from .chat import ChatManager, ChatSetup
-from .session import ChatMessage, ChatResponse, Session
+from .chat import ChatManager, ChatSetup, ChatConfig
+from .session import ChatMessage, ChatResponse, Session, SessionStore
+from .stream import ChatStream, AsyncChatStream, ChatStreamGroup
+from .cache import ResponseCache, MemoryCache, DiskCache
+from .semantic import SemanticCache, HashingEmbedder
+from .telemetry import Telemetry, RequestTrace
+from .scheduler import Scheduler
+from .router import Router, Endpoint
+from .context import ContextTrimmer
+from .packing import PromptPacker
+from .ledger import Ledger
+from .shard import ShardedRunner
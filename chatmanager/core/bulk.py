@@ -0,0 +1,308 @@
+"""
+Run a JSON lines file of prompts through a ChatManager, resumable
+
+Each input line is a request:
+
+    {"id": "q1", "messages": [{"role": "user", "content": "hi"}]}
+    {"id": "q2", "prompt": "hi"}
+
+Each output line is written as soon as its request finishes, in completion
+order, tagged with the id (the line number if the input has none):
+
+    {"id": "q1", "response": {...}}
+    {"id": "q2", "error": {"kind": "rate_limit", "message": "..."}}
+
+    python -m chatmanager.core.bulk in.jsonl out.jsonl --key k1=sk-... \\
+        --concurrency 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, Optional, Any, Iterator, Tuple, Set, IO, List
+
+from chatmanager.config import ChatConfig
+from chatmanager.util import logger
+from .chat import ChatManager
+from .session import Session, ChatMessage, ChatResponse
+from .retry import ChatError
+
+
+class Checkpoint:
+    """ How far a job got, saved next to the output
+
+    Every input line before line is finished, as are the lines in done.
+    The output is valid up to offset bytes; anything after was written
+    after the checkpoint and is truncated on resume.
+
+    Attributes:
+        path: The path of the checkpoint file
+        line: The number of leading input lines finished
+        done: The finished input lines after line
+        offset: The size of the output when the checkpoint was saved
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.line: int = 0
+        self.done: Set[int] = set()
+        self.offset: int = 0
+
+    def load(self) -> bool:
+        """ Read the checkpoint, False if there is none """
+
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            state = json.load(f)
+        self.line = state['line']
+        self.done = set(state['done'])
+        self.offset = state['offset']
+        return True
+
+    def save(self) -> None:
+        """ Replace the checkpoint atomically """
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    'line': self.line,
+                    'done': sorted(self.done),
+                    'offset': self.offset
+                }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def finished(self, line: int) -> bool:
+        return line < self.line or line in self.done
+
+
+def parse(line: str, lineno: int) -> Tuple[Any, ChatMessage]:
+    """ The id and message of an input line """
+
+    record = json.loads(line)
+    msg = ChatMessage()
+    if 'messages' in record:
+        msg.push_msg(record['messages'])
+    elif 'prompt' in record:
+        msg.push_user(record['prompt'])
+    else:
+        raise ValueError("expect messages or prompt")
+    return record.get('id', lineno), msg
+
+
+def result(request_id: Any,
+           response: Optional[ChatResponse] = None,
+           error: Optional[ChatError] = None) -> Dict[str, Any]:
+    if response is not None:
+        return {'id': request_id, 'response': response.response}
+    if error is None:
+        error = ChatError('unknown', 'ChatManager is not ready')
+    return {
+        'id': request_id,
+        'error': {
+            'kind': error.kind,
+            'message': error.message,
+            'http_status': error.http_status,
+            'attempts': error.attempts,
+        }
+    }
+
+
+class BulkJob:
+    """ Send every line of an input file, write each result as it finishes
+
+    At most concurrency requests are in flight and only those are held in
+    memory, so the input can have millions of lines. The responses are not
+    saved to any session of the manager.
+
+    Attributes:
+        cm: The ChatManager sending the requests
+        input_path: The JSON lines file of requests
+        output_path: The JSON lines file of results, overwritten unless the
+            job resumes from a checkpoint
+        checkpoint: The progress of the job, saved to checkpoint_path
+        concurrency: The maximum number of in-flight requests
+        checkpoint_interval: Save the checkpoint every so many results
+        sent: The number of requests finished in this run
+        failed: The number of them that failed
+        skipped: The number of input lines finished by an earlier run
+    """
+
+    def __init__(self,
+                 cm: ChatManager,
+                 input_path: str,
+                 output_path: str,
+                 checkpoint_path: Optional[str] = None,
+                 concurrency: int = 64,
+                 checkpoint_interval: int = 100) -> None:
+        assert (concurrency > 0), "concurrency must be positive"
+        self.cm: ChatManager = cm
+        self.input_path: str = input_path
+        self.output_path: str = output_path
+        self.checkpoint: Checkpoint = Checkpoint(checkpoint_path or
+                                                 output_path + '.ckpt')
+        self.concurrency: int = concurrency
+        self.checkpoint_interval: int = checkpoint_interval
+        self.sent: int = 0
+        self.failed: int = 0
+        self.skipped: int = 0
+
+        # a session that keeps nothing in memory
+        self.session: Session = Session('bulk', window=0)
+        self.inflight: Set[int] = set()
+        self.next_line: int = 0
+        self.output: Optional[IO[str]] = None
+
+    async def arun(self) -> Dict[str, int]:
+        """Run the job on the running event loop
+
+        The manager is left open, it belongs to the caller.
+
+        Returns:
+            The numbers of sent, failed and skipped lines
+        """
+
+        self.resume()
+        self.output = open(self.output_path, 'a', encoding='utf-8')
+        try:
+            with open(self.input_path, encoding='utf-8') as f:
+                lines = self.pending(f)
+                await asyncio.gather(
+                    *(self.worker(lines) for _ in range(self.concurrency)))
+            self.save()
+        finally:
+            self.output.close()
+            self.output = None
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped
+        }
+
+    def run(self) -> Dict[str, int]:
+        """Run the job on a new event loop
+
+        The aiohttp sessions the manager opened on that loop are closed
+        with it, the manager stays usable.
+        """
+
+        async def run() -> Dict[str, int]:
+            try:
+                return await self.arun()
+            finally:
+                await self.cm.clients.aclose()
+
+        return asyncio.run(run())
+
+    def resume(self) -> None:
+        """ Load the checkpoint and drop the output written after it """
+
+        if not self.checkpoint.load():
+            # a fresh job starts with a fresh output
+            open(self.output_path, 'w').close()
+            return
+        with open(self.output_path, 'a', encoding='utf-8') as f:
+            f.truncate(self.checkpoint.offset)
+        logger.info("resume %s from line %d", self.input_path,
+                    self.checkpoint.line)
+
+    def pending(self, f: IO[str]) -> Iterator[Tuple[int, str]]:
+        """ The lines not finished yet, with their line numbers """
+
+        for lineno, line in enumerate(f):
+            self.next_line = lineno + 1
+            if self.checkpoint.finished(lineno):
+                self.skipped += 1
+                continue
+            if not line.strip():
+                continue
+            self.inflight.add(lineno)
+            yield lineno, line
+
+    async def worker(self, lines: Iterator[Tuple[int, str]]) -> None:
+        for lineno, line in lines:
+            try:
+                request_id, msg = parse(line, lineno)
+            except Exception as e:
+                self.write(
+                    lineno,
+                    result(lineno, error=ChatError('invalid_request', str(e))))
+                continue
+
+            response = await self.cm.asend(msg, session=self.session)
+            if isinstance(response, ChatResponse):
+                self.write(lineno, result(request_id, response))
+            else:
+                error = response if isinstance(response, ChatError) else None
+                self.write(lineno, result(request_id, error=error))
+
+    def write(self, lineno: int, record: Dict[str, Any]) -> None:
+        assert (self.output is not None)
+        self.output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.sent += 1
+        self.failed += 'error' in record
+        self.inflight.discard(lineno)
+        self.checkpoint.done.add(lineno)
+        if self.sent % self.checkpoint_interval == 0:
+            self.save()
+
+    def save(self) -> None:
+        """ Flush the output and save the checkpoint """
+
+        assert (self.output is not None)
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+        # every line before the earliest in flight is finished
+        line = min(self.inflight) if self.inflight else self.next_line
+        checkpoint = self.checkpoint
+        checkpoint.line = max(checkpoint.line, line)
+        checkpoint.done = {_ for _ in checkpoint.done if _ >= checkpoint.line}
+        checkpoint.offset = self.output.tell()
+        checkpoint.save()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input', help='the JSON lines file of requests')
+    parser.add_argument('output', help='the JSON lines file of results')
+    parser.add_argument('--key',
+                        action='append',
+                        default=[],
+                        help='name=key, repeat for more keys. '
+                        'Defaults to $OPENAI_API_KEY')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--checkpoint',
+                        default=None,
+                        help='defaults to the output path + .ckpt')
+    parser.add_argument('--checkpoint-interval', type=int, default=100)
+    parser.add_argument('--strategy', default='default')
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--api-base', default=None)
+    args = parser.parse_args(argv)
+
+    cm = ChatManager(ChatConfig(model=args.model, api_base=args.api_base))
+    keys = args.key
+    if not keys and os.environ.get('OPENAI_API_KEY'):
+        keys = ['default=' + os.environ['OPENAI_API_KEY']]
+    assert (keys), "no key given"
+    for item in keys:
+        name, _, key = item.partition('=')
+        cm.add_key(name, key or name)
+    cm.set_key_strategy(args.strategy)
+
+    job = BulkJob(cm, args.input, args.output, args.checkpoint,
+                  args.concurrency, args.checkpoint_interval)
+    try:
+        print(json.dumps(job.run()))
+    finally:
+        # the manager was created here
+        cm.clients.close()
+
+
+if __name__ == '__main__':
+    main()
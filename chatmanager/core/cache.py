@@ -0,0 +1,234 @@
+"""
+Cache the responses of identical requests
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Any, Tuple
+
+# fields of the request body that do not change the response
+TRANSPORT_FIELDS = {'request_timeout', 'stream', 'stream_options'}
+
+
+def request_key(request_body: Dict[str, Any]) -> str:
+    """ Canonical hash of a request body """
+
+    body = {k: v for k, v in request_body.items() if k not in TRANSPORT_FIELDS}
+    dumped = json.dumps(body,
+                        sort_keys=True,
+                        separators=(',', ':'),
+                        ensure_ascii=False)
+    return hashlib.sha256(dumped.encode('utf-8')).hexdigest()
+
+
+class MemoryCache:
+    """ Bounded in-memory LRU of response payloads
+
+    Attributes:
+        max_entries: The maximum number of cached responses
+        ttl: Seconds a response stays valid, None if forever
+        entries: key -> (expire time, payload), least recently used first
+    """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 ttl: Optional[float] = None) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: Optional[float] = ttl
+        self.entries: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]'
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            if (entry := self.entries.get(key)) is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, payload: Dict[str, Any]) -> None:
+        expire = float('inf')
+        if self.ttl is not None:
+            expire = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = (expire, payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class DiskCache:
+    """ Persistent cache of response payloads in a SQLite file
+
+    Attributes:
+        path: The path of the database
+        max_entries: The maximum number of cached responses, None if
+            unbounded. The least recently used are evicted.
+        ttl: Seconds a response stays valid, None if forever
+    """
+
+    # evict every so many inserts instead of on each one
+    EVICT_INTERVAL = 64
+
+    def __init__(self,
+                 path: str,
+                 max_entries: Optional[int] = None,
+                 ttl: Optional[float] = None) -> None:
+        self.path: str = path
+        self.max_entries: Optional[int] = max_entries
+        self.ttl: Optional[float] = ttl
+        self.lock = threading.Lock()
+        self.inserts: int = 0
+
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                              'key TEXT PRIMARY KEY, payload TEXT NOT NULL, '
+                              'created REAL NOT NULL, accessed REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                              'ON responses (accessed)')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT payload, created FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                if self.ttl is not None and row[1] + self.ttl < now:
+                    self.conn.execute('DELETE FROM responses WHERE key = ?',
+                                      (key,))
+                    return None
+                self.conn.execute(
+                    'UPDATE responses SET accessed = ? WHERE key = ?',
+                    (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, payload: Dict[str, Any]) -> None:
+        now = time.time()
+        dumped = json.dumps(payload, ensure_ascii=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, dumped, now, now))
+            self.inserts += 1
+            if self.inserts % self.EVICT_INTERVAL == 0:
+                self.evict(now)
+
+    def evict(self, now: float) -> None:
+        """ Drop the expired and excess entries, the caller holds the lock """
+
+        if self.ttl is not None:
+            self.conn.execute('DELETE FROM responses WHERE created < ?',
+                              (now - self.ttl,))
+        if self.max_entries is not None:
+            self.conn.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM '
+                'responses ORDER BY accessed DESC, rowid DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def clear(self) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        with self.lock:
+            self.evict(time.time())
+            self.conn.commit()
+            self.conn.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+class ResponseCache:
+    """ Two-tier response cache: memory first, then disk
+
+    A disk hit is promoted to the memory tier.
+
+    Attributes:
+        memory: The in-memory tier, None to disable
+        disk: The on-disk tier, None to disable
+        hits: The number of lookups answered by the cache
+        misses: The number of lookups not answered by the cache
+        memory_hits: The hits answered by the memory tier
+        disk_hits: The hits answered by the disk tier
+    """
+
+    def __init__(self,
+                 memory: Optional[MemoryCache] = None,
+                 disk: Optional[DiskCache] = None) -> None:
+        self.memory: Optional[MemoryCache] = memory
+        self.disk: Optional[DiskCache] = disk
+        self.hits: int = 0
+        self.misses: int = 0
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        payload = None
+        tier = None
+        if self.memory is not None:
+            payload = self.memory.get(key)
+            tier = 'memory'
+        if payload is None and self.disk is not None:
+            payload = self.disk.get(key)
+            tier = 'disk'
+            if payload is not None and self.memory is not None:
+                self.memory.set(key, payload)
+
+        with self.lock:
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if tier == 'memory':
+                    self.memory_hits += 1
+                else:
+                    self.disk_hits += 1
+        return payload
+
+    def set(self, key: str, payload: Dict[str, Any]) -> None:
+        if self.memory is not None:
+            self.memory.set(key, payload)
+        if self.disk is not None:
+            self.disk.set(key, payload)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+            }
+
+    def clear(self) -> None:
+        if self.memory is not None:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
@@ -1,12 +1,30 @@
-from typing import Optional, List, Dict, Callable, Any, Union
+from typing import (Optional, List, Dict, Callable, Any, Union, Sequence,
+                    AsyncIterator, Iterator, Tuple)
+from contextlib import contextmanager, asynccontextmanager
 from concurrent import futures
+import asyncio
+import functools
+import threading
+import time
 
-from typeguard import typechecked
-import openai
-
-from chatmanager.config import ChatSetup
-from .session import Session, ChatMessage, ChatResponse
+from chatmanager.config import ChatSetup, ChatConfig
+from chatmanager.util import logger, typechecked
+from .session import Session, SessionStore, ChatMessage, ChatResponse
 from .key import KeyGroup
+from .retry import (ChatError, RetryPolicy, CircuitBreaker, classify,
+                    retry_after, KEY_SPECIFIC, UNHEALTHY)
+from .client import ClientPool, client_pool
+from .cache import ResponseCache, request_key
+from .semantic import SemanticCache
+from .coalesce import SingleFlight
+from .context import ContextTrimmer
+from .telemetry import Telemetry, RequestTrace
+from .scheduler import Scheduler
+from .router import Router, Endpoint
+from .packing import PromptPacker
+from .ledger import Ledger, Reservation
+from .stream import (StreamCollector, ChatStream, AsyncChatStream,
+                     ChatStreamGroup, stream_many)
 """
 response = openai.ChatCompletion.create(
     model="gpt-3.5-turbo",
@@ -41,88 +59,307 @@ response = openai.ChatCompletion.create(
 """
 
 
-def send_msg(msg: List[Dict[str, str]], key: str) -> Optional[ChatResponse]:
+def build_request_body(msg: List[Dict[str, str]],
+                       config: Optional[ChatConfig] = None) -> Dict[str, Any]:
+    """Build the request body of chat completions
+
+    https://platform.openai.com/docs/api-reference/chat/create
+
+    Args:
+        msg: A list of messages
+        config: The parameters of the request, the fields it leaves None
+            are taken from ChatSetup
+
+    Returns:
+        The keyword arguments passed to ChatCompletion
+
+    """
+
+    body = (config or ChatConfig()).resolve().body()
+    request_body: Dict[str, Any] = {
+        'model': body.pop('model'),
+        'messages': msg,
+    }
+    request_body.update(body)
+
+    return request_body
+
+
+def send_msg(msg: List[Dict[str, str]],
+             key: str,
+             pool: Optional[ClientPool] = None,
+             on_error: Optional[Callable[[Exception], None]] = None,
+             request_timeout: Optional[float] = None,
+             config: Optional[ChatConfig] = None) -> Optional[ChatResponse]:
     """Send a message to openai
 
+    The credentials are passed with the request instead of being set on the
+    openai module, so concurrent threads never see each other's key.
+
     Args:
         msg: A list of messages
-        setup: The ChatSetup object
+        key: The api key
+        pool: The pool of HTTP clients, the module-level pool by default
+        on_error: Called with the exception if the request fails
+        request_timeout: The timeout of the request in seconds
+        config: The parameters of the request, ChatSetup by default
 
     Returns:
         The ChatCompletion object
 
     """
 
-    openai.api_base = ChatSetup.api_base
-    openai.api_key = key
+    config = (config or ChatConfig()).resolve()
+    client = (pool or client_pool).get(key, config.api_base or
+                                       ChatSetup.api_base)
+    request_body = build_request_body(msg, config)
+    if request_timeout is not None:
+        request_body['request_timeout'] = request_timeout
 
-    # construct the requrest body
-    # https://platform.openai.com/docs/api-reference/chat/create
-    request_body = {
-        'model': ChatSetup.model,
-        'messages': msg,
-    }
+    try:
+        response = client.create(**request_body)
+    except Exception as e:
+        logger.warning("request failed: %s", e)
+        if on_error is not None:
+            on_error(e)
+        return None
 
-    # optional args
-    setup_dict: Dict[str, Any] = {
-        'temperature': ChatSetup.temperature,
-        'top_p': ChatSetup.top_p,
-        # TODO: add more args
-    }
+    return ChatResponse(response)
+
+
+async def asend_msg(
+        msg: List[Dict[str, str]],
+        key: str,
+        pool: Optional[ClientPool] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        request_timeout: Optional[float] = None,
+        config: Optional[ChatConfig] = None) -> Optional[ChatResponse]:
+    """Send a message to openai without blocking the event loop
+
+    Args:
+        msg: A list of messages
+        key: The api key
+        pool: The pool of HTTP clients, the module-level pool by default
+        on_error: Called with the exception if the request fails
+        request_timeout: The timeout of the request in seconds
+        config: The parameters of the request, ChatSetup by default
+
+    Returns:
+        The ChatCompletion object
+
+    """
 
-    for k, v in setup_dict.items():
-        if v is not None:
-            request_body[k] = v
+    config = (config or ChatConfig()).resolve()
+    client = (pool or client_pool).get(key, config.api_base or
+                                       ChatSetup.api_base)
+    request_body = build_request_body(msg, config)
+    if request_timeout is not None:
+        request_body['request_timeout'] = request_timeout
 
-    #TODO error processing
-    #TODO different parameters
     try:
-        response = openai.ChatCompletion.create(**request_body)
+        response = await client.acreate(**request_body)
     except Exception as e:
-        print(e)  # TODO: refine output
+        logger.warning("request failed: %s", e)
+        if on_error is not None:
+            on_error(e)
         return None
 
     return ChatResponse(response)
 
 
+def send_msg_stream(
+        msg: List[Dict[str, str]],
+        key: str,
+        pool: Optional[ClientPool] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        request_timeout: Optional[float] = None,
+        config: Optional[ChatConfig] = None) -> Optional[ChatStream]:
+    """Send a message to openai and stream the response
+
+    Args:
+        msg: A list of messages
+        key: The api key
+        pool: The pool of HTTP clients, the module-level pool by default
+        on_error: Called with the exception if the request fails
+        request_timeout: The timeout of the request in seconds
+        config: The parameters of the request, ChatSetup by default
+
+    Returns:
+        The ChatStream yielding the content deltas
+
+    """
+
+    config = (config or ChatConfig()).resolve()
+    client = (pool or client_pool).get(key, config.api_base or
+                                       ChatSetup.api_base)
+    request_body = build_request_body(msg, config)
+    if request_timeout is not None:
+        request_body['request_timeout'] = request_timeout
+    request_body['stream'] = True
+    if config.stream_usage:
+        request_body['stream_options'] = {'include_usage': True}
+
+    try:
+        chunks = client.create(**request_body)
+    except Exception as e:
+        logger.warning("request failed: %s", e)
+        if on_error is not None:
+            on_error(e)
+        return None
+
+    return ChatStream(msg, chunks)
+
+
+async def asend_msg_stream(
+        msg: List[Dict[str, str]],
+        key: str,
+        pool: Optional[ClientPool] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        request_timeout: Optional[float] = None,
+        config: Optional[ChatConfig] = None) -> Optional[AsyncChatStream]:
+    """Send a message to openai and stream the response asynchronously
+
+    Args:
+        msg: A list of messages
+        key: The api key
+        pool: The pool of HTTP clients, the module-level pool by default
+        on_error: Called with the exception if the request fails
+        request_timeout: The timeout of the request in seconds
+        config: The parameters of the request, ChatSetup by default
+
+    Returns:
+        The AsyncChatStream yielding the content deltas
+
+    """
+
+    config = (config or ChatConfig()).resolve()
+    client = (pool or client_pool).get(key, config.api_base or
+                                       ChatSetup.api_base)
+    request_body = build_request_body(msg, config)
+    if request_timeout is not None:
+        request_body['request_timeout'] = request_timeout
+    request_body['stream'] = True
+    if config.stream_usage:
+        request_body['stream_options'] = {'include_usage': True}
+
+    try:
+        chunks = await client.acreate(**request_body)
+    except Exception as e:
+        logger.warning("request failed: %s", e)
+        if on_error is not None:
+            on_error(e)
+        return None
+
+    return AsyncChatStream(msg, chunks)
+
+
 class ChatManager:
     """High-level interface for interaction with ChatGPT
 
     Attributes:
         cur_session: The current session
-        sessions: A list of all sessions
+        sessions: All sessions, indexed by name
         keys: A KeyGroup object managing key-related stuff
+        clients: The pooled HTTP clients of the keys
+        retry: The RetryPolicy of failed requests
+        breaker: The CircuitBreaker of keys and api_base
+        cache: The ResponseCache of identical requests, None to disable
+        semantic_cache: The SemanticCache answering requests similar to
+            answered ones, tried after cache, None to disable
+        coalesce: Whether concurrent identical requests share one call. Turn
+            it off to get independent samples when temperature > 0.
+        flight: The in-flight calls shared by identical requests
+        trimmer: The ContextTrimmer fitting messages to the context window
+            before they are sent, None to send them as they are
+        telemetry: Collects the RequestTrace of every request, None to
+            disable
+        scheduler: Admits requests by priority class and fair share across
+            sessions, None to send them as they come
+        router: Spreads requests over several endpoints, each with its own
+            keys. None to send every request to the api_base of the config
+            with keys.
+        packer: Packs the messages of a list sent without streaming into
+            fewer requests, None to send each message by itself
+        ledger: Accounts the tokens and cost of the requests and enforces
+            its budgets before they are sent, None to disable
+        config: The ChatConfig of the requests of this manager. A config
+            passed to send/asend takes precedence, ChatSetup fills the
+            fields left None.
 
     Methods:
         set_session: Set the current session
 
     """
 
-    def __init__(self) -> None:
+    def __init__(self, config: Optional[ChatConfig] = None) -> None:
         self.cur_session: Optional[Session] = None
-        self.sessions: List[Session] = []
+        self.sessions: Dict[str, Session] = dict()
+        self.session_lock = threading.Lock()
         self.keys: KeyGroup = KeyGroup()
-        self.setup: ChatSetup = ChatSetup()
+        self.clients: ClientPool = ClientPool()
+        self.retry: RetryPolicy = RetryPolicy()
+        self.breaker: CircuitBreaker = CircuitBreaker()
+        self.cache: Optional[ResponseCache] = None
+        self.semantic_cache: Optional[SemanticCache] = None
+        self.coalesce: bool = True
+        self.flight: SingleFlight = SingleFlight()
+        self.trimmer: Optional[ContextTrimmer] = None
+        self.telemetry: Optional[Telemetry] = Telemetry()
+        self.scheduler: Optional[Scheduler] = None
+        self.router: Optional[Router] = None
+        self.packer: Optional[PromptPacker] = None
+        self.ledger: Optional[Ledger] = None
+        self.config: ChatConfig = config or ChatConfig()
 
-    def is_ready(self) -> bool:
+    def is_ready(self, session: Optional[Session] = None) -> bool:
         """Check if the ChatManager is ready to work
 
+        Args:
+            session: The session of the request, cur_session if None
+
         TODO: Add hints for reasons of failure
         """
 
         # key check
-        if not self.keys.has_key():
+        if self.router is not None:
+            if not self.router.has_key():
+                return False
+        elif not self.keys.has_key():
             return False
 
-        # cur session check
-        if self.cur_session is None:
+        # session check
+        if session is None and self.cur_session is None:
             return False
 
         return True
 
-    def add_key(self, name: str, key: str) -> None:
+    def add_key(self,
+                name: str,
+                key: str,
+                rpm: Optional[int] = None,
+                tpm: Optional[int] = None) -> None:
+        """Add a key
+
+        Args:
+            name: The name of the key
+            key: The value of the key
+            rpm: The requests per minute quota, used by rate-limit
+            tpm: The tokens per minute quota, used by rate-limit
+        """
 
-        self.keys.add_key(name, key)
+        self.keys.add_key(name, key, rpm, tpm)
+
+    def remove_key(self, name: str) -> None:
+
+        assert (self.keys.key_name_exist(name)), "Key name does not exist"
+        key = self.keys.keys[name].key
+        self.keys.remove_key(name)
+        self.clients.remove(key)
+
+    async def aclose(self) -> None:
+        """ Close the kept-alive connections of the event loop """
+
+        await self.clients.aclose()
 
     def set_key_strategy(self, strategy: str) -> None:
         """
@@ -133,11 +370,13 @@ class ChatManager:
             'random': self.strategy_random,
             'least-used': self.strategy_least_used,
             'rest-time': self.strategy_rest_time,
+            'rate-limit': self.strategy_rate_limit,
         }
 
         """
         strategy_tab = [
-            'default', 'roll-polling', 'random', 'least-used', 'rest-time'
+            'default', 'roll-polling', 'random', 'least-used', 'rest-time',
+            'rate-limit'
         ]
         assert (strategy in strategy_tab)
 
@@ -147,63 +386,920 @@ class ChatManager:
     def send(
         self,
         msg: Union[list[ChatMessage], ChatMessage],
-        thread_num: int = 5
-    ) -> Union[List[Optional[ChatResponse]], Optional[ChatResponse]]:
+        thread_num: int = 5,
+        stream: bool = False,
+        session: Union[str, Session, None] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[List[Union[ChatResponse, ChatError, None]], ChatResponse,
+               ChatError, None, ChatStream, ChatStreamGroup]:
         """ Send messages to openai
 
+        Failed requests are retried according to retry. A message that still
+        fails gets a ChatError, which is falsy like None.
+
         Args:
             msg: The message to send
             thread_num: The number of threads to use
+            stream: Whether to stream the responses. A ChatStream is returned
+                for a single message, and a ChatStreamGroup yielding
+                (index, delta) for a list of messages.
+            session: The session (or its name) to save the pairs to instead
+                of cur_session. A missing name is created.
+            priority: The priority class of the requests, used when a
+                scheduler is set. The session name is the tenant.
+            config: The ChatConfig of the requests, over the config of the
+                manager
+
+        Returns:
+            A list of ChatResponse if the ChatManager is ready, None otherwise
+
+        """
+
+        submitted = time.perf_counter()
+        target = self._target_session(session)
+        config = self._config(config)
+        if not self.is_ready(target):
+            # TODO: throw error
+            return None if isinstance(msg, ChatMessage) else [None for _ in msg]
+
+        if stream:
+            if isinstance(msg, ChatMessage):
+                return self._send_stream(msg, target, submitted, priority,
+                                         config)
+            return ChatStreamGroup(
+                msg,
+                functools.partial(self._send_stream,
+                                  session=target,
+                                  submitted=submitted,
+                                  priority=priority,
+                                  config=config), thread_num)
+
+        if isinstance(msg, ChatMessage):
+            return self._send(msg, target, submitted, priority, config)
+
+        if self.packer is not None:
+            return self._send_packed(msg, thread_num, target, submitted,
+                                     priority, config)
+
+        with futures.ThreadPoolExecutor(thread_num) as executor:
+            return list(
+                executor.map(
+                    functools.partial(self._send,
+                                      session=target,
+                                      submitted=submitted,
+                                      priority=priority,
+                                      config=config), msg))
+
+    @typechecked
+    async def asend(
+        self,
+        msg: Union[List[ChatMessage], ChatMessage],
+        concurrency: int = 64,
+        stream: bool = False,
+        session: Union[str, Session, None] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[List[Union[ChatResponse, ChatError, None]], ChatResponse,
+               ChatError, None, AsyncChatStream, AsyncIterator[Tuple[int,
+                                                                     str]]]:
+        """ Send messages to openai on the running event loop
+
+        Args:
+            msg: The message to send
+            concurrency: The maximum number of in-flight requests
+            stream: Whether to stream the responses. An AsyncChatStream is
+                returned for a single message, and an async iterator
+                yielding (index, delta) for a list of messages.
+            session: The session (or its name) to save the pairs to instead
+                of cur_session. A missing name is created.
+            priority: The priority class of the requests, used when a
+                scheduler is set. The session name is the tenant.
+            config: The ChatConfig of the requests, over the config of the
+                manager
 
         Returns:
             A list of ChatResponse if the ChatManager is ready, None otherwise
 
         """
 
-        if not self.is_ready():
+        target = self._target_session(session)
+        config = self._config(config)
+        if not self.is_ready(target):
             # TODO: throw error
             return None if isinstance(msg, ChatMessage) else [None for _ in msg]
 
+        if stream:
+            if isinstance(msg, ChatMessage):
+                return await self._asend_stream(msg,
+                                                target,
+                                                priority=priority,
+                                                config=config)
+            return self.astream_many(msg,
+                                     concurrency,
+                                     session=target,
+                                     priority=priority,
+                                     config=config)
+
         if isinstance(msg, ChatMessage):
-            return self._send(msg)
+            return await self._asend(msg,
+                                     target,
+                                     priority=priority,
+                                     config=config)
+
+        return await self.asend_many(msg, concurrency, target, priority, config)
+
+    async def asend_many(
+        self,
+        msgs: Sequence[ChatMessage],
+        concurrency: int = 64,
+        session: Optional[Session] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> List[Union[ChatResponse, ChatError, None]]:
+        """Send multiple messages with at most concurrency in flight
+
+        A fixed number of workers pull from a shared iterator, so the number
+        of pending coroutines stays bounded no matter how long msgs is.
+
+        Args:
+            msgs: The messages to send
+            concurrency: The maximum number of in-flight requests
+            session: The session to save the pairs to, cur_session if None
+            priority: The priority class of the requests
+            config: The ChatConfig of the requests, over the config of the
+                manager
+
+        Returns:
+            The responses, in the same order as msgs
+
+        """
+
+        assert (concurrency > 0), "concurrency must be positive"
+        if session is None:
+            session = self.cur_session
+        submitted = time.perf_counter()
+        config = self._config(config)
+
+        results: List[Union[ChatResponse, ChatError,
+                            None]] = [None for _ in msgs]
+        if self.packer is not None and session is not None:
+            groups = self.packer.pack(msgs, config.model)
+        else:
+            groups = [[_] for _ in range(len(msgs))]
+        pending = iter(groups)
+
+        async def worker() -> None:
+            for group in pending:
+                responses = await self._asend_group([msgs[_] for _ in group],
+                                                    session, submitted,
+                                                    priority, config)
+                for index, response in zip(group, responses):
+                    results[index] = response
+
+        await asyncio.gather(
+            *(worker() for _ in range(min(concurrency, len(groups)))))
+        return results
+
+    def _send_packed(
+            self, msgs: Sequence[ChatMessage], thread_num: int,
+            session: Optional[Session], submitted: float, priority: str,
+            config: ChatConfig) -> List[Union[ChatResponse, ChatError, None]]:
+        """ Send a list of messages packed into fewer requests """
+
+        assert (self.packer is not None)
+        results: List[Union[ChatResponse, ChatError,
+                            None]] = [None for _ in msgs]
+
+        def run(group: List[int]) -> None:
+            responses = self._send_group([msgs[_] for _ in group], session,
+                                         submitted, priority, config)
+            for index, response in zip(group, responses):
+                results[index] = response
 
         with futures.ThreadPoolExecutor(thread_num) as executor:
-            return list(executor.map(self._send, msg))
+            list(executor.map(run, self.packer.pack(msgs, config.model)))
+        return results
+
+    def _send_group(
+        self, msgs: List[ChatMessage], session: Optional[Session],
+        submitted: Optional[float], priority: str, config: Optional[ChatConfig]
+    ) -> List[Union[ChatResponse, ChatError, None]]:
+        """Send a group of messages as one packed request
+
+        Each message is pushed to the session with its own response, the
+        packed pair is not. If the packed response cannot be split, the
+        messages are sent one by one.
+
+        Returns:
+            The responses, in the order of msgs
+        """
+
+        if len(msgs) == 1 or self.packer is None or session is None:
+            return [
+                self._send(_, session, submitted, priority, config)
+                for _ in msgs
+            ]
+
+        if config is None:
+            config = self._config(None)
+
+        # a session of the same tenant that keeps nothing
+        scratch = Session(session.name, window=0)
+        response = self._send(self.packer.combine(msgs), scratch, submitted,
+                              priority,
+                              self.packer.packed_config(config, len(msgs)))
+        if not isinstance(response, ChatResponse):
+            for msg in msgs:
+                session.push(msg, None)
+            return [response for _ in msgs]
+        if (responses := self.packer.split(response, msgs,
+                                           config.model)) is None:
+            return [
+                self._send(_, session, submitted, priority, config)
+                for _ in msgs
+            ]
+        for msg, split in zip(msgs, responses):
+            session.push(msg, split)
+        return list(responses)
+
+    async def _asend_group(
+        self, msgs: List[ChatMessage], session: Optional[Session],
+        submitted: Optional[float], priority: str, config: Optional[ChatConfig]
+    ) -> List[Union[ChatResponse, ChatError, None]]:
+        """ Same as _send_group, on the running event loop """
 
-    def _send(self, msg: ChatMessage) -> Optional[ChatResponse]:
+        if len(msgs) == 1 or self.packer is None or session is None:
+            return [
+                await self._asend(_, session, submitted, priority, config)
+                for _ in msgs
+            ]
+
+        if config is None:
+            config = self._config(None)
+
+        scratch = Session(session.name, window=0)
+        response = await self._asend(
+            self.packer.combine(msgs), scratch, submitted, priority,
+            self.packer.packed_config(config, len(msgs)))
+        if not isinstance(response, ChatResponse):
+            for msg in msgs:
+                session.push(msg, None)
+            return [response for _ in msgs]
+        if (responses := self.packer.split(response, msgs,
+                                           config.model)) is None:
+            return [
+                await self._asend(_, session, submitted, priority, config)
+                for _ in msgs
+            ]
+        for msg, split in zip(msgs, responses):
+            session.push(msg, split)
+        return list(responses)
+
+    def astream_many(
+            self,
+            msgs: Sequence[ChatMessage],
+            concurrency: int = 64,
+            responses: Optional[List[Union[ChatResponse, ChatError,
+                                           None]]] = None,
+            session: Optional[Session] = None,
+            priority: str = 'default',
+            config: Optional[ChatConfig] = None
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """Stream multiple messages with at most concurrency in flight
+
+        Args:
+            msgs: The messages to send
+            concurrency: The maximum number of in-flight requests
+            responses: If given, filled with the complete responses (or
+                ChatError) in the order of msgs
+            session: The session to save the pairs to, cur_session if None
+            priority: The priority class of the requests
+            config: The ChatConfig of the requests, over the config of the
+                manager
+
+        Returns:
+            An async iterator yielding (index, delta) in arrival order
+
+        """
+
+        if session is None:
+            session = self.cur_session
+        return stream_many(
+            msgs,
+            functools.partial(self._asend_stream,
+                              session=session,
+                              submitted=time.perf_counter(),
+                              priority=priority,
+                              config=self._config(config)), concurrency,
+            responses)
+
+    def _send(
+        self,
+        msg: ChatMessage,
+        session: Optional[Session] = None,
+        submitted: Optional[float] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[ChatResponse, ChatError, None]:
         """Send a message to openai
 
         Args:
             msg: The message to send
+            session: The session to push the pair to, cur_session if None
+            submitted: The perf_counter time the message was handed to
+                send/asend, for the queue wait of the trace
+            priority: The priority class of the request
+            config: The resolved ChatConfig, that of the manager if None
+
+        Returns:
+            ChatResponse if the ChatManager is ready, None otherwise
+
+        """
+
+        if session is None:
+            session = self.cur_session
+        if not self.is_ready(session):
+            # TODO: throw error
+            return None
+
+        assert (session is not None)
+        if config is None:
+            config = self._config(None)
+        start = time.perf_counter()
+        trace = self._trace(session, submitted, start)
+        msg = self._prepare(msg, config)
+        req_key = self._request_key(msg, config)
+        if cached := self._lookup(req_key, msg, config):
+            session.push(msg, cached)
+            trace.cached = True
+            self._finish(trace, cached, start)
+            return cached
+
+        def call() -> Union[ChatResponse, ChatError, None]:
+            tokens = self._estimate(msg, config)
+            held = self._reserve(session, config, tokens)
+            if isinstance(held, ChatError):
+                return held
+            response: Union[ChatResponse, ChatError, None] = None
+            name = ''
+            try:
+                if held is not None and held.delay:
+                    time.sleep(held.delay)
+                with self._slot(priority, session.name):
+                    response, name = self._call(msg, tokens, send_msg, trace,
+                                                config)
+            finally:
+                # also on an exception, the reservation is released
+                self._settle(name, tokens, response, held)
+            self._store(req_key, response, msg, config)
+            return response
+
+        if req_key and self.coalesce:
+            response, trace.shared = self.flight.do(req_key, call)
+        else:
+            response = call()
+        self._push(session, msg, response)
+        self._finish(trace, response, start)
+        return response
+
+    async def _asend(
+        self,
+        msg: ChatMessage,
+        session: Optional[Session] = None,
+        submitted: Optional[float] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[ChatResponse, ChatError, None]:
+        """Send a message to openai asynchronously
+
+        Args:
+            msg: The message to send
+            session: The session to push the pair to, cur_session if None
+            submitted: The perf_counter time the message was handed to
+                send/asend, for the queue wait of the trace
+            priority: The priority class of the request
+            config: The resolved ChatConfig, that of the manager if None
 
         Returns:
             ChatResponse if the ChatManager is ready, None otherwise
 
         """
 
-        if not self.is_ready():
+        if session is None:
+            session = self.cur_session
+        if not self.is_ready(session):
             # TODO: throw error
             return None
 
-        assert (key := self.keys.get_key())
-        response = send_msg(msg.drain(), key)
-        assert (self.cur_session is not None)
-        self.cur_session.push(msg, response)
+        assert (session is not None)
+        if config is None:
+            config = self._config(None)
+        start = time.perf_counter()
+        trace = self._trace(session, submitted, start)
+        msg = self._prepare(msg, config)
+        req_key = self._request_key(msg, config)
+        if cached := self._lookup(req_key, msg, config):
+            session.push(msg, cached)
+            trace.cached = True
+            self._finish(trace, cached, start)
+            return cached
+
+        async def call() -> Union[ChatResponse, ChatError, None]:
+            tokens = self._estimate(msg, config)
+            held = self._reserve(session, config, tokens)
+            if isinstance(held, ChatError):
+                return held
+            response: Union[ChatResponse, ChatError, None] = None
+            name = ''
+            try:
+                if held is not None and held.delay:
+                    await asyncio.sleep(held.delay)
+                async with self._aslot(priority, session.name):
+                    response, name = await self._acall(msg, tokens, asend_msg,
+                                                       trace, config)
+            finally:
+                # also on a cancellation, the reservation is released
+                self._settle(name, tokens, response, held)
+            self._store(req_key, response, msg, config)
+            return response
+
+        if req_key and self.coalesce:
+            response, trace.shared = await self.flight.ado(req_key, call)
+        else:
+            response = await call()
+        self._push(session, msg, response)
+        self._finish(trace, response, start)
         return response
 
-    def set_session(self, name: str) -> None:
+    def _send_stream(
+        self,
+        msg: ChatMessage,
+        session: Optional[Session] = None,
+        submitted: Optional[float] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[ChatStream, ChatError, None]:
+        """Send a message to openai and stream the response
+
+        Only opening the stream is retried. The (message, response) pair is
+        pushed to the session once the stream ends.
+        """
+
+        if session is None:
+            session = self.cur_session
+        if not self.is_ready(session):
+            # TODO: throw error
+            return None
+
+        assert (session is not None)
+        if config is None:
+            config = self._config(None)
+        start = time.perf_counter()
+        trace = self._trace(session, submitted, start)
+        msg = self._prepare(msg, config)
+        tokens = self._estimate(msg, config)
+        held = self._reserve(session, config, tokens)
+        if isinstance(held, ChatError):
+            session.push(msg, None)
+            self._finish(trace, held, start)
+            return held
+        stream: Union[ChatStream, ChatError, None] = None
+        name = ''
+        try:
+            if held is not None and held.delay:
+                time.sleep(held.delay)
+            # the slot is held while the stream opens, not while it is read
+            with self._slot(priority, session.name):
+                stream, name = self._call(msg, tokens, send_msg_stream, trace,
+                                          config)
+                if isinstance(stream, ChatStream):
+                    # settles the reservation once the stream ends or closes
+                    stream.on_finish = lambda response: self._record(
+                        session, msg, name, tokens, response, trace, stream,
+                        start, held)
+        finally:
+            if not isinstance(stream, ChatStream):
+                self._settle(name, tokens, stream, held)
+        if not isinstance(stream, ChatStream):
+            session.push(msg, None)
+            self._finish(trace, stream, start)
+        return stream
+
+    async def _asend_stream(
+        self,
+        msg: ChatMessage,
+        session: Optional[Session] = None,
+        submitted: Optional[float] = None,
+        priority: str = 'default',
+        config: Optional[ChatConfig] = None
+    ) -> Union[AsyncChatStream, ChatError, None]:
+        """Send a message to openai and stream the response asynchronously
+
+        Only opening the stream is retried. The (message, response) pair is
+        pushed to the session once the stream ends.
+        """
+
+        if session is None:
+            session = self.cur_session
+        if not self.is_ready(session):
+            # TODO: throw error
+            return None
+
+        assert (session is not None)
+        if config is None:
+            config = self._config(None)
+        start = time.perf_counter()
+        trace = self._trace(session, submitted, start)
+        msg = self._prepare(msg, config)
+        tokens = self._estimate(msg, config)
+        held = self._reserve(session, config, tokens)
+        if isinstance(held, ChatError):
+            session.push(msg, None)
+            self._finish(trace, held, start)
+            return held
+        stream: Union[AsyncChatStream, ChatError, None] = None
+        name = ''
+        try:
+            if held is not None and held.delay:
+                await asyncio.sleep(held.delay)
+            async with self._aslot(priority, session.name):
+                stream, name = await self._acall(msg, tokens, asend_msg_stream,
+                                                 trace, config)
+                if isinstance(stream, AsyncChatStream):
+                    # settles the reservation once the stream ends or closes
+                    stream.on_finish = lambda response: self._record(
+                        session, msg, name, tokens, response, trace, stream,
+                        start, held)
+        finally:
+            if not isinstance(stream, AsyncChatStream):
+                self._settle(name, tokens, stream, held)
+        if not isinstance(stream, AsyncChatStream):
+            session.push(msg, None)
+            self._finish(trace, stream, start)
+        return stream
+
+    def _call(self, msg: ChatMessage, tokens: int, send: Callable[..., Any],
+              trace: RequestTrace, config: ChatConfig) -> Tuple[Any, str]:
+        """Send a message with send_msg or send_msg_stream, retrying failures
+
+        Returns:
+            (result, name of the last key used), result is a ChatError if
+            every attempt failed
+        """
+
+        deadline = self.retry.deadline_at()
+        attempt = 0
+        name = ''
+        while True:
+            if (error := self._check(deadline, attempt, name,
+                                     config.api_base)) is not None:
+                return error, name
+
+            attempt += 1
+            begin = time.perf_counter()
+            endpoint = self.router.pick() if self.router else None
+            errors: List[Exception] = []
+            latency: Optional[float] = None
+            key: Optional[str] = None
+            try:
+                keys = endpoint.keys if endpoint else self.keys
+                if (key := keys.get_key(tokens=tokens)) is None:
+                    # the key group is empty, e.g. its keys were removed
+                    return ChatError('no_key', 'no key is available', None,
+                                     attempt - 1, name or None), name
+                name = keys.get_key_name(key) or ''
+                sent = time.perf_counter()
+                result = send(msg.drain(), key, self.clients, errors.append,
+                              self.retry.request_timeout(deadline),
+                              self._target(endpoint, config))
+                latency = time.perf_counter() - sent
+                trace.step(name, sent - begin, latency)
+            finally:
+                self._report(endpoint, latency, errors)
+                if latency is None and key is not None:
+                    # the attempt raised, give back the quota it reserved
+                    keys.report_usage(name, tokens, 0)
+            if result is not None:
+                self._succeed(name, config.api_base)
+                return result, name
+
+            if (delay := self._fail(name, tokens, errors[0], attempt, deadline,
+                                    config.api_base)) is None:
+                return ChatError.from_exception(errors[0], attempt, name), name
+            time.sleep(delay)
+
+    async def _acall(self, msg: ChatMessage, tokens: int,
+                     send: Callable[..., Any], trace: RequestTrace,
+                     config: ChatConfig) -> Tuple[Any, str]:
+        """ Same as _call, with asend_msg or asend_msg_stream """
+
+        deadline = self.retry.deadline_at()
+        attempt = 0
+        name = ''
+        while True:
+            if (error := self._check(deadline, attempt, name,
+                                     config.api_base)) is not None:
+                return error, name
+
+            attempt += 1
+            begin = time.perf_counter()
+            endpoint = self.router.pick() if self.router else None
+            errors: List[Exception] = []
+            latency: Optional[float] = None
+            key: Optional[str] = None
+            try:
+                keys = endpoint.keys if endpoint else self.keys
+                if (key := await keys.aget_key(tokens=tokens)) is None:
+                    # the key group is empty, e.g. its keys were removed
+                    return ChatError('no_key', 'no key is available', None,
+                                     attempt - 1, name or None), name
+                name = keys.get_key_name(key) or ''
+                sent = time.perf_counter()
+                result = await send(msg.drain(), key, self.clients,
+                                    errors.append,
+                                    self.retry.request_timeout(deadline),
+                                    self._target(endpoint, config))
+                latency = time.perf_counter() - sent
+                trace.step(name, sent - begin, latency)
+            finally:
+                self._report(endpoint, latency, errors)
+                if latency is None and key is not None:
+                    # the attempt raised, give back the quota it reserved
+                    keys.report_usage(name, tokens, 0)
+            if result is not None:
+                self._succeed(name, config.api_base)
+                return result, name
+
+            if (delay := self._fail(name, tokens, errors[0], attempt, deadline,
+                                    config.api_base)) is None:
+                return ChatError.from_exception(errors[0], attempt, name), name
+            await asyncio.sleep(delay)
+
+    def _check(self, deadline: Optional[float], attempt: int, name: str,
+               api_base: Optional[str]) -> Optional[ChatError]:
+        """ Refuse to send if the deadline passed or api_base is open
+
+        With a router, the health of the endpoints is left to it.
+        """
+
+        if deadline is not None and time.monotonic() >= deadline:
+            return ChatError('deadline', 'deadline exceeded', None, attempt,
+                             name or None)
+        if self.router is None and api_base and not self.breaker.allow(
+                api_base):
+            return ChatError('circuit_open', f'{api_base} is out of rotation',
+                             None, attempt, name or None)
+        return None
+
+    def _succeed(self, name: str, api_base: Optional[str]) -> None:
+        self.breaker.record_success(name)
+        if self.router is None and api_base:
+            self.breaker.record_success(api_base)
+
+    def _fail(self, name: str, tokens: int, e: Exception, attempt: int,
+              deadline: Optional[float],
+              api_base: Optional[str]) -> Optional[float]:
+        """Account for a failed attempt
+
+        Key-specific failures take the key out of rotation so the next
+        attempt fails over to another key. Unhealthy keys and api_base are
+        counted by the circuit breaker.
+
+        Returns:
+            Seconds to wait before the next attempt, None to give up
+        """
+
+        kind = classify(e)
+        keys = self._keys_of(name)
+        keys.report_error(name, e)
+        keys.report_usage(name, tokens, 0)
+
+        if kind in KEY_SPECIFIC:
+            rest = retry_after(e)
+            if rest is None:
+                rest = keys.cooldown if kind == 'rate_limit' else self.breaker.reset_timeout
+            keys.suspend(name, rest)
+        elif kind in UNHEALTHY:
+            if self.breaker.record_failure(name):
+                keys.suspend(name, self.breaker.reset_timeout)
+            if self.router is None and api_base:
+                self.breaker.record_failure(api_base)
+
+        delay = self.retry.delay(attempt, e)
+        if delay is not None and deadline is not None and time.monotonic(
+        ) + delay >= deadline:
+            return None
+        return delay
+
+    def _keys_of(self, name: str) -> KeyGroup:
+        """ The key group holding a key name """
+
+        if self.router is not None and (keys := self.router.keys_of(name)):
+            return keys
+        return self.keys
+
+    def _config(self, config: Optional[ChatConfig]) -> ChatConfig:
+        """The config of a request over that of the manager
+
+        Resolved once per call, so a change of ChatSetup does not split a
+        batch.
+        """
+
+        return self.config.merge(config).resolve()
+
+    def _target(self, endpoint: Optional[Endpoint],
+                config: ChatConfig) -> ChatConfig:
+        """ The config of a request sent to an endpoint """
+
+        if endpoint is None:
+            return config
+        return config.replace(api_base=endpoint.api_base,
+                              model=endpoint.model(config.model or ''))
+
+    def _report(self, endpoint: Optional[Endpoint], latency: Optional[float],
+                errors: List[Exception]) -> None:
+        """Feed the outcome of an attempt to the router
+
+        latency is None if the attempt raised (e.g. it was cancelled), the
+        endpoint is then only released.
+        """
+
+        if self.router is None or endpoint is None:
+            return
+        if latency is None:
+            self.router.release(endpoint)
+        else:
+            self.router.report(endpoint, latency,
+                               classify(errors[0]) if errors else None)
+
+    @contextmanager
+    def _slot(self, priority: str, tenant: str) -> Iterator[None]:
+        """ Hold a scheduler slot, if a scheduler is set """
+
+        if self.scheduler is None:
+            yield
+            return
+        with self.scheduler.slot(priority, tenant):
+            yield
+
+    @asynccontextmanager
+    async def _aslot(self, priority: str, tenant: str) -> AsyncIterator[None]:
+        if self.scheduler is None:
+            yield
+            return
+        async with self.scheduler.aslot(priority, tenant):
+            yield
+
+    def _prepare(self, msg: ChatMessage, config: ChatConfig) -> ChatMessage:
+        """ The message actually sent, trimmed if a trimmer is set """
+
+        if self.trimmer is None:
+            return msg
+        return self.trimmer.trim(msg, config.model)
+
+    def _request_key(self, msg: ChatMessage,
+                     config: ChatConfig) -> Optional[str]:
+        """The canonical key of the request body
+
+        None if neither caching nor coalescing is on.
+        """
+
+        if self.cache is None and not self.coalesce:
+            return None
+        return request_key(build_request_body(msg.drain(), config))
+
+    def _lookup(self, key: Optional[str], msg: ChatMessage,
+                config: ChatConfig) -> Optional[ChatResponse]:
+        """ The cached response of the request, exact matches first """
+
+        if key and self.cache is not None and (payload :=
+                                               self.cache.get(key)) is not None:
+            return ChatResponse(payload)
+        if self.semantic_cache is not None and (
+                payload := self.semantic_cache.get(
+                    build_request_body(msg.drain(), config))) is not None:
+            return ChatResponse(payload)
+        return None
+
+    def _store(self, key: Optional[str], response: Union[ChatResponse,
+                                                         ChatError, None],
+               msg: ChatMessage, config: ChatConfig) -> None:
+        if not isinstance(response, ChatResponse):
+            return
+        if key and self.cache is not None:
+            self.cache.set(key, response.response)
+        if self.semantic_cache is not None:
+            self.semantic_cache.set(build_request_body(msg.drain(), config),
+                                    response.response)
+
+    def _estimate(self, msg: ChatMessage, config: ChatConfig) -> int:
+        """ The token cost reserved from the key quota before sending """
+
+        needs_tokens = self.keys.needs_tokens() or (
+            self.router is not None and
+            self.router.needs_tokens()) or self.ledger is not None
+        return msg.token_usage(config.model) if needs_tokens else 0
+
+    def _reserve(self, session: Session, config: ChatConfig,
+                 tokens: int) -> Union[Reservation, ChatError, None]:
+        """ Hold the estimate of a request in the ledger, if one is set """
+
+        if self.ledger is None:
+            return None
+        return self.ledger.reserve(session.name, config.model or '', tokens,
+                                   config.max_tokens, config.n)
+
+    def _record(self,
+                session: Session,
+                msg: ChatMessage,
+                name: str,
+                tokens: int,
+                response: Optional[ChatResponse],
+                trace: RequestTrace,
+                stream: StreamCollector,
+                start: float,
+                held: Optional[Reservation] = None) -> None:
+        """ Account for a finished stream
+
+        Push the pair to the session, settle the reserved quota and record
+        the trace.
+        """
+
+        self._settle(name, tokens, response, held)
+        self._push(session, msg, response)
+        if stream.first_token_at is not None:
+            trace.first_token = stream.first_token_at - start
+        self._finish(trace, response or stream.error, start)
+
+    def _trace(self, session: Session, submitted: Optional[float],
+               start: float) -> RequestTrace:
+        trace = RequestTrace(session.name)
+        if submitted is not None:
+            trace.queue_wait = start - submitted
+        return trace
+
+    def _finish(self, trace: RequestTrace, response: Union[ChatResponse,
+                                                           ChatError, None],
+                start: float) -> None:
+        """ Complete the trace with the outcome and record it """
+
+        if self.telemetry is None:
+            return
+        trace.total = time.perf_counter() - start
+        if isinstance(response, ChatResponse):
+            # a cache hit or a coalesced follower spends no tokens
+            if trace.attempts:
+                trace.prompt_tokens = response.prompt_tokens
+                trace.completion_tokens = response.completion_tokens
+        else:
+            trace.error = response.kind if response is not None else 'unknown'
+        self.telemetry.record(trace)
+
+    def _settle(self,
+                name: str,
+                tokens: int,
+                response: Union[ChatResponse, ChatError, None],
+                held: Optional[Reservation] = None) -> None:
+        """ Correct the quota and the ledger reserved for the request """
+
+        if isinstance(response, ChatResponse):
+            self._keys_of(name).report_usage(name, tokens,
+                                             response.token_usage())
+        if held is not None and self.ledger is not None:
+            self.ledger.settle(
+                held, name,
+                response if isinstance(response, ChatResponse) else None)
+
+    def _push(self, session: Session, msg: ChatMessage,
+              response: Union[ChatResponse, ChatError, None]) -> None:
+        """ Push the pair to the session, a failed request is recorded as None
+        """
+
+        if isinstance(response, ChatResponse):
+            session.push(msg, response)
+        else:
+            session.push(msg, None)
+
+    def set_session(self,
+                    name: str,
+                    store: Optional[SessionStore] = None,
+                    window: Optional[int] = None) -> None:
         """Assign the current session
 
         If the session does not exist, create a new one.
 
         Args:
             name: The name of the session
+            store: Append each pair of a new session to this store
+            window: Keep only the latest window pairs of a new session in
+                memory, the full history stays in the store
         """
 
-        session = self.get_session(name)
-        if not session:
-            self.sessions.append(session := Session(name))
-        self.cur_session = session
+        with self.session_lock:
+            if (session := self.sessions.get(name)) is None:
+                session = self.sessions[name] = Session(name, store, window)
+            self.cur_session = session
 
     def get_session(self, name: str) -> Optional[Session]:
         """Get a session by name
@@ -216,10 +1312,20 @@ class ChatManager:
 
         """
 
-        for session in self.sessions:
-            if session.name == name:
-                return session
-        return None
+        return self.sessions.get(name)
+
+    def _target_session(
+            self, session: Union[str, Session, None]) -> Optional[Session]:
+        """ The session a request saves to, creating a missing name """
+
+        if session is None:
+            return self.cur_session
+        if isinstance(session, Session):
+            return session
+        with self.session_lock:
+            if (target := self.sessions.get(session)) is None:
+                target = self.sessions[session] = Session(session)
+            return target
 
     def export_session(self,
                        export_processor: Optional[Callable[
@@ -0,0 +1,195 @@
+"""
+Pooled HTTP clients bound to api keys
+"""
+
+import asyncio
+import threading
+from typing import Dict, Optional, Tuple, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import aiohttp
+    import requests
+
+# openai, requests and aiohttp take a while to import, they are imported
+# when the first client is created or used
+
+# the requests session of the ChatClient calling openai on this thread
+active = threading.local()
+
+_router: Optional['requests.Session'] = None
+_router_lock = threading.Lock()
+
+
+def session_router() -> 'requests.Session':
+    """The session installed as openai.requestssession
+
+    openai keeps the session it gets from the hook per thread, so the
+    installed one forwards each request to the session of the ChatClient
+    active on the calling thread, or handles it itself if there is none.
+    """
+
+    global _router
+    with _router_lock:
+        if _router is None:
+            import requests
+
+            class SessionRouter(requests.Session):
+
+                def request(self, *args, **kwargs) -> Any:
+                    if (session := getattr(active, 'session', None)) is None:
+                        return super().request(*args, **kwargs)
+                    return session.request(*args, **kwargs)
+
+                def close(self) -> None:
+                    # openai closes its thread sessions every few minutes,
+                    # the pooled ones are closed with their clients
+                    pass
+
+            _router = SessionRouter()
+        return _router
+
+
+class ChatClient:
+    """ Send chat completions with fixed credentials
+
+    The key and api_base are passed with every request instead of being set
+    on the openai module, so concurrent callers never see each other's key.
+    The HTTP sessions are kept alive and reused across calls to skip the
+    connection setup and TLS handshake.
+
+    Attributes:
+        key: The api key
+        api_base: The api base url
+        pool_size: The maximum number of kept-alive connections
+        session: The requests session shared by all threads
+        asession: The aiohttp session of the event loop it was created in
+
+    """
+
+    def __init__(self, key: str, api_base: str, pool_size: int = 32) -> None:
+        self.key: str = key
+        self.api_base: str = api_base
+        self.pool_size: int = pool_size
+
+        import requests
+
+        self.session: 'requests.Session' = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.asession: Optional['aiohttp.ClientSession'] = None
+        self.aloop: Optional[asyncio.AbstractEventLoop] = None
+
+    def create(self, **request_body) -> Any:
+        """Call ChatCompletion.create through the pooled session
+
+        The session reaches openai through the public requestssession hook.
+        If it was set to another session by the user, that one is used.
+        """
+
+        import openai
+
+        if openai.requestssession is None:
+            openai.requestssession = session_router()
+        saved = getattr(active, 'session', None)
+        active.session = self.session
+        try:
+            return openai.ChatCompletion.create(api_key=self.key,
+                                                api_base=self.api_base,
+                                                **request_body)
+        finally:
+            active.session = saved
+
+    async def acreate(self, **request_body) -> Any:
+        """ Call ChatCompletion.acreate through the pooled session """
+
+        import openai
+
+        token = openai.aiosession.set(self.get_asession())
+        try:
+            return await openai.ChatCompletion.acreate(api_key=self.key,
+                                                       api_base=self.api_base,
+                                                       **request_body)
+        finally:
+            openai.aiosession.reset(token)
+
+    def get_asession(self) -> 'aiohttp.ClientSession':
+        """ Get the aiohttp session of the running event loop
+
+        aiohttp sessions are bound to a loop, a new one is created when the
+        client is used from another loop (e.g. a second asyncio.run).
+        """
+
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if self.asession is None or self.asession.closed or self.aloop is not loop:
+            if self.asession is not None and not self.asession.closed:
+                # the old loop is gone, so the session can not be closed
+                # gracefully any more
+                self.asession.detach()
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.asession = aiohttp.ClientSession(connector=connector)
+            self.aloop = loop
+        return self.asession
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def aclose(self) -> None:
+        if self.asession is not None and not self.asession.closed:
+            if self.aloop is asyncio.get_running_loop():
+                await self.asession.close()
+            else:
+                self.asession.detach()
+        self.asession = None
+        self.aloop = None
+
+
+class ClientPool:
+    """ Manage one ChatClient per (key, api_base)
+
+    Attributes:
+        pool_size: The connection pool size of each client
+        clients: The clients indexed by (key, api_base)
+
+    """
+
+    def __init__(self, pool_size: int = 32) -> None:
+        self.pool_size: int = pool_size
+        self.clients: Dict[Tuple[str, str], ChatClient] = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, api_base: str) -> ChatClient:
+        """ Get the client of the key, create it if not exist """
+
+        with self.lock:
+            client = self.clients.get((key, api_base))
+            if client is None:
+                client = ChatClient(key, api_base, self.pool_size)
+                self.clients[(key, api_base)] = client
+            return client
+
+    def remove(self, key: str) -> None:
+        """ Close and remove all clients of the key """
+
+        with self.lock:
+            for k in [_ for _ in self.clients if _[0] == key]:
+                self.clients.pop(k).close()
+
+    def close(self) -> None:
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+    async def aclose(self) -> None:
+        """ Close the aiohttp sessions of all clients """
+
+        for client in list(self.clients.values()):
+            await client.aclose()
+
+
+client_pool = ClientPool()
@@ -0,0 +1,100 @@
+"""
+Share one upstream call among concurrent identical requests
+"""
+
+import asyncio
+import threading
+from typing import Dict, Optional, Any, Tuple, Callable, Awaitable
+
+# the result a cancelled leader leaves to its followers
+HANDOFF = object()
+
+
+class Call:
+    """ An in-flight call, waited on by the followers """
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """ Run at most one call per key at a time
+
+    A caller arriving while a call with the same key is in flight waits for
+    it and gets its result instead of calling again.
+
+    Attributes:
+        calls: The in-flight calls of threads
+        futures: The in-flight calls of coroutines, per event loop
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, Call] = dict()
+        self.futures: Dict[Tuple[int, str], asyncio.Future] = dict()
+        self.lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Call fn unless a call with the same key is in flight
+
+        Returns:
+            (result, shared), shared is True if the result came from the
+            call of another thread
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def ado(self, key: str,
+                  fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Same as do, for coroutines running on one event loop
+
+        If the leading coroutine is cancelled, its followers are not: the
+        first of them to resume calls again and leads the rest.
+        """
+
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        while (future := self.futures.get(flight_key)) is not None:
+            result = await asyncio.shield(future)
+            if result is not HANDOFF:
+                return result, True
+
+        future = loop.create_future()
+        self.futures[flight_key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.set_result(HANDOFF)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark the exception as retrieved if nobody is waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.futures[flight_key]
+        return result, False
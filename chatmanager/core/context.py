@@ -0,0 +1,123 @@
+"""
+Keep a message within the context window before it is sent
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, List, Callable
+
+from chatmanager.config import ChatSetup
+from chatmanager.util import num_tokens_from_message, logger
+from .session import ChatMessage
+
+
+class ContextTrimmer:
+    """ Trim a message to a token budget
+
+    The leading system messages and the latest turns are kept, the oldest
+    turns in between are dropped. With summarize, the dropped turns are
+    replaced by a system message holding their summary. Summaries are
+    cached, so a growing conversation is only summarized again when more
+    turns fall out of the window.
+
+    Token counts are memoized per string, so only new turns are encoded.
+
+    Attributes:
+        max_tokens: The token budget of the prompt
+        keep_system: Whether the leading system messages are always kept
+        keep_last: The number of latest messages always kept
+        summarize: Summarize a list of dropped messages, None to drop them
+        summary_tokens: The budget reserved for the summary
+        summary_prefix: Put before the summary in the system message
+        summaries: Hash of dropped messages -> summary, least recent first
+        max_summaries: The maximum number of cached summaries
+    """
+
+    def __init__(self,
+                 max_tokens: int,
+                 keep_system: bool = True,
+                 keep_last: int = 1,
+                 summarize: Optional[Callable[[List[Dict[str, str]]],
+                                              str]] = None,
+                 summary_tokens: int = 256,
+                 summary_prefix: str = "Summary of the earlier conversation: ",
+                 max_summaries: int = 1024) -> None:
+        assert (max_tokens > 0), "max_tokens must be positive"
+        self.max_tokens: int = max_tokens
+        self.keep_system: bool = keep_system
+        self.keep_last: int = keep_last
+        self.summarize: Optional[Callable[[List[Dict[str, str]]],
+                                          str]] = summarize
+        self.summary_tokens: int = summary_tokens
+        self.summary_prefix: str = summary_prefix
+        self.summaries: 'OrderedDict[str, str]' = OrderedDict()
+        self.max_summaries: int = max_summaries
+        self.lock = threading.Lock()
+
+    def trim(self,
+             msg: ChatMessage,
+             model: Optional[str] = None) -> ChatMessage:
+        """Return msg if it fits the budget, a trimmed copy otherwise
+
+        Args:
+            msg: The message to trim
+            model: The model counting the tokens, ChatSetup.model by default
+        """
+
+        model = model or ChatSetup.model
+        # the counts of a shared history are cached on its nodes
+        if msg.token_usage(model) <= self.max_tokens:
+            return msg
+
+        messages = msg.drain()
+        counts = [num_tokens_from_message(_, model) for _ in messages]
+
+        head = 0
+        if self.keep_system:
+            while head < len(messages) and messages[head].get(
+                    'role') == 'system':
+                head += 1
+
+        budget = self.max_tokens - 3 - sum(counts[:head])
+        if self.summarize is not None:
+            budget -= self.summary_tokens
+
+        # take the latest turns while they fit, at least keep_last of them
+        tail = len(messages)
+        while tail > head:
+            kept = len(messages) - tail
+            if kept >= self.keep_last and counts[tail - 1] > budget:
+                break
+            budget -= counts[tail - 1]
+            tail -= 1
+
+        if budget < 0:
+            logger.warning("message exceeds %d tokens after trimming",
+                           self.max_tokens)
+
+        trimmed = ChatMessage()
+        trimmed.push_msg(messages[:head])
+        dropped = messages[head:tail]
+        if dropped and self.summarize is not None:
+            trimmed.push_system(self.summary_prefix + self.summary_of(dropped))
+        trimmed.push_msg(messages[tail:])
+        return trimmed
+
+    def summary_of(self, dropped: List[Dict[str, str]]) -> str:
+        assert (self.summarize is not None)
+        key = hashlib.sha256(
+            json.dumps(dropped, sort_keys=True,
+                       ensure_ascii=False).encode('utf-8')).hexdigest()
+        with self.lock:
+            if (summary := self.summaries.get(key)) is not None:
+                self.summaries.move_to_end(key)
+                return summary
+
+        summary = self.summarize(dropped)
+        with self.lock:
+            self.summaries[key] = summary
+            while len(self.summaries) > self.max_summaries:
+                self.summaries.popitem(last=False)
+        return summary
@@ -2,9 +2,13 @@
 Manage the api keys
 """
 
+import asyncio
+import bisect
+import heapq
 import random
+import threading
 import time
-from typing import List, Dict, Optional, Callable
+from typing import List, Dict, Optional, Callable, Tuple
 
 
 class Key:
@@ -14,6 +18,86 @@ class Key:
         self.key: str = key
 
 
+class TokenBucket:
+    """ A bucket of capacity tokens refilled continuously at rate per second
+
+    Attributes:
+        capacity: The maximum number of tokens
+        rate: The number of tokens refilled per second
+        tokens: The current number of tokens, negative if overdrawn
+        updated: The time of the last refill
+    """
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity: float = capacity
+        self.rate: float = rate
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """ Seconds until amount tokens are available """
+
+        self.refill(now)
+        # a request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def give(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class KeyLimit:
+    """ The request and token quotas of a key
+
+    Attributes:
+        requests: Bucket of requests per minute, None if unlimited
+        tokens: Bucket of tokens per minute, None if unlimited
+        cooldown_until: The key is not used before this time (monotonic)
+    """
+
+    def __init__(self,
+                 rpm: Optional[int] = None,
+                 tpm: Optional[int] = None) -> None:
+        self.requests: Optional[TokenBucket] = TokenBucket(rpm, rpm /
+                                                           60) if rpm else None
+        self.tokens: Optional[TokenBucket] = TokenBucket(tpm, tpm /
+                                                         60) if tpm else None
+        self.cooldown_until: float = 0.0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        """ Seconds until a request costing tokens can be sent """
+
+        wait = self.cooldown_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return max(wait, 0.0)
+
+    def take(self, tokens: int) -> None:
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    def headroom(self) -> float:
+        """ The fraction of the request quota left, 1.0 if unlimited """
+
+        if self.requests is None:
+            return 1.0
+        return self.requests.tokens / self.requests.capacity
+
+
 class KeyGroup:
     """ Manage multiple api keys
 
@@ -24,36 +108,142 @@ class KeyGroup:
         use_cnt: The number of times each key has been used
         key_index: Sorted names of the keys, used for roll-polling
         cur_key_index: Store the index of the next key to use in key_index
+        limits: The rate limits of each key, used for rate-limit
+        cooldown: Seconds a key rests after a 429 without Retry-After
+        value_index: Map the value of each key to its name
+        use_heap: Min-heap of (use_cnt, name), used for least-used
+        rest_heap: Min-heap of (last_use_time, name), used for rest-time
+        suspended: The keys out of rotation, mapped to the monotonic time
+            they come back
+        lock: Protect the state above, get_key may be called from threads
+
+    The heaps are updated lazily: every use pushes a new entry, and entries
+    that no longer match use_cnt/last_use_time, or belong to a suspended
+    key, are dropped when they reach the top.
 
     """
 
     def __init__(self) -> None:
         self.keys: Dict[str, Key] = dict()
-        self.strategy: Callable[[], str] = self.strategy_roll_polling
+        self.strategy: Callable[[int], str] = self.strategy_roll_polling
         self.last_use_time: Dict[str, float] = dict()
         self.use_cnt: Dict[str, int] = dict()
         self.key_index: List[str] = []
         self.cur_key_index: Optional[int] = None
+        self.limits: Dict[str, KeyLimit] = dict()
+        self.cooldown: float = 1.0
+        self.value_index: Dict[str, str] = dict()
+        self.use_heap: List[Tuple[int, str]] = []
+        self.rest_heap: List[Tuple[float, str]] = []
+        self.suspended: Dict[str, float] = dict()
+        self.lock = threading.RLock()
 
     def has_key(self) -> bool:
         return len(self.keys) != 0
 
-    def get_key(self, key_name: Optional[str] = None) -> Optional[str]:
-        """ Get the next key to use according to strategy """
+    def get_key(self,
+                key_name: Optional[str] = None,
+                tokens: int = 0) -> Optional[str]:
+        """ Get the next key to use according to strategy
+
+        Args:
+            key_name: Use this key instead of consulting the strategy
+            tokens: The estimated token cost of the request, reserved from
+                the key's quota by the rate-limit strategy
+        """
 
         if len(self.keys) == 0:
             return None
 
-        if not key_name:
-            name = self.strategy()
-        else:
-            name = key_name
+        if not key_name and self.is_rate_limited():
+            # wait for quota outside of the lock
+            key_name = self.strategy_rate_limit(tokens)
+
+        with self.lock:
+            if not key_name:
+                self.resume_expired()
+                name = self.strategy(tokens)
+            else:
+                name = key_name
+
+            self.record_use(name)
+            return self.keys[name].key
+
+    async def aget_key(self,
+                       key_name: Optional[str] = None,
+                       tokens: int = 0) -> Optional[str]:
+        """ Same as get_key, but waits for quota without blocking the loop """
 
-        # update
-        self.last_use_time[name] = time.time()
+        if len(self.keys) == 0:
+            return None
+
+        if key_name or not self.is_rate_limited():
+            return self.get_key(key_name, tokens)
+
+        while True:
+            name, wait = self.reserve(tokens)
+            if name is not None:
+                break
+            await asyncio.sleep(wait)
+
+        return self.get_key(name, tokens)
+
+    def record_use(self, name: str) -> None:
+        """ Update the usage of a key, the caller holds the lock """
+
+        self.last_use_time[name] = now = time.time()
         self.use_cnt[name] += 1
 
-        return self.keys[name].key
+        heapq.heappush(self.use_heap, (self.use_cnt[name], name))
+        heapq.heappush(self.rest_heap, (now, name))
+
+        # drop the stale entries once they outnumber the live ones
+        if len(self.use_heap) > 2 * len(self.keys) + 16:
+            self.rebuild_heaps()
+
+    def suspend(self, name: str, seconds: float) -> None:
+        """ Take a key out of rotation for seconds """
+
+        with self.lock:
+            if name not in self.keys:
+                return
+            if name not in self.suspended:
+                del self.key_index[bisect.bisect_left(self.key_index, name)]
+                self.cur_key_index = None
+            self.suspended[name] = max(self.suspended.get(name, 0.0),
+                                       time.monotonic() + seconds)
+
+    def resume(self, name: str) -> None:
+        """ Put a suspended key back into rotation """
+
+        with self.lock:
+            if self.suspended.pop(name, None) is None:
+                return
+            bisect.insort(self.key_index, name)
+            self.cur_key_index = None
+            heapq.heappush(self.use_heap, (self.use_cnt[name], name))
+            heapq.heappush(self.rest_heap, (self.last_use_time[name], name))
+
+    def resume_expired(self) -> None:
+        """ Resume the keys whose suspension is over, the caller holds the lock
+
+        If every key is suspended, the one coming back first is resumed.
+        """
+
+        if not self.suspended:
+            return
+        now = time.monotonic()
+        for name, until in list(self.suspended.items()):
+            if until <= now:
+                self.resume(name)
+        if not self.key_index:
+            self.resume(min(self.suspended, key=lambda k: self.suspended[k]))
+
+    def rebuild_heaps(self) -> None:
+        self.use_heap = [(v, k) for k, v in self.use_cnt.items()]
+        self.rest_heap = [(v, k) for k, v in self.last_use_time.items()]
+        heapq.heapify(self.use_heap)
+        heapq.heapify(self.rest_heap)
 
     def set_strategy(self, strategy: str) -> None:
         """Set the strategy for choosing a key
@@ -62,6 +252,7 @@ class KeyGroup:
         random: choose a random key
         least-used: choose the key that has been used the least
         rest-time: choose the key that has not been used for the longest time
+        rate-limit: choose a key with quota left, wait if all are exhausted
 
         """
 
@@ -71,34 +262,135 @@ class KeyGroup:
             'random': self.strategy_random,
             'least-used': self.strategy_least_used,
             'rest-time': self.strategy_rest_time,
+            'rate-limit': self.strategy_rate_limit,
         }
 
         assert (strategy in tab), "Invalid strategy"
 
-        self.strategy = tab[strategy]
+        with self.lock:
+            self.strategy = tab[strategy]
+
+    def is_rate_limited(self) -> bool:
+        return self.strategy == self.strategy_rate_limit
+
+    def needs_tokens(self) -> bool:
+        """ Whether get_key makes use of the token cost of requests """
 
-    def strategy_roll_polling(self) -> str:
-        """ all strategy functions return the name of the key """
+        return self.is_rate_limited() and any(
+            _.tokens is not None for _ in self.limits.values())
+
+    def strategy_roll_polling(self, tokens: int = 0) -> str:
+        """ all strategy functions return the name of the key
+
+        tokens is the estimated token cost of the request
+        """
         if self.cur_key_index is None:
             self.cur_key_index = 0
         else:
             self.cur_key_index = (self.cur_key_index + 1) % len(self.key_index)
         return self.key_index[self.cur_key_index]
 
-    def strategy_random(self) -> str:
-        return random.choice(list(self.keys.keys()))
+    def strategy_random(self, tokens: int = 0) -> str:
+        return random.choice(self.key_index)
+
+    def strategy_least_used(self, tokens: int = 0) -> str:
+        heap = self.use_heap
+        while heap[0][1] in self.suspended or heap[0][0] != self.use_cnt.get(
+                heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    def strategy_rest_time(self, tokens: int = 0) -> str:
+        heap = self.rest_heap
+        while heap[0][1] in self.suspended or heap[0][
+                0] != self.last_use_time.get(heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    def strategy_rate_limit(self, tokens: int = 0) -> str:
+        """ Block until a key can take the request """
+
+        while True:
+            name, wait = self.reserve(tokens)
+            if name is not None:
+                return name
+            time.sleep(wait)
+
+    def reserve(self, tokens: int) -> Tuple[Optional[str], float]:
+        """ Reserve quota for a request from the key with most headroom
+
+        Returns:
+            (name, 0) if a key is reserved, otherwise (None, seconds until
+            the first key has enough quota)
+        """
 
-    def strategy_least_used(self) -> str:
-        return min(self.use_cnt, key=lambda k: self.use_cnt[k])
+        with self.lock:
+            self.resume_expired()
+            now = time.monotonic()
+            best: Optional[str] = None
+            best_headroom = -1.0
+            min_wait = float('inf')
+            for name in self.key_index:
+                limit = self.limits[name]
+                wait = limit.wait_time(tokens, now)
+                if wait > 0:
+                    min_wait = min(min_wait, wait)
+                elif (headroom := limit.headroom()) > best_headroom:
+                    best, best_headroom = name, headroom
+
+            if best is None:
+                return None, min_wait
+            self.limits[best].take(tokens)
+            return best, 0.0
+
+    def report_usage(self, name: str, reserved: int, used: int) -> None:
+        """ Correct the reserved token cost with the actual usage """
+
+        with self.lock:
+            if name not in self.limits or (bucket :=
+                                           self.limits[name].tokens) is None:
+                return
+            if used > reserved:
+                bucket.take(used - reserved)
+            else:
+                bucket.give(reserved - used)
+
+    def report_error(self, name: str, e: Exception) -> None:
+        """ Rest the key after a 429, honoring Retry-After """
+
+        if getattr(e, 'http_status', None) != 429:
+            return
+
+        cooldown = self.cooldown
+        headers = getattr(e, 'headers', None) or {}
+        try:
+            cooldown = float(headers.get('retry-after', cooldown))
+        except (TypeError, ValueError):
+            pass
+
+        with self.lock:
+            if name in self.limits:
+                limit = self.limits[name]
+                limit.cooldown_until = max(limit.cooldown_until,
+                                           time.monotonic() + cooldown)
+
+    def set_limit(self,
+                  name: str,
+                  rpm: Optional[int] = None,
+                  tpm: Optional[int] = None) -> None:
+        """ Set the requests/tokens per minute quota of a key """
 
-    def strategy_rest_time(self) -> str:
-        cur_time = time.time()
-        return max(self.last_use_time,
-                   key=lambda k: cur_time - self.last_use_time[k])
+        assert (name in self.keys), "Key name does not exist"
+        with self.lock:
+            self.limits[name] = KeyLimit(rpm, tpm)
 
     def update_key_status(self) -> None:
+        """ Rebuild the derived state from keys """
+
+        self.suspended.clear()
         self.key_index = sorted(self.keys.keys())
         self.cur_key_index = None
+        self.value_index = {_.key: _.name for _ in self.keys.values()}
 
         def align_dict(dic, keys, val):
             """ Align the keys in dic with keys, and set the new value to val """
@@ -110,13 +402,11 @@ class KeyGroup:
 
         align_dict(self.use_cnt, self.keys.keys(), 0)
         align_dict(self.last_use_time, self.keys.keys(), 0)
+        self.rebuild_heaps()
 
     def key_value_exist(self, key: str) -> bool:
         """ Whether the key value exists """
-        for _ in self.keys.values():
-            if _.key == key:
-                return True
-        return False
+        return key in self.value_index
 
     def key_name_exist(self, name: str) -> bool:
         """ Whether the key name exists """
@@ -124,20 +414,38 @@ class KeyGroup:
 
     def get_key_name(self, key: str) -> Optional[str]:
         """ Get the name of the key with the given value """
-
-        for _ in self.keys.values():
-            if _.key == key:
-                return _.name
-        return None
-
-    def add_key(self, name: str, key: str) -> None:
-        assert (not self.key_name_exist(name)), "Key name already exists"
-        assert (not self.key_value_exist(key)), "Key value already exists"
-
-        self.keys[name] = Key(name, key)
-        self.update_key_status()
+        return self.value_index.get(key)
+
+    def add_key(self,
+                name: str,
+                key: str,
+                rpm: Optional[int] = None,
+                tpm: Optional[int] = None) -> None:
+        with self.lock:
+            assert (not self.key_name_exist(name)), "Key name already exists"
+            assert (not self.key_value_exist(key)), "Key value already exists"
+
+            self.keys[name] = Key(name, key)
+            self.limits[name] = KeyLimit(rpm, tpm)
+
+            bisect.insort(self.key_index, name)
+            self.cur_key_index = None
+            self.value_index[key] = name
+            self.use_cnt[name] = 0
+            self.last_use_time[name] = 0
+            heapq.heappush(self.use_heap, (0, name))
+            heapq.heappush(self.rest_heap, (0, name))
 
     def remove_key(self, name: str) -> None:
-        assert (name in self.keys), "Key name does not exist"
-        self.keys.pop(name)
-        self.update_key_status()
+        with self.lock:
+            assert (name in self.keys), "Key name does not exist"
+            key = self.keys.pop(name)
+            self.limits.pop(name)
+
+            # the heap entries of the key become stale and are dropped lazily
+            if self.suspended.pop(name, None) is None:
+                del self.key_index[bisect.bisect_left(self.key_index, name)]
+            self.cur_key_index = None
+            self.value_index.pop(key.key)
+            self.use_cnt.pop(name)
+            self.last_use_time.pop(name)
@@ -0,0 +1,354 @@
+"""
+Account the tokens and cost of requests, and stop them at a budget
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Any, Tuple, List, Union
+
+from chatmanager.util import logger
+from .retry import ChatError
+from .session import ChatResponse
+
+
+class Usage:
+    """ The running totals of a key, a session, a model or all requests
+
+    Attributes:
+        requests: The number of requests that got a response
+        prompt_tokens: The prompt tokens used
+        completion_tokens: The completion tokens used
+        cost: The cost of the tokens used
+        reserved_tokens: The estimated tokens of the requests in flight
+        reserved_cost: The estimated cost of the requests in flight
+    """
+
+    __slots__ = ('requests', 'prompt_tokens', 'completion_tokens', 'cost',
+                 'reserved_tokens', 'reserved_cost')
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.cost: float = 0.0
+        self.reserved_tokens: int = 0
+        self.reserved_cost: float = 0.0
+
+    def spent(self, unit: str) -> float:
+        """ The tokens or cost used and reserved """
+
+        if unit == 'cost':
+            return self.cost + self.reserved_cost
+        return (self.prompt_tokens + self.completion_tokens +
+                self.reserved_tokens)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cost': self.cost,
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> 'Usage':
+        usage = cls()
+        usage.requests = state['requests']
+        usage.prompt_tokens = state['prompt_tokens']
+        usage.completion_tokens = state['completion_tokens']
+        usage.cost = state['cost']
+        return usage
+
+
+class Budget:
+    """ A limit on the tokens or cost of a scope
+
+    Attributes:
+        hard: Requests that would exceed it are rejected, None if unbounded
+        soft: Requests beyond it are throttled, None if unbounded
+        unit: 'tokens' or 'cost'
+    """
+
+    def __init__(self,
+                 hard: Optional[float] = None,
+                 soft: Optional[float] = None,
+                 unit: str = 'tokens') -> None:
+        assert (unit in ('tokens', 'cost')), "unit must be tokens or cost"
+        self.hard: Optional[float] = hard
+        self.soft: Optional[float] = soft
+        self.unit: str = unit
+
+
+class Reservation:
+    """ The estimate held for a request until it finishes
+
+    Attributes:
+        session: The session of the request
+        model: The requested model
+        tokens: The estimated tokens
+        cost: The estimated cost
+        delay: Seconds to wait before sending, set by a soft budget
+        settled: Whether it has been settled
+    """
+
+    __slots__ = ('session', 'model', 'tokens', 'cost', 'delay', 'settled')
+
+    def __init__(self, session: str, model: str, tokens: int, cost: float,
+                 delay: float) -> None:
+        self.session: str = session
+        self.model: str = model
+        self.tokens: int = tokens
+        self.cost: float = cost
+        self.delay: float = delay
+        self.settled: bool = False
+
+
+class Ledger:
+    """ Accumulate usage per key, session and model, and enforce budgets
+
+    Before a request goes out, its tokens are estimated from the prompt and
+    the expected completion, and reserved against every budget it falls
+    under (all requests, its session and its model). A request that would
+    exceed a hard budget is rejected with a ChatError of kind 'budget', one
+    beyond a soft budget is delayed by throttle seconds. The reservation is
+    replaced by the actual usage once the request finishes, so concurrent
+    requests cannot overshoot a budget together.
+
+    With a path, the usage is loaded from it and saved to it at most every
+    snapshot_interval seconds, so a restarted job keeps counting.
+
+    Attributes:
+        prices: Model -> (cost of 1K prompt tokens, cost of 1K completion
+            tokens). A model missing is priced as its longest prefix in
+            prices, 0 if none.
+        expected_completion: The completion tokens expected of a request
+            without max_tokens
+        throttle: Seconds a request waits when a soft budget is exceeded
+        path: The snapshot file, None to keep the usage in memory only
+        snapshot_interval: The minimum seconds between two snapshots
+        total: The usage of all requests
+        keys: The usage of each key name
+        sessions: The usage of each session name
+        models: The usage of each requested model
+        budgets: (scope, name) -> Budget, scope is total, session or model
+    """
+
+    def __init__(self,
+                 prices: Optional[Dict[str, Tuple[float, float]]] = None,
+                 expected_completion: int = 256,
+                 throttle: float = 1.0,
+                 path: Optional[str] = None,
+                 snapshot_interval: float = 5.0) -> None:
+        self.prices: Dict[str, Tuple[float, float]] = prices or dict()
+        self.expected_completion: int = expected_completion
+        self.throttle: float = throttle
+        self.path: Optional[str] = path
+        self.snapshot_interval: float = snapshot_interval
+        self.total: Usage = Usage()
+        self.keys: Dict[str, Usage] = dict()
+        self.sessions: Dict[str, Usage] = dict()
+        self.models: Dict[str, Usage] = dict()
+        self.budgets: Dict[Tuple[str, str], Budget] = dict()
+        self.saved_at: float = time.monotonic()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def set_budget(self,
+                   hard: Optional[float] = None,
+                   soft: Optional[float] = None,
+                   unit: str = 'tokens',
+                   session: Optional[str] = None,
+                   model: Optional[str] = None) -> None:
+        """Limit the usage of all requests, a session or a model
+
+        Args:
+            hard: Reject the requests that would exceed it
+            soft: Throttle the requests beyond it
+            unit: 'tokens' or 'cost'
+            session: Limit this session only
+            model: Limit this model only
+        """
+
+        assert (session is None or model is None), \
+            "a budget limits a session or a model, not both"
+        if session is not None:
+            scope = ('session', session)
+        elif model is not None:
+            scope = ('model', model)
+        else:
+            scope = ('total', '')
+        with self.lock:
+            self.budgets[scope] = Budget(hard, soft, unit)
+
+    def price(self, model: str) -> Tuple[float, float]:
+        if (price := self.prices.get(model)) is not None:
+            return price
+        matches = [_ for _ in self.prices if model.startswith(_)]
+        if not matches:
+            return (0.0, 0.0)
+        return self.prices[max(matches, key=len)]
+
+    def cost(self, model: str, prompt_tokens: int,
+             completion_tokens: int) -> float:
+        prompt, completion = self.price(model)
+        return (prompt_tokens * prompt + completion_tokens * completion) / 1000
+
+    def estimate(self,
+                 prompt_tokens: int,
+                 max_tokens: Optional[int] = None,
+                 n: Optional[int] = None) -> Tuple[int, int]:
+        """ The (prompt, completion) tokens expected of a request """
+
+        completion = self.expected_completion if max_tokens is None else max_tokens
+        return prompt_tokens, completion * (n or 1)
+
+    def reserve(self,
+                session: str,
+                model: str,
+                prompt_tokens: int,
+                max_tokens: Optional[int] = None,
+                n: Optional[int] = None) -> Union[Reservation, ChatError]:
+        """Hold the estimate of a request against the budgets
+
+        Args:
+            session: The name of the session of the request
+            model: The requested model
+            prompt_tokens: The tokens of the prompt, see token_usage
+            max_tokens: The max_tokens of the request, if any
+            n: The number of choices of the request, if any
+
+        Returns:
+            A Reservation to settle once the request finishes, or a
+            ChatError if a hard budget would be exceeded
+        """
+
+        prompt, completion = self.estimate(prompt_tokens, max_tokens, n)
+        tokens = prompt + completion
+        cost = self.cost(model, prompt, completion)
+        delay = 0.0
+        with self.lock:
+            scopes = self.scopes(session, model)
+            for scope, usage in scopes:
+                if (budget := self.budgets.get(scope)) is None:
+                    continue
+                spent = usage.spent(
+                    budget.unit) + (cost if budget.unit == 'cost' else tokens)
+                if budget.hard is not None and spent > budget.hard:
+                    return ChatError(
+                        'budget', f'{" ".join(_ for _ in scope if _)} budget '
+                        f'of {budget.hard} {budget.unit} exhausted')
+                if budget.soft is not None and spent > budget.soft:
+                    delay = self.throttle
+
+            for _, usage in scopes:
+                usage.reserved_tokens += tokens
+                usage.reserved_cost += cost
+
+        if delay:
+            logger.warning("session %s over a soft budget, throttled", session)
+        return Reservation(session, model, tokens, cost, delay)
+
+    def settle(self, reservation: Reservation, key_name: str,
+               response: Optional[ChatResponse]) -> None:
+        """Replace the estimate of a finished request by its usage
+
+        Settling a reservation again does nothing.
+
+        Args:
+            reservation: Returned by reserve for the request
+            key_name: The name of the key that sent the request
+            response: The response, None if the request failed and used
+                nothing
+        """
+
+        prompt = completion = 0
+        if response is not None:
+            prompt = response.prompt_tokens or 0
+            completion = response.completion_tokens or 0
+        cost = self.cost(reservation.model, prompt, completion)
+
+        with self.lock:
+            if reservation.settled:
+                return
+            reservation.settled = True
+            for _, usage in self.scopes(reservation.session, reservation.model):
+                usage.reserved_tokens -= reservation.tokens
+                usage.reserved_cost -= reservation.cost
+            if response is not None:
+                scopes = self.scopes(reservation.session, reservation.model)
+                if key_name:
+                    scopes.append(
+                        (('key', key_name), self.usage(self.keys, key_name)))
+                for _, usage in scopes:
+                    usage.requests += 1
+                    usage.prompt_tokens += prompt
+                    usage.completion_tokens += completion
+                    usage.cost += cost
+
+        if (self.path is not None and
+                time.monotonic() - self.saved_at >= self.snapshot_interval):
+            self.save()
+
+    def scopes(self, session: str,
+               model: str) -> List[Tuple[Tuple[str, str], Usage]]:
+        """ The usages a request counts in, the caller holds lock """
+
+        return [
+            (('total', ''), self.total),
+            (('session', session), self.usage(self.sessions, session)),
+            (('model', model), self.usage(self.models, model)),
+        ]
+
+    @staticmethod
+    def usage(usages: Dict[str, Usage], name: str) -> Usage:
+        if (usage := usages.get(name)) is None:
+            usage = usages[name] = Usage()
+        return usage
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ The usage so far, requests in flight excluded """
+
+        with self.lock:
+            return {
+                'total': self.total.as_dict(),
+                'keys': {
+                    k: v.as_dict() for k, v in self.keys.items()
+                },
+                'sessions': {
+                    k: v.as_dict() for k, v in self.sessions.items()
+                },
+                'models': {
+                    k: v.as_dict() for k, v in self.models.items()
+                },
+            }
+
+    def save(self, path: Optional[str] = None) -> None:
+        """ Replace the snapshot file atomically """
+
+        if (path := path or self.path) is None:
+            return
+        with self.save_lock:
+            self.saved_at = time.monotonic()
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+
+    def load(self, path: str) -> None:
+        """ Restore the usage of a snapshot """
+
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        with self.lock:
+            self.total = Usage.from_dict(state['total'])
+            for usages, name in ((self.keys, 'keys'),
+                                 (self.sessions, 'sessions'), (self.models,
+                                                               'models')):
+                usages.clear()
+                usages.update({
+                    k: Usage.from_dict(v) for k, v in state[name].items()
+                })
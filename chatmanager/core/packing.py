@@ -0,0 +1,202 @@
+"""
+Pack many small prompts into one request and split the answer back
+"""
+
+import json
+from typing import Dict, Optional, List, Any, Sequence
+
+from chatmanager.config import ChatSetup, ChatConfig
+from chatmanager.util import (num_tokens_from_messages,
+                              num_tokens_from_messages_batch, logger)
+from .session import ChatMessage, ChatResponse
+
+
+def apportion(total: int, weights: Sequence[int]) -> List[int]:
+    """ Split total in proportion to weights, the shares sum up to total """
+
+    if not weights:
+        return []
+    whole = sum(weights)
+    if whole <= 0:
+        shares = [total // len(weights) for _ in weights]
+    else:
+        shares = [total * _ // whole for _ in weights]
+    shares[-1] += total - sum(shares)
+    return shares
+
+
+class PromptPacker:
+    """ Combine independent prompts into a JSON array sent as one request
+
+    The packed request asks for a JSON array of answers, one per prompt in
+    the same order. A prompt made of a single user message is packed as its
+    content, any other as its list of messages. Prompts are packed greedily
+    in order until the next one would exceed max_tokens or max_prompts; a
+    prompt over the budget on its own is sent by itself.
+
+    The usage of a packed request is split over its prompts, the prompt
+    tokens by their token counts and the completion tokens by the lengths
+    of the answers.
+
+    Attributes:
+        max_tokens: The token budget of the prompt of a packed request
+        max_prompts: The maximum number of prompts in a packed request
+        instruction: The system message of a packed request, formatted with
+            the number of prompts as n
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 2048,
+        max_prompts: int = 32,
+        instruction: str = (
+            "You are given a JSON array of {n} independent prompts. Answer "
+            "each one on its own, as if it were the only prompt. Reply with "
+            "only a JSON array of {n} strings, the i-th string answering the "
+            "i-th prompt.")
+    ) -> None:
+        assert (max_tokens > 0), "max_tokens must be positive"
+        assert (max_prompts > 0), "max_prompts must be positive"
+        self.max_tokens: int = max_tokens
+        self.max_prompts: int = max_prompts
+        self.instruction: str = instruction
+
+    def pack(self,
+             msgs: Sequence[ChatMessage],
+             model: Optional[str] = None) -> List[List[int]]:
+        """Group prompts into requests
+
+        Args:
+            msgs: The prompts
+            model: The model counting the tokens, ChatSetup.model by default
+
+        Returns:
+            The indices of the prompts of each request, in order
+        """
+
+        model = model or ChatSetup.model
+        items = [[{'content': self.item(_)}] for _ in msgs]
+        costs = num_tokens_from_messages_batch(items, model)
+        overhead = num_tokens_from_messages([{
+            'role': 'system',
+            'content': self.instruction.format(n=self.max_prompts)
+        }], model)
+
+        groups: List[List[int]] = []
+        group: List[int] = []
+        used = overhead
+        for index, cost in enumerate(costs):
+            if group and (used + cost > self.max_tokens or
+                          len(group) >= self.max_prompts):
+                groups.append(group)
+                group, used = [], overhead
+            group.append(index)
+            used += cost
+        if group:
+            groups.append(group)
+        return groups
+
+    def item(self, msg: ChatMessage) -> str:
+        """ The JSON of a prompt in the array """
+
+        messages = msg.drain()
+        if len(messages) == 1 and messages[0].get('role') == 'user':
+            return json.dumps(messages[0]['content'], ensure_ascii=False)
+        return json.dumps(messages, ensure_ascii=False)
+
+    def combine(self, msgs: Sequence[ChatMessage]) -> ChatMessage:
+        """ The message of a packed request """
+
+        packed = ChatMessage()
+        packed.push_system(self.instruction.format(n=len(msgs)))
+        packed.push_user('[' + ', '.join(self.item(_) for _ in msgs) + ']')
+        return packed
+
+    @staticmethod
+    def packed_config(config: ChatConfig, n: int) -> ChatConfig:
+        """The config of a request packing n prompts
+
+        The config was meant for a single prompt. One choice holds all the
+        answers, so max_tokens is scaled by n and n is 1; response_format is
+        dropped since the instruction asks for a JSON array.
+        """
+
+        return config.replace(max_tokens=None if config.max_tokens is None else
+                              config.max_tokens * n,
+                              n=None if config.n is None else 1,
+                              response_format=None)
+
+    def answers(self, response: ChatResponse, n: int) -> Optional[List[str]]:
+        """ The answers in a packed response, None if it cannot be parsed """
+
+        content = (response.get_msg() or '').strip()
+        if content.startswith('```'):
+            # drop a markdown code fence around the array
+            content = content.split('\n', 1)[-1].rsplit('```', 1)[0]
+        try:
+            answers = json.loads(content)
+        except ValueError:
+            return None
+        if not isinstance(answers, list) or len(answers) != n:
+            return None
+        return [
+            _ if isinstance(_, str) else json.dumps(_, ensure_ascii=False)
+            for _ in answers
+        ]
+
+    def split(self,
+              response: ChatResponse,
+              msgs: Sequence[ChatMessage],
+              model: Optional[str] = None) -> Optional[List[ChatResponse]]:
+        """Split a packed response into a response per prompt
+
+        Args:
+            response: The response of the packed request
+            msgs: The prompts, in the order they were packed
+            model: The model counting the tokens, ChatSetup.model by default
+
+        Returns:
+            The responses in the order of msgs, None if the packed response
+            does not hold exactly one answer per prompt
+        """
+
+        if response.finish_reasons[0] not in (None, 'stop'):
+            return None
+        if (answers := self.answers(response, len(msgs))) is None:
+            logger.warning("cannot split a packed response of %d prompts",
+                           len(msgs))
+            return None
+
+        prompt_tokens = apportion(
+            response.prompt_tokens,
+            num_tokens_from_messages_batch([_.drain() for _ in msgs], model or
+                                           ChatSetup.model))
+        completion_tokens = apportion(response.completion_tokens,
+                                      [len(_) for _ in answers])
+        return [
+            ChatResponse(
+                self.payload(response, answer, prompt_tokens[i],
+                             completion_tokens[i]))
+            for i, answer in enumerate(answers)
+        ]
+
+    def payload(self, response: ChatResponse, answer: str, prompt_tokens: int,
+                completion_tokens: int) -> Dict[str, Any]:
+        return {
+            'id': response.id,
+            'created': response.created,
+            'model': response.model,
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': answer
+                },
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
@@ -0,0 +1,219 @@
+"""
+Retry, backoff and circuit breaking of failed requests
+"""
+
+import random
+import threading
+import time
+from typing import Dict, Optional, Any
+
+# kinds of failures that may succeed when sent again
+RETRYABLE = {'timeout', 'connection', 'rate_limit', 'server', 'auth'}
+# kinds of failures caused by the key rather than the request
+KEY_SPECIFIC = {'rate_limit', 'auth'}
+# kinds of failures counted by the circuit breaker
+UNHEALTHY = {'timeout', 'connection', 'server'}
+
+
+def classify(e: Exception) -> str:
+    """Classify an exception raised by openai
+
+    Returns:
+        One of timeout, connection, rate_limit, auth, server,
+        invalid_request and unknown
+    """
+
+    import openai
+
+    status = getattr(e, 'http_status', None)
+    if isinstance(e, openai.error.Timeout) or status == 408:
+        return 'timeout'
+    if isinstance(e, openai.error.APIConnectionError):
+        return 'connection'
+    if isinstance(e, openai.error.RateLimitError) or status == 429:
+        return 'rate_limit'
+    if isinstance(e, (openai.error.AuthenticationError,
+                      openai.error.PermissionError)) or status in (401, 403):
+        return 'auth'
+    if isinstance(e, (openai.error.ServiceUnavailableError,
+                      openai.error.TryAgain)) or (status or 0) >= 500:
+        return 'server'
+    if status is not None and 400 <= status < 500:
+        return 'invalid_request'
+    if isinstance(e, openai.error.APIError):
+        # an APIError without status is a malformed response
+        return 'server'
+    return 'unknown'
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """ The seconds to wait suggested by the Retry-After headers, if any """
+
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        if (ms := headers.get('retry-after-ms')) is not None:
+            return float(ms) / 1000
+        if (seconds := headers.get('retry-after')) is not None:
+            return float(seconds)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class ChatError:
+    """A failed request
+
+    Returned in place of a ChatResponse. It is falsy, so `if response:`
+    keeps working as it did with None.
+
+    Attributes:
+        kind: The class of the failure, see classify
+        message: The error message
+        error: The last exception raised, None if no request was sent
+        http_status: The HTTP status of the last response, if any
+        attempts: The number of requests sent
+        key_name: The name of the key used by the last request
+    """
+
+    def __init__(self,
+                 kind: str,
+                 message: str,
+                 error: Optional[Exception] = None,
+                 attempts: int = 0,
+                 key_name: Optional[str] = None) -> None:
+        self.kind: str = kind
+        self.message: str = message
+        self.error: Optional[Exception] = error
+        self.http_status: Optional[int] = getattr(error, 'http_status', None)
+        self.attempts: int = attempts
+        self.key_name: Optional[str] = key_name
+
+    @classmethod
+    def from_exception(cls,
+                       e: Exception,
+                       attempts: int = 0,
+                       key_name: Optional[str] = None) -> 'ChatError':
+        return cls(classify(e), str(e), e, attempts, key_name)
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __repr__(self) -> str:
+        return (f'ChatError(kind={self.kind!r}, http_status='
+                f'{self.http_status}, attempts={self.attempts}, '
+                f'message={self.message!r})')
+
+
+class RetryPolicy:
+    """ When and how long to wait before sending a failed request again
+
+    Attributes:
+        max_attempts: The maximum number of requests per message
+        base_delay: The backoff before the second attempt, in seconds
+        max_delay: The upper bound of the backoff, in seconds
+        timeout: The timeout of each request, in seconds
+        deadline: The total time budget of a message, None if unbounded
+    """
+
+    def __init__(self,
+                 max_attempts: int = 4,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30.0,
+                 timeout: float = 600.0,
+                 deadline: Optional[float] = None) -> None:
+        assert (max_attempts > 0), "max_attempts must be positive"
+        self.max_attempts: int = max_attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.timeout: float = timeout
+        self.deadline: Optional[float] = deadline
+
+    def deadline_at(self) -> Optional[float]:
+        """ The monotonic time a message sent now has to finish by """
+
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def request_timeout(self, deadline_at: Optional[float]) -> float:
+        """ The timeout of the next request, bounded by the deadline """
+
+        if deadline_at is None:
+            return self.timeout
+        return max(min(self.timeout, deadline_at - time.monotonic()), 0.0)
+
+    def delay(self, attempt: int, e: Exception) -> Optional[float]:
+        """ Seconds to wait before the next attempt, None to give up
+
+        Exponential backoff with full jitter. Retry-After is honored, and a
+        key-specific failure is retried at once since another key is used.
+
+        Args:
+            attempt: The number of attempts made so far
+            e: The exception raised by the last attempt
+        """
+
+        kind = classify(e)
+        if attempt >= self.max_attempts or kind not in RETRYABLE:
+            return None
+
+        if (suggested := retry_after(e)) is not None:
+            return min(suggested, self.max_delay)
+        if kind == 'auth':
+            return 0.0
+
+        backoff = min(self.max_delay, self.base_delay * 2**(attempt - 1))
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    """ Take a failing target (key or api_base) out of rotation
+
+    A target opens after threshold consecutive failures. Once open, it is
+    rejected for reset_timeout seconds, then one trial request is let
+    through (half-open): a success closes it, a failure opens it again.
+
+    Attributes:
+        threshold: The number of consecutive failures to open a target
+        reset_timeout: Seconds an open target rejects requests
+        failures: The consecutive failures of each target
+        opened_at: The monotonic time each open target was (re)opened
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.threshold: int = threshold
+        self.reset_timeout: float = reset_timeout
+        self.failures: Dict[Any, int] = dict()
+        self.opened_at: Dict[Any, float] = dict()
+        self.lock = threading.Lock()
+
+    def allow(self, target: Any) -> bool:
+        """ Whether a request may be sent to target """
+
+        with self.lock:
+            if target not in self.opened_at:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at[target] < self.reset_timeout:
+                return False
+            # half-open, hold the others back until the trial finishes
+            self.opened_at[target] = now
+            return True
+
+    def is_open(self, target: Any) -> bool:
+        return target in self.opened_at
+
+    def record_success(self, target: Any) -> None:
+        with self.lock:
+            self.failures.pop(target, None)
+            self.opened_at.pop(target, None)
+
+    def record_failure(self, target: Any) -> bool:
+        """ Count a failure, return True if the target is (re)opened """
+
+        with self.lock:
+            self.failures[target] = self.failures.get(target, 0) + 1
+            if self.failures[target] < self.threshold:
+                return False
+            self.opened_at[target] = time.monotonic()
+            return True
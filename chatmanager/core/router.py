@@ -0,0 +1,316 @@
+"""
+Route requests across several OpenAI-compatible endpoints
+"""
+
+import random
+import threading
+import time
+from typing import Dict, Optional, List, Callable
+
+from chatmanager.util import logger
+from .key import KeyGroup
+from .retry import UNHEALTHY
+
+
+class Endpoint:
+    """ An OpenAI-compatible backend with its own keys
+
+    Attributes:
+        name: The name of the endpoint
+        api_base: The api base url
+        keys: The keys of the endpoint
+        models: Requested model -> the model name served by the endpoint
+        weight: Relative capacity, a higher weight draws more traffic
+        latency: The EWMA of the latency of successful requests, None
+            before the first one
+        error_rate: The EWMA of the share of failed requests
+        failures: The number of consecutive failures
+        inflight: The number of requests in flight
+        ejected_until: The endpoint is out of rotation until this time
+            (monotonic), 0 if it is in rotation
+        probation: Whether the endpoint was just re-admitted, a failure
+            ejects it again at once
+    """
+
+    def __init__(self,
+                 name: str,
+                 api_base: str,
+                 models: Optional[Dict[str, str]] = None,
+                 weight: float = 1.0) -> None:
+        assert (weight > 0), "weight must be positive"
+        self.name: str = name
+        self.api_base: str = api_base
+        self.keys: KeyGroup = KeyGroup()
+        self.models: Dict[str, str] = models or dict()
+        self.weight: float = weight
+        self.latency: Optional[float] = None
+        self.error_rate: float = 0.0
+        self.failures: int = 0
+        self.inflight: int = 0
+        self.ejected_until: float = 0.0
+        self.probation: bool = False
+
+    def model(self, model: str) -> str:
+        """ The model name to send for a requested model """
+
+        return self.models.get(model, model)
+
+    def score(self) -> float:
+        """ The expected cost of one more request, lower is better
+
+        Endpoints without a measured latency score 0 so they are tried.
+        """
+
+        if self.latency is None:
+            return 0.0
+        return self.latency * (self.inflight +
+                               1) * (1 + 10 * self.error_rate) / self.weight
+
+    def __repr__(self) -> str:
+        return (f'Endpoint(name={self.name!r}, latency={self.latency}, '
+                f'error_rate={self.error_rate:.3f}, '
+                f'ejected={self.ejected_until > 0})')
+
+
+class Router:
+    """ Pick an endpoint for each request
+
+    Two endpoints in rotation are drawn at random and the one with the
+    lower score (latency EWMA scaled by load and error rate) is used, so
+    load spreads without every caller herding to the fastest endpoint.
+
+    An endpoint is ejected after threshold consecutive failures or when
+    its error rate exceeds max_error_rate. It is re-admitted on probation
+    after eject_time seconds, or earlier when a health check succeeds.
+    Failures caused by a key (rate limits, auth) do not count against the
+    endpoint.
+
+    Attributes:
+        endpoints: The endpoints by name
+        owners: The endpoint of each key name
+        alpha: The weight of the latest sample in the EWMAs
+        threshold: The consecutive failures to eject an endpoint
+        max_error_rate: The error rate to eject an endpoint
+        eject_time: Seconds an ejected endpoint stays out of rotation
+    """
+
+    def __init__(self,
+                 alpha: float = 0.3,
+                 threshold: int = 5,
+                 max_error_rate: float = 0.5,
+                 eject_time: float = 30.0) -> None:
+        self.endpoints: Dict[str, Endpoint] = dict()
+        self.owners: Dict[str, Endpoint] = dict()
+        self.alpha: float = alpha
+        self.threshold: int = threshold
+        self.max_error_rate: float = max_error_rate
+        self.eject_time: float = eject_time
+        self.lock = threading.Lock()
+        self.checker: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def add_endpoint(self,
+                     name: str,
+                     api_base: str,
+                     models: Optional[Dict[str, str]] = None,
+                     weight: float = 1.0) -> Endpoint:
+        """Add an endpoint, its keys are added with add_key
+
+        Args:
+            name: The name of the endpoint
+            api_base: The api base url
+            models: Requested model -> the model name served by the endpoint
+            weight: Relative capacity, a higher weight draws more traffic
+        """
+
+        with self.lock:
+            assert (name not in self.endpoints), "Endpoint name already exists"
+            endpoint = self.endpoints[name] = Endpoint(name, api_base, models,
+                                                       weight)
+        return endpoint
+
+    def remove_endpoint(self, name: str) -> None:
+        with self.lock:
+            endpoint = self.endpoints.pop(name)
+            for key_name in list(endpoint.keys.keys):
+                self.owners.pop(key_name, None)
+
+    def add_key(self,
+                endpoint: str,
+                name: str,
+                key: str,
+                rpm: Optional[int] = None,
+                tpm: Optional[int] = None) -> None:
+        """ Add a key to an endpoint, key names are unique across endpoints
+        """
+
+        with self.lock:
+            assert (name not in self.owners), "Key name already exists"
+            owner = self.owners[name] = self.endpoints[endpoint]
+        owner.keys.add_key(name, key, rpm, tpm)
+
+    def has_key(self) -> bool:
+        return any(_.keys.has_key() for _ in self.endpoints.values())
+
+    def needs_tokens(self) -> bool:
+        return any(_.keys.needs_tokens() for _ in self.endpoints.values())
+
+    def keys_of(self, name: str) -> Optional[KeyGroup]:
+        """ The key group holding a key name, None if no endpoint has it """
+
+        if (endpoint := self.owners.get(name)) is None:
+            return None
+        return endpoint.keys
+
+    def pick(self) -> Endpoint:
+        """ Choose the endpoint of the next request and count it in flight
+
+        If every endpoint is ejected, the one due back first is used.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            candidates: List[Endpoint] = []
+            for endpoint in self.endpoints.values():
+                if not endpoint.keys.has_key():
+                    continue
+                if endpoint.ejected_until and endpoint.ejected_until <= now:
+                    self.readmit(endpoint)
+                if not endpoint.ejected_until:
+                    candidates.append(endpoint)
+
+            if not candidates:
+                ejected = [
+                    _ for _ in self.endpoints.values() if _.keys.has_key()
+                ]
+                assert (ejected), "no endpoint has a key"
+                best = min(ejected, key=lambda _: _.ejected_until)
+            elif len(candidates) <= 2:
+                best = min(candidates, key=lambda _: _.score())
+            else:
+                a, b = random.sample(candidates, 2)
+                best = a if a.score() <= b.score() else b
+
+            best.inflight += 1
+            return best
+
+    def report(self, endpoint: Endpoint, latency: float,
+               kind: Optional[str]) -> None:
+        """Account for a finished request
+
+        Args:
+            endpoint: The endpoint returned by pick
+            latency: The seconds the request took
+            kind: The kind of the failure (see classify), None on success
+        """
+
+        with self.lock:
+            endpoint.inflight -= 1
+            failed = kind in UNHEALTHY
+            if kind is not None and not failed:
+                # the key failed, the endpoint answered
+                return
+
+            endpoint.error_rate += self.alpha * (failed - endpoint.error_rate)
+            if not failed:
+                endpoint.failures = 0
+                endpoint.probation = False
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += self.alpha * (latency -
+                                                      endpoint.latency)
+                return
+
+            endpoint.failures += 1
+            if (endpoint.probation or endpoint.failures >= self.threshold or
+                    endpoint.error_rate > self.max_error_rate):
+                self.eject(endpoint)
+
+    def release(self, endpoint: Endpoint) -> None:
+        """ Stop counting a request that never finished (e.g. cancelled)
+
+        Nothing is learned about the endpoint from it.
+        """
+
+        with self.lock:
+            endpoint.inflight -= 1
+
+    def eject(self, endpoint: Endpoint) -> None:
+        """ Take an endpoint out of rotation, the caller holds lock """
+
+        if not endpoint.ejected_until:
+            logger.warning("endpoint %s ejected", endpoint.name)
+        endpoint.ejected_until = time.monotonic() + self.eject_time
+        endpoint.probation = False
+
+    def readmit(self, endpoint: Endpoint) -> None:
+        """ Put an endpoint back on probation, the caller holds lock """
+
+        endpoint.ejected_until = 0.0
+        endpoint.failures = 0
+        endpoint.error_rate = min(endpoint.error_rate, self.max_error_rate / 2)
+        endpoint.probation = True
+
+    def check(self, probe: Optional[Callable[[Endpoint], bool]] = None) -> None:
+        """Health check every endpoint once
+
+        A failing endpoint is ejected, an ejected endpoint that passes is
+        re-admitted.
+
+        Args:
+            probe: Return whether an endpoint is healthy, GET /models with
+                one of its keys by default
+        """
+
+        for endpoint in list(self.endpoints.values()):
+            healthy = (probe or self.probe)(endpoint)
+            with self.lock:
+                if healthy and endpoint.ejected_until:
+                    self.readmit(endpoint)
+                elif not healthy:
+                    self.eject(endpoint)
+
+    def probe(self, endpoint: Endpoint, timeout: float = 5.0) -> bool:
+        """ Whether GET {api_base}/models answers with a key of the endpoint
+        """
+
+        import requests
+
+        if not (names := list(endpoint.keys.keys)):
+            return False
+        key = endpoint.keys.keys[names[0]].key
+        try:
+            response = requests.get(endpoint.api_base.rstrip('/') + '/models',
+                                    headers={'Authorization': f'Bearer {key}'},
+                                    timeout=timeout)
+        except requests.RequestException:
+            return False
+        return response.status_code < 500
+
+    def start_health_check(
+            self,
+            interval: float = 30.0,
+            probe: Optional[Callable[[Endpoint], bool]] = None) -> None:
+        """ Health check every interval seconds in a daemon thread """
+
+        if self.checker is not None:
+            return
+        self.stop_event.clear()
+
+        def loop() -> None:
+            while not self.stop_event.wait(interval):
+                try:
+                    self.check(probe)
+                except Exception as e:
+                    logger.warning("health check failed: %s", e)
+
+        self.checker = threading.Thread(target=loop, daemon=True)
+        self.checker.start()
+
+    def stop_health_check(self) -> None:
+        if self.checker is None:
+            return
+        self.stop_event.set()
+        self.checker.join()
+        self.checker = None
@@ -0,0 +1,221 @@
+"""
+Admit requests by priority class and weighted fair share across tenants
+"""
+
+import asyncio
+import heapq
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import (Dict, Optional, List, Callable, Iterator, AsyncIterator,
+                    Tuple)
+
+
+class Waiter:
+    """ A request waiting for a slot """
+
+    __slots__ = ('grant', 'granted', 'cancelled')
+
+    def __init__(self, grant: Callable[[], None]) -> None:
+        self.grant: Callable[[], None] = grant
+        self.granted: bool = False
+        self.cancelled: bool = False
+
+
+class PriorityClass:
+    """ A class of requests sharing a priority and a concurrency cap
+
+    Within a class, tenants get slots in proportion to their weights
+    (weighted fair queuing on virtual finish tags).
+
+    Attributes:
+        name: The name of the class
+        priority: Classes with a higher priority are served first
+        concurrency: The maximum number of running requests, None if only
+            bounded by the scheduler capacity
+        running: The number of running requests
+        vtime: The finish tag of the last request admitted
+        last_tag: The finish tag of the last request queued by each tenant
+        queue: (finish tag, sequence, waiter) of the waiting requests
+    """
+
+    def __init__(self,
+                 name: str,
+                 priority: int = 0,
+                 concurrency: Optional[int] = None) -> None:
+        self.name: str = name
+        self.priority: int = priority
+        self.concurrency: Optional[int] = concurrency
+        self.running: int = 0
+        self.vtime: float = 0.0
+        self.last_tag: Dict[str, float] = dict()
+        self.queue: List[Tuple[float, int, Waiter]] = []
+
+    def full(self) -> bool:
+        return self.concurrency is not None and self.running >= self.concurrency
+
+
+class Scheduler:
+    """ Decide which waiting request runs next
+
+    A request takes a slot of its class before it is sent and gives it
+    back once it finishes. Free slots go to the waiting class with the
+    highest priority that is under its cap, and within it to the tenant
+    furthest below its fair share. A bulk class capped below capacity
+    leaves slots free for interactive traffic, and soaks up whatever is
+    left when there is none. All classes draw from the same KeyGroup.
+
+    Attributes:
+        capacity: The maximum number of running requests over all classes,
+            None if unbounded
+        classes: The priority classes by name
+        weights: The weight of each tenant, 1 if not set
+        running: The number of running requests
+    """
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        self.capacity: Optional[int] = capacity
+        self.classes: Dict[str, PriorityClass] = {
+            'default': PriorityClass('default')
+        }
+        self.weights: Dict[str, float] = dict()
+        self.running: int = 0
+        self.seq: int = 0
+        self.lock = threading.Lock()
+
+    def add_class(self,
+                  name: str,
+                  priority: int = 0,
+                  concurrency: Optional[int] = None) -> None:
+        """Add or replace a priority class
+
+        Args:
+            name: The name of the class, passed as priority to send
+            priority: Classes with a higher priority are served first
+            concurrency: The maximum number of running requests of the class
+        """
+
+        with self.lock:
+            cls = PriorityClass(name, priority, concurrency)
+            if (old := self.classes.get(name)) is not None:
+                cls.running, cls.queue = old.running, old.queue
+                cls.vtime, cls.last_tag = old.vtime, old.last_tag
+            self.classes[name] = cls
+            self.dispatch()
+
+    def set_weight(self, tenant: str, weight: float) -> None:
+        assert (weight > 0), "weight must be positive"
+        with self.lock:
+            self.weights[tenant] = weight
+
+    def enqueue(self, name: str, tenant: str, waiter: Waiter) -> None:
+        """ Queue a waiter and admit whoever can run, the caller holds lock """
+
+        assert (name in self.classes), f"unknown priority class {name}"
+        cls = self.classes[name]
+        start = max(cls.vtime, cls.last_tag.get(tenant, 0.0))
+        tag = start + 1.0 / self.weights.get(tenant, 1.0)
+        cls.last_tag[tenant] = tag
+        self.seq += 1
+        heapq.heappush(cls.queue, (tag, self.seq, waiter))
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """ Hand free slots to waiters, the caller holds lock """
+
+        while self.capacity is None or self.running < self.capacity:
+            best = None
+            for cls in self.classes.values():
+                while cls.queue and cls.queue[0][2].cancelled:
+                    heapq.heappop(cls.queue)
+                if cls.queue and not cls.full() and (
+                        best is None or cls.priority > best.priority):
+                    best = cls
+            if best is None:
+                break
+
+            tag, _, waiter = heapq.heappop(best.queue)
+            best.vtime = tag
+            best.running += 1
+            self.running += 1
+            waiter.granted = True
+            waiter.grant()
+
+        # with nothing queued every tag is behind vtime, forget them
+        for cls in self.classes.values():
+            if not cls.queue and cls.last_tag:
+                cls.last_tag.clear()
+
+    def acquire(self, name: str = 'default', tenant: str = '') -> None:
+        """ Block until a slot of the class is free """
+
+        event = threading.Event()
+        with self.lock:
+            self.enqueue(name, tenant, waiter := Waiter(event.set))
+            if waiter.granted:
+                return
+        event.wait()
+
+    async def aacquire(self, name: str = 'default', tenant: str = '') -> None:
+        """ Wait on the running event loop until a slot of the class is free
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake() -> None:
+            if not future.done():
+                future.set_result(None)
+
+        def grant() -> None:
+            loop.call_soon_threadsafe(wake)
+
+        with self.lock:
+            self.enqueue(name, tenant, waiter := Waiter(grant))
+            if waiter.granted:
+                return
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                waiter.cancelled = True
+                granted = waiter.granted
+            if granted:
+                self.release(name)
+            raise
+
+    def release(self, name: str = 'default') -> None:
+        """ Give back a slot and admit the next waiter """
+
+        with self.lock:
+            self.classes[name].running -= 1
+            self.running -= 1
+            self.dispatch()
+
+    @contextmanager
+    def slot(self, name: str = 'default', tenant: str = '') -> Iterator[None]:
+        self.acquire(name, tenant)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    @asynccontextmanager
+    async def aslot(self,
+                    name: str = 'default',
+                    tenant: str = '') -> AsyncIterator[None]:
+        await self.aacquire(name, tenant)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """ The running and waiting requests of each class """
+
+        with self.lock:
+            return {
+                name: {
+                    'running': cls.running,
+                    'waiting': sum(not _[2].cancelled for _ in cls.queue)
+                } for name, cls in self.classes.items()
+            }
@@ -0,0 +1,459 @@
+"""
+Cache the responses of similar requests by the embedding of the last user turn
+"""
+
+import hashlib
+import importlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Optional, Any, List, Tuple, Callable, Sequence
+
+from chatmanager.util import logger
+from .cache import request_key
+
+Embedder = Callable[[str], Sequence[float]]
+
+
+def load_numpy() -> Any:
+    """ numpy if it is installed, None otherwise """
+
+    try:
+        return importlib.import_module('numpy')
+    except ImportError:
+        return None
+
+
+def file_digest(path: str) -> str:
+    """ The sha256 of a file, read in chunks """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize(vector: Sequence[float]) -> List[float]:
+    """ The vector scaled to unit length, zeros stay zeros """
+
+    norm = math.sqrt(math.fsum(_ * _ for _ in vector))
+    if norm == 0:
+        return [0.0] * len(vector)
+    return [_ / norm for _ in vector]
+
+
+class HashingEmbedder:
+    """ A deterministic local embedder, no model or network needed
+
+    The words and word pairs of a text are hashed into dim signed buckets,
+    so texts sharing most of their words are close. It does not know
+    synonyms; plug in a real embedding model for paraphrases that share few
+    words.
+
+    Attributes:
+        dim: The dimension of the vectors
+    """
+
+    def __init__(self, dim: int = 512) -> None:
+        assert (dim > 0), "dim must be positive"
+        self.dim: int = dim
+
+    def __call__(self, text: str) -> List[float]:
+        words = re.findall(r'\w+', text.lower())
+        features = words + [' '.join(_) for _ in zip(words, words[1:])]
+        vector = [0.0] * self.dim
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode('utf-8'),
+                                     digest_size=8).digest()
+            value = int.from_bytes(digest, 'little')
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        return vector
+
+
+class VectorIndex:
+    """ Rows of unit vectors searched by inner product
+
+    Backed by a float32 numpy matrix when numpy is installed, by a list of
+    array('f') rows otherwise. A loaded index can be memory-mapped from its
+    file, the rows are then paged in as they are searched and changes stay
+    in memory until it is saved.
+
+    Attributes:
+        dim: The dimension of the vectors
+        size: The number of rows
+        np: The numpy module, None to use the array rows
+        matrix: The numpy matrix, its first size rows are in use
+        rows: The array rows without numpy
+    """
+
+    def __init__(self, dim: int, np: Any = None) -> None:
+        self.dim: int = dim
+        self.size: int = 0
+        self.np: Any = np
+        self.matrix: Any = None
+        self.rows: List[array] = []
+        if np is not None:
+            self.matrix = np.zeros((0, dim), dtype=np.float32)
+
+    def set(self, row: int, vector: Sequence[float]) -> None:
+        """ Replace a row, or append one if row is size """
+
+        assert (0 <= row <= self.size), "row out of range"
+        assert (len(vector) == self.dim), "vector of a wrong dimension"
+        if self.np is None:
+            if row == self.size:
+                self.rows.append(array('f', vector))
+            else:
+                self.rows[row] = array('f', vector)
+        else:
+            if row >= len(self.matrix):
+                # grow by doubling, a memory-mapped matrix is copied to memory
+                grown = self.np.zeros((max(16, 2 * len(self.matrix)), self.dim),
+                                      dtype=self.np.float32)
+                grown[:self.size] = self.matrix[:self.size]
+                self.matrix = grown
+            self.matrix[row] = vector
+        self.size = max(self.size, row + 1)
+
+    def search(self, vector: Sequence[float],
+               threshold: float) -> List[Tuple[float, int]]:
+        """ (score, row) of the rows scoring at least threshold, best first """
+
+        if self.size == 0:
+            return []
+        if self.np is None:
+            scores = [
+                math.fsum(map(float.__mul__, vector, _)) for _ in self.rows
+            ]
+            return sorted(
+                ((s, i) for i, s in enumerate(scores) if s >= threshold),
+                reverse=True)
+        found = self.matrix[:self.size] @ self.np.asarray(vector,
+                                                          dtype=self.np.float32)
+        return sorted(((float(found[i]), int(i))
+                       for i in self.np.flatnonzero(found >= threshold)),
+                      reverse=True)
+
+    def save(self, path: str, order: Sequence[int]) -> None:
+        """ Write the rows in order as little-endian float32 """
+
+        with open(path, 'wb') as f:
+            if self.np is not None:
+                rows = self.matrix[list(order)] if order else self.matrix[:0]
+                f.write(self.np.ascontiguousarray(rows, dtype='<f4').tobytes())
+                return
+            for i in order:
+                row = self.rows[i]
+                if sys.byteorder != 'little':
+                    row = array('f', row)
+                    row.byteswap()
+                row.tofile(f)
+
+    @classmethod
+    def load(cls,
+             path: str,
+             dim: int,
+             size: int,
+             np: Any = None,
+             mmap: bool = False) -> 'VectorIndex':
+        """ Read size rows written by save """
+
+        index = cls(dim, np)
+        if size == 0:
+            return index
+        if np is not None:
+            if mmap:
+                # copy-on-write, the file is only changed by save
+                index.matrix = np.memmap(path,
+                                         dtype='<f4',
+                                         mode='c',
+                                         shape=(size, dim))
+            else:
+                index.matrix = np.fromfile(path, dtype='<f4',
+                                           count=size * dim).reshape(size, dim)
+        else:
+            data = array('f')
+            with open(path, 'rb') as f:
+                data.fromfile(f, size * dim)
+            if sys.byteorder != 'little':
+                data.byteswap()
+            index.rows = [data[_ * dim:(_ + 1) * dim] for _ in range(size)]
+        index.size = size
+        return index
+
+
+class SemanticEntry:
+    """ A cached response and what it answered
+
+    Attributes:
+        scope: The key of the request without the last user turn
+        text: The last user turn
+        payload: The response payload
+        created: The time it was cached
+    """
+
+    __slots__ = ('scope', 'text', 'payload', 'created')
+
+    def __init__(self, scope: str, text: str, payload: Dict[str, Any],
+                 created: float) -> None:
+        self.scope: str = scope
+        self.text: str = text
+        self.payload: Dict[str, Any] = payload
+        self.created: float = created
+
+
+class SemanticCache:
+    """ Answer a request with the response of a similar one
+
+    A request is cached by the embedding of its last message, which must be
+    a user message with text content. Another request is answered from the
+    cache if everything else in it (model, parameters, earlier messages) is
+    identical and the cosine similarity of the last messages is at least
+    threshold. The exact ResponseCache of the ChatManager is tried first.
+
+    The least recently used entry is evicted beyond max_entries. With a
+    path, the entries are loaded from path.json and path.f32 when the cache
+    is created and written back by save and close.
+
+    Attributes:
+        embed: Maps a text to a vector, any dimension and length
+        threshold: The minimum cosine similarity of a hit, in (0, 1]
+        max_entries: The maximum number of cached responses
+        ttl: Seconds a response stays valid, None if forever
+        path: The prefix of the index files, None to keep it in memory
+        mmap: Whether a loaded index is memory-mapped, numpy only
+        verify: Whether load always checks the sha256 of the vectors, not
+            only their size and modification time
+        np: The numpy module, None if not installed or disabled
+        index: The VectorIndex of the entries, created by the first vector
+        entries: The entry of each row of index, None if the row is free
+        recency: The rows in use, least recently used first
+        free: The rows free for reuse
+        hits: The number of requests answered
+        misses: The number of requests looked up but not answered
+    """
+
+    # embeddings kept for the set following a missed get
+    EMBEDDING_CACHE = 1024
+
+    def __init__(self,
+                 embed: Optional[Embedder] = None,
+                 threshold: float = 0.9,
+                 max_entries: int = 1024,
+                 ttl: Optional[float] = None,
+                 path: Optional[str] = None,
+                 mmap: bool = False,
+                 use_numpy: bool = True,
+                 verify: bool = False) -> None:
+        assert (0 < threshold <= 1), "threshold must be in (0, 1]"
+        assert (max_entries > 0), "max_entries must be positive"
+        self.embed: Embedder = embed or HashingEmbedder()
+        self.threshold: float = threshold
+        self.max_entries: int = max_entries
+        self.ttl: Optional[float] = ttl
+        self.path: Optional[str] = path
+        self.mmap: bool = mmap
+        self.verify: bool = verify
+        self.np: Any = load_numpy() if use_numpy else None
+        self.index: Optional[VectorIndex] = None
+        self.entries: List[Optional[SemanticEntry]] = []
+        self.recency: 'OrderedDict[int, None]' = OrderedDict()
+        self.free: List[int] = []
+        self.embeddings: 'OrderedDict[str, List[float]]' = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path + '.json'):
+            self.load(path)
+
+    @staticmethod
+    def split(request_body: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """ (scope, text) of a request, None if it cannot be cached """
+
+        messages = request_body.get('messages') or []
+        if not messages:
+            return None
+        last = messages[-1]
+        if last.get('role') != 'user' or not isinstance(last.get('content'),
+                                                        str):
+            return None
+        body = dict(request_body)
+        body['messages'] = messages[:-1] + [{
+            k: v for k, v in last.items() if k != 'content'
+        }]
+        return request_key(body), last['content']
+
+    def vector(self, text: str) -> List[float]:
+        """ The unit embedding of a text, recent ones are reused """
+
+        with self.lock:
+            if (vector := self.embeddings.get(text)) is not None:
+                self.embeddings.move_to_end(text)
+                return vector
+        # embed may be slow or remote, do not hold the lock
+        vector = normalize(self.embed(text))
+        with self.lock:
+            self.embeddings[text] = vector
+            while len(self.embeddings) > self.EMBEDDING_CACHE:
+                self.embeddings.popitem(last=False)
+        return vector
+
+    def get(self, request_body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ The payload of the most similar cached request, if any """
+
+        if (split := self.split(request_body)) is None:
+            return None
+        scope, text = split
+        vector = self.vector(text)
+        now = time.time()
+        with self.lock:
+            if self.index is not None and len(vector) == self.index.dim:
+                for _, row in self.index.search(vector, self.threshold):
+                    entry = self.entries[row]
+                    if entry is None or entry.scope != scope:
+                        continue
+                    if self.ttl is not None and entry.created + self.ttl < now:
+                        self.release(row)
+                        continue
+                    self.recency.move_to_end(row)
+                    self.hits += 1
+                    return entry.payload
+            self.misses += 1
+            return None
+
+    def set(self, request_body: Dict[str, Any], payload: Dict[str,
+                                                              Any]) -> None:
+        if (split := self.split(request_body)) is None:
+            return
+        scope, text = split
+        vector = self.vector(text)
+        with self.lock:
+            if self.index is None:
+                self.index = VectorIndex(len(vector), self.np)
+            assert (len(vector) == self.index.dim), \
+                "the embedder changed its dimension"
+            if self.free:
+                row = self.free.pop()
+            elif len(self.recency) >= self.max_entries:
+                row, _ = self.recency.popitem(last=False)
+            else:
+                row = self.index.size
+                self.entries.append(None)
+            self.index.set(row, vector)
+            self.entries[row] = SemanticEntry(scope, text, payload, time.time())
+            self.recency[row] = None
+            self.recency.move_to_end(row)
+
+    def release(self, row: int) -> None:
+        """ Free a row, the caller holds lock """
+
+        assert (self.index is not None)
+        self.entries[row] = None
+        self.recency.pop(row, None)
+        # a zero vector never reaches a positive threshold
+        self.index.set(row, [0.0] * self.index.dim)
+        self.free.append(row)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """Write the entries, least recently used first
+
+        The rows are compacted, so the files hold no free rows. Each file is
+        replaced atomically, and path.json, replaced last, records the
+        size, modification time and sha256 of path.f32, so load detects a
+        crash between the two.
+        """
+
+        if (path := path or self.path) is None:
+            return
+        with self.lock:
+            order = [_ for _ in self.recency if self.entries[_] is not None]
+            state = {
+                'dim':
+                    0 if self.index is None else self.index.dim,
+                'entries': [[
+                    entry.scope, entry.text, entry.payload, entry.created
+                ] for entry in (self.entries[_] for _ in order) if entry],
+            }
+            if self.index is not None:
+                self.index.save(path + '.f32.tmp', order)
+            else:
+                open(path + '.f32.tmp', 'wb').close()
+        stat = os.stat(path + '.f32.tmp')
+        state['size'], state['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        state['sha256'] = file_digest(path + '.f32.tmp')
+        with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(path + '.f32.tmp', path + '.f32')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    def load(self, path: str) -> None:
+        """Replace the entries by those saved to path
+
+        If path.f32 does not match path.json (e.g. save was interrupted),
+        the cache is left empty rather than pairing vectors with the wrong
+        responses.
+        """
+
+        with open(path + '.json', encoding='utf-8') as f:
+            state = json.load(f)
+        entries = [SemanticEntry(*_) for _ in state['entries']]
+        if not self.matches(path + '.f32', state):
+            logger.warning("%s.f32 does not match %s.json, not loaded", path,
+                           path)
+            self.clear()
+            return
+        with self.lock:
+            self.index = None
+            if state['dim']:
+                self.index = VectorIndex.load(path + '.f32', state['dim'],
+                                              len(entries), self.np, self.mmap)
+            self.entries = list(entries)
+            self.recency = OrderedDict((_, None) for _ in range(len(entries)))
+            self.free = []
+
+    def matches(self, path: str, state: Dict[str, Any]) -> bool:
+        """Whether the vectors at path are those saved with state
+
+        The file is only hashed if verify is set or its modification time
+        changed (e.g. it was copied), so a memory-mapped load stays lazy.
+        """
+
+        if not os.path.exists(path):
+            return False
+        if 'sha256' not in state:
+            # files saved before the digest was recorded are trusted
+            return True
+        stat = os.stat(path)
+        if state.get('size', stat.st_size) != stat.st_size:
+            return False
+        if not self.verify and state.get('mtime_ns') == stat.st_mtime_ns:
+            return True
+        return file_digest(path) == state['sha256']
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.recency),
+            }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.index = None
+            self.entries = []
+            self.recency.clear()
+            self.free = []
+
+    def close(self) -> None:
+        self.save()
+
+    def __len__(self) -> int:
+        return len(self.recency)
@@ -1,27 +1,135 @@
+import gzip
 import json
-from typing import Dict, Optional, List, Callable, Tuple, Any, Union
+import os
+import threading
+from collections import deque
+from typing import (Dict, Optional, List, Callable, Tuple, Any, Union, IO,
+                    Iterator, Iterable, MutableSequence, Set, cast)
+
+from chatmanager.util import (num_tokens_from_message,
+                              num_tokens_from_messages_batch, typechecked)
+from chatmanager.config import ChatSetup
 
-from typeguard import typechecked
 
-from chatmanager.util import num_tokens_from_messages
-from chatmanager.config import ChatSetup
+class MessageNode:
+    """ A message and the history before it
+
+    Nodes are never modified, so every ChatMessage extending a history
+    shares its nodes instead of copying the messages.
+
+    Attributes:
+        message: The message
+        parent: The node of the previous message, None for the first one
+        length: The number of messages up to this one
+        tokens: (model, the tokens of the messages up to this one), cached
+            by token_usage
+    """
+
+    __slots__ = ('message', 'parent', 'length', 'tokens')
+
+    def __init__(self, message: Dict[str, str],
+                 parent: Optional['MessageNode']) -> None:
+        self.message: Dict[str, str] = message
+        self.parent: Optional[MessageNode] = parent
+        self.length: int = 1 if parent is None else parent.length + 1
+        self.tokens: Optional[Tuple[str, int]] = None
+
+
+class MessageList(List[Dict[str, str]]):
+    """ The messages of a ChatMessage as a list, see ChatMessage.drain
+
+    Changing it in place changes the ChatMessage, which rebuilds its chain
+    from the first changed message.
+
+    Attributes:
+        owner: The ChatMessage
+        tail: The node of the last message it holds
+    """
+
+    __slots__ = ('owner', 'tail')
+
+    def __init__(self, owner: 'ChatMessage',
+                 tail: Optional[MessageNode]) -> None:
+        super().__init__([{}] * (0 if tail is None else tail.length))
+        self.owner: ChatMessage = owner
+        self.tail: Optional[MessageNode] = tail
+        node = tail
+        while node is not None:
+            list.__setitem__(self, node.length - 1, node.message)
+            node = node.parent
+
+    def append(self, message: Dict[str, str]) -> None:
+        list.append(self, message)
+        self.owner.resync(self, len(self) - 1)
+
+    def extend(self, messages: Iterable[Dict[str, str]]) -> None:
+        keep = len(self)
+        list.extend(self, messages)
+        self.owner.resync(self, keep)
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        # copies and pickles are plain lists, detached from the ChatMessage
+        return list, (list(self),)
+
+
+def _edit(name: str) -> Callable[..., Any]:
+    method = getattr(list, name)
+
+    def edit(self: MessageList, *args: Any) -> Any:
+        before = list(self)
+        result = method(self, *args)
+        keep = 0
+        while keep < min(len(before), len(self)) and before[keep] is self[keep]:
+            keep += 1
+        self.owner.resync(self, keep)
+        return result
+
+    edit.__name__ = name
+    return edit
+
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'insert',
+              'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(MessageList, _name, _edit(_name))
 
 
 class ChatMessage:
     """Construct the message for single interaction
 
+    The messages are kept in a chain of MessageNode. A ChatMessage created
+    from another (or by fork) starts from the same chain, so a follow-up
+    only stores its new messages and a long conversation takes memory
+    linear in its turns. The token counts of a shared prefix are cached on
+    its nodes and counted once.
+
     Attributes:
-        repo: store the messages, order sensitive
+        tail: The node of the last message, None if there is none
+        repo: The messages, order sensitive, the same list as drain
     """
 
-    def __init__(self) -> None:
-        self.repo: List[Dict[str, str]] = list()
+    def __init__(self, history: Optional['ChatMessage'] = None) -> None:
+        self.tail: Optional[
+            MessageNode] = None if history is None else history.tail
+        self.messages: Optional[MessageList] = None
+
+    @property
+    def repo(self) -> List[Dict[str, str]]:
+        return self.drain()
+
+    @repo.setter
+    def repo(self, messages: List[Dict[str, str]]) -> None:
+        self.relink(0, list(messages))
 
     def set_repo(self, index: int, message: Dict[str, str]) -> None:
-        self.repo[index] = message
+        self.drain()[index] = message
 
     def clear(self) -> None:
-        self.repo = list()
+        self.relink(0, [])
+
+    def fork(self) -> 'ChatMessage':
+        """ A new ChatMessage sharing the messages so far """
+
+        return ChatMessage(self)
 
     def push_system(self, msg: str) -> None:
         self.push_msg({"role": "system", "content": msg})
@@ -33,28 +141,149 @@ class ChatMessage:
         self.push_msg({"role": "assistant", "content": msg})
 
     @typechecked
-    def push_msg(self, message: Union[List[Dict[str, str]], Dict[str,
-                                                                 str]]) -> None:
+    def push_msg(
+        self, message: Union[List[Dict[str, str]], Dict[str, str],
+                             'ChatMessage']
+    ) -> None:
+        """Append a message, a list of messages or another ChatMessage
+
+        The messages of another ChatMessage are shared, not copied, if this
+        one is empty.
+        """
+
         if isinstance(message, dict):
-            self.repo.append(message)
+            self.extend([message])
         elif isinstance(message, list):
-            self.repo.extend(message)
+            self.extend(message)
+        elif isinstance(message, ChatMessage):
+            if self.tail is None:
+                self.tail = message.tail
+            else:
+                self.extend(list(message.drain()))
         else:
-            raise TypeError("message must be a dict or a list of dict")
+            raise TypeError(
+                "message must be a dict, a list of dict or a ChatMessage")
+
+    def extend(self, messages: List[Dict[str, str]]) -> None:
+        self.relink(0 if self.tail is None else self.tail.length, messages)
 
     def del_msg(self, delete_checker: Callable[[Dict[str, str]], bool]) -> None:
         """ Delete the entries that satisfy delete_checker (i.e. return True) """
 
-        self.repo = list(filter(lambda x: not delete_checker(x), self.repo))
+        messages = self.drain()
+        kept = [not delete_checker(_) for _ in messages]
+        if all(kept):
+            return
+        first = kept.index(False)
+        self.relink(first, [
+            message for message, keep in zip(messages[first:], kept[first:])
+            if keep
+        ])
+
+    def rebuild(self, messages: List[Dict[str, str]], keep: int) -> None:
+        """ Replace the messages, sharing the nodes of the first keep """
+
+        self.relink(keep, messages[keep:])
+
+    def relink(self, keep: int, messages: List[Dict[str, str]]) -> None:
+        """Keep the first keep messages and chain messages after them
+
+        The list returned by drain is updated in place, appending is O(1).
+        """
+
+        cached = self.messages
+        if cached is not None and cached.tail is not self.tail:
+            cached = self.messages = None
+        tail = self.node_at(keep)
+        for message in messages:
+            tail = MessageNode(message, tail)
+        self.tail = tail
+        if cached is not None:
+            list.__setitem__(cached, slice(keep, None), messages)
+            cached.tail = tail
+
+    def resync(self, messages: MessageList, keep: int) -> None:
+        """ Follow an in-place change of the list returned by drain """
+
+        node = messages.tail
+        while node is not None and node.length > keep:
+            node = node.parent
+        for message in messages[keep:]:
+            node = MessageNode(message, node)
+        messages.tail = self.tail = node
+        self.messages = messages
+
+    def node_at(self, length: int) -> Optional[MessageNode]:
+        """ The node ending the first length messages """
+
+        node = self.tail
+        while node is not None and node.length > length:
+            node = node.parent
+        return node
+
+    def prefix(self, length: int) -> 'ChatMessage':
+        """ A new ChatMessage sharing the first length messages """
+
+        msg = ChatMessage()
+        msg.tail = self.node_at(length)
+        return msg
 
     def drain(self) -> List[Dict[str, str]]:
-        return self.repo
+        """The list of messages
+
+        Built from the chain once and kept in step with this ChatMessage,
+        so it is cheap to call repeatedly. Changing it changes the
+        ChatMessage.
+        """
+
+        if (messages :=
+                self.messages) is None or messages.tail is not self.tail:
+            messages = self.messages = MessageList(self, self.tail)
+        return messages
+
+    def token_usage(self, model: Optional[str] = None) -> int:
+        """The prompt tokens, counting only the messages not counted yet
 
-    def token_usage(self) -> int:
-        return num_tokens_from_messages(self.drain(), ChatSetup.model)
+        Args:
+            model: The model counting the tokens, ChatSetup.model by default
+        """
+
+        model = model or ChatSetup.model
+        pending: List[MessageNode] = []
+        node = self.tail
+        while node is not None and (node.tokens is None or
+                                    node.tokens[0] != model):
+            pending.append(node)
+            node = node.parent
+
+        num = 0 if node is None or node.tokens is None else node.tokens[1]
+        for node in reversed(pending):
+            num += num_tokens_from_message(node.message, model)
+            node.tokens = (model, num)
+        # every reply is primed with <|start|>assistant<|message|>
+        return num + 3
+
+    @staticmethod
+    def batch_token_usage(msgs: List['ChatMessage'],
+                          num_threads: int = 8,
+                          model: Optional[str] = None) -> List[int]:
+        """ Count the tokens of many messages, encoding them in one batch """
+
+        return num_tokens_from_messages_batch([_.drain() for _ in msgs],
+                                              model or ChatSetup.model,
+                                              num_threads)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # a long chain would exhaust the recursion limit of pickle
+        return {'messages': list(self.drain())}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.tail = None
+        self.messages = None
+        self.extend(state['messages'])
 
     def __str__(self) -> str:
-        return str(self.repo)
+        return str(self.drain())
 
 
 class ChatResponse:
@@ -82,8 +311,20 @@ class ChatResponse:
       }
     }
 
+    Only the fields in use are kept, in slots: the content and
+    finish_reason of each choice, the usage counts, object and
+    system_fingerprint. Whatever else the payload carries (tool calls,
+    logprobs, ...) is kept aside only if present, null fields are dropped.
+    The payload is rebuilt on access to response.
+
     Attributes:
-        response: The response from openai
+        response: The response from openai, rebuilt on each access
+        contents: The message content of each choice
+        finish_reasons: The finish_reason of each choice
+        prompt_tokens: The number of tokens of the prompt
+        completion_tokens: The number of tokens of the completion
+        total_tokens: The number of tokens of both
+        extra: The other fields of the payload, None if there is none
 
     Methods:
         token_usage: Get the number of tokens used
@@ -91,24 +332,121 @@ class ChatResponse:
         get_msg: Get the message of a choice
     """
 
-    def __init__(self, response) -> None:
-        self.response = response
+    __slots__ = ('contents', 'finish_reasons', 'created', 'id', 'model',
+                 'object', 'system_fingerprint', 'prompt_tokens',
+                 'completion_tokens', 'total_tokens', 'extra')
 
-        self.choices: List[Dict[str, str]] = response["choices"]
+    # the fields rebuilt from the slots, the rest goes to extra
+    FIELDS = {
+        'choices', 'created', 'id', 'model', 'object', 'system_fingerprint',
+        'usage'
+    }
+    CHOICE_FIELDS = {'index', 'message', 'finish_reason'}
+    MESSAGE_FIELDS = {'role', 'content'}
+
+    def __init__(self, response: Any) -> None:
+        choices = response["choices"]
+        usage = response["usage"]
+        self.contents: Tuple[Optional[str], ...] = tuple(
+            _["message"].get("content") for _ in choices)
+        self.finish_reasons: Tuple[Optional[str], ...] = tuple(
+            _.get("finish_reason") for _ in choices)
         self.created: int = response["created"]
         self.id: str = response["id"]
         self.model: str = response["model"]
-        self.usage: Dict[str, int] = response["usage"]
+        self.object: Optional[str] = response.get("object")
+        self.system_fingerprint: Optional[str] = response.get(
+            "system_fingerprint")
+        self.prompt_tokens: int = usage.get("prompt_tokens", 0)
+        self.completion_tokens: int = usage.get("completion_tokens", 0)
+        self.total_tokens: int = usage.get("total_tokens", 0)
+
+        # fields set to null (logprobs, refusal, ...) are dropped, so a
+        # plain completion leaves extra None
+        self.extra: Optional[Dict[str, Any]] = None
+        top = self.unknown(response, self.FIELDS)
+        per_choice: Optional[List[Optional[Dict[str, Any]]]] = None
+        for index, choice in enumerate(choices):
+            fields = self.unknown(choice, self.CHOICE_FIELDS)
+            message = self.unknown(choice["message"], self.MESSAGE_FIELDS)
+            if choice["message"].get("role", "assistant") != "assistant":
+                message = message or dict()
+                message["role"] = choice["message"]["role"]
+            if message:
+                fields = fields or dict()
+                fields["message"] = message
+            if fields:
+                if per_choice is None:
+                    per_choice = [None] * len(choices)
+                per_choice[index] = fields
+        if top or per_choice is not None:
+            self.extra = {"top": top or dict(), "choices": per_choice}
+
+    @staticmethod
+    def unknown(fields: Dict[str, Any],
+                known: Set[str]) -> Optional[Dict[str, Any]]:
+        """ The non-null fields not in known, None if there is none """
+
+        if all(k in known or v is None for k, v in fields.items()):
+            return None
+        return {
+            k: v for k, v in fields.items() if k not in known and v is not None
+        }
+
+    @property
+    def response(self) -> Dict[str, Any]:
+        response: Dict[str, Any] = {
+            "choices": self.choices,
+            "created": self.created,
+            "id": self.id,
+            "model": self.model,
+            "usage": self.usage,
+        }
+        if self.object is not None:
+            response["object"] = self.object
+        if self.system_fingerprint is not None:
+            response["system_fingerprint"] = self.system_fingerprint
+        if self.extra is not None:
+            response.update(self.extra["top"])
+        return response
+
+    @property
+    def choices(self) -> List[Dict[str, Any]]:
+        per_choice = None if self.extra is None else self.extra["choices"]
+        choices = []
+        for index in range(len(self.contents)):
+            choice: Dict[str, Any] = {
+                "finish_reason": self.finish_reasons[index],
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": self.contents[index],
+                },
+            }
+            if per_choice is not None and per_choice[index] is not None:
+                extra = dict(per_choice[index])
+                choice["message"].update(extra.pop("message", {}))
+                choice.update(extra)
+            choices.append(choice)
+        return choices
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        return {
+            "completion_tokens": self.completion_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "total_tokens": self.total_tokens,
+        }
 
     def token_usage(self, choice: str = 'total_tokens') -> int:
         assert (choice
                 in ['completion_tokens', 'prompt_tokens', 'total_tokens'])
-        return self.response["usage"][choice]
+        return getattr(self, choice)
 
     def choice_num(self) -> int:
-        return len(self.response["choices"])
+        return len(self.contents)
 
-    def get_choice(self, num: int) -> Optional[Dict[str, str]]:
+    def get_choice(self, num: int) -> Optional[Dict[str, Any]]:
         if num >= self.choice_num():
             # TODO: throw error
             return None
@@ -119,7 +457,97 @@ class ChatResponse:
         if choice >= self.choice_num():
             return None
 
-        return self.response["choices"][choice]["message"]["content"]
+        return self.contents[choice]
+
+
+class SessionStore:
+    """Append-only JSON lines file of (message, response) pairs
+
+    Each pair is written as one line when it is pushed:
+
+        {"messages": [...], "response": {...} or null}
+
+    Attributes:
+        path: The path of the file, gzip compressed if it ends with .gz
+        compress: Whether the file is gzip compressed
+        flush_interval: Flush to disk every so many pairs
+    """
+
+    def __init__(self,
+                 path: str,
+                 compress: Optional[bool] = None,
+                 flush_interval: int = 1) -> None:
+        self.path: str = path
+        self.compress: bool = path.endswith(
+            '.gz') if compress is None else compress
+        self.flush_interval: int = flush_interval
+        self.pending: int = 0
+        self.file: Optional[IO[str]] = None
+        self.lock = threading.Lock()
+
+    def open(self, mode: str) -> IO[str]:
+        if self.compress:
+            return cast(IO[str],
+                        gzip.open(self.path, mode + 't', encoding='utf-8'))
+        return open(self.path, mode, encoding='utf-8')
+
+    def append(self, msg: ChatMessage,
+               response: Optional[ChatResponse]) -> None:
+        line = json.dumps(
+            {
+                'messages': msg.drain(),
+                'response': None if response is None else response.response,
+            },
+            ensure_ascii=False)
+        with self.lock:
+            if self.file is None:
+                self.file = self.open('a')
+            self.file.write(line + '\n')
+            self.pending += 1
+            if self.pending >= self.flush_interval:
+                self.file.flush()
+                self.pending = 0
+
+    def __iter__(self) -> Iterator[Tuple[ChatMessage, Optional[ChatResponse]]]:
+        """ Read the pairs back one at a time
+
+        A message starting with the messages of the previous one shares
+        their storage, so reloading a conversation takes linear memory.
+        """
+
+        self.flush()
+        if not os.path.exists(self.path):
+            return
+        last: List[Dict[str, str]] = []
+        msg = ChatMessage()
+        with self.open('r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                messages = record['messages']
+                common = 0
+                while common < min(
+                        len(messages),
+                        len(last)) and messages[common] == last[common]:
+                    common += 1
+                msg = msg.prefix(common)
+                msg.extend(messages[common:])
+                last = messages
+                response = record['response']
+                yield msg, None if response is None else ChatResponse(response)
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
 
 
 class Session:
@@ -129,15 +557,38 @@ class Session:
 
     Attributes:
         name: The name of the session
-        repo: The list of (message, response) tuples
+        repo: The list of (message, response) tuples. With window, only the
+            latest window pairs are kept in memory.
+        store: If given, every pair is also appended to it as it is pushed
+        window: The maximum number of pairs kept in memory, None if unbounded
     """
 
-    def __init__(self, name: str) -> None:
+    def __init__(self,
+                 name: str,
+                 store: Optional[SessionStore] = None,
+                 window: Optional[int] = None) -> None:
         self.name: str = name
-        self.repo: List[Tuple[ChatMessage, Optional[ChatResponse]]] = list()
+        self.store: Optional[SessionStore] = store
+        self.window: Optional[int] = window
+        self.repo: MutableSequence[Tuple[ChatMessage, Optional[ChatResponse]]]
+        self.repo = list() if window is None else deque(maxlen=window)
+        self.lock = threading.Lock()
 
     def push(self, msg: ChatMessage, response: Optional[ChatResponse]) -> None:
-        self.repo.append((msg, response))
+        """ Save a pair, safe to call from many threads """
+
+        with self.lock:
+            self.repo.append((msg, response))
+            if self.store is not None:
+                self.store.append(msg, response)
+
+    def records(self) -> Iterator[Tuple[ChatMessage, Optional[ChatResponse]]]:
+        """ Iterate over all pairs, read from the store if there is one """
+
+        if self.store is not None:
+            return iter(self.store)
+        with self.lock:
+            return iter(list(self.repo))
 
     def export(
         self, export_processor: Callable[[ChatMessage, Optional[ChatResponse]],
@@ -149,5 +600,46 @@ class Session:
             export_processor: A function that process each (message, response) pair
         """
 
-        lst = list(map(lambda x: export_processor(x[0], x[1]), self.repo))
+        lst = list(map(lambda x: export_processor(x[0], x[1]), self.records()))
         return json.dumps(lst, indent=4)
+
+    def export_to(
+        self, f: IO[str],
+        export_processor: Callable[[ChatMessage, Optional[ChatResponse]], Any]
+    ) -> int:
+        """ Export the session to a file, one JSON line per pair
+
+        Only one pair is held in memory at a time.
+
+        Args:
+            f: The file to write to
+            export_processor: A function that process each (message, response) pair
+
+        Returns:
+            The number of pairs exported
+        """
+
+        num = 0
+        for msg, response in self.records():
+            f.write(
+                json.dumps(export_processor(msg, response), ensure_ascii=False)
+                + '\n')
+            num += 1
+        return num
+
+    @classmethod
+    def load(cls,
+             name: str,
+             store: SessionStore,
+             window: Optional[int] = None) -> 'Session':
+        """ Reload a session from its store
+
+        With window, only the latest window pairs are kept in memory while
+        the file is streamed.
+        """
+
+        session = cls(name, None, window)
+        for msg, response in store:
+            session.repo.append((msg, response))
+        session.store = store
+        return session
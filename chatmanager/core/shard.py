@@ -0,0 +1,311 @@
+"""
+Shard a stream of messages across worker processes
+
+Token counting, JSON parsing and building ChatResponse objects hold the GIL,
+so with enough traffic a single process is CPU bound. Each worker runs its
+own ChatManager and async send loop; the rate limits of the keys are kept in
+shared memory, so all workers draw from one quota per key.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent import futures
+from typing import (Dict, Optional, List, Any, Iterator, Iterable, Tuple, Union,
+                    Callable)
+
+from chatmanager.config import ChatConfig
+from .chat import ChatManager
+from .key import KeyGroup, KeyLimit, TokenBucket
+from .retry import ChatError, RetryPolicy
+from .session import Session, ChatMessage, ChatResponse
+
+Result = Union[ChatResponse, ChatError, None]
+
+
+class SharedTokenBucket(TokenBucket):
+    """ A TokenBucket whose state lives in shared memory
+
+    Attributes:
+        state: The shared array
+        offset: The index of tokens in state, updated follows it
+    """
+
+    def __init__(self, capacity: float, rate: float, state: Any,
+                 offset: int) -> None:
+        # the state is initialized by SharedQuota, not here
+        self.capacity = capacity
+        self.rate = rate
+        self.state: Any = state
+        self.offset: int = offset
+
+    @property  # type: ignore[override]
+    def tokens(self) -> float:
+        return self.state[self.offset]
+
+    @tokens.setter
+    def tokens(self, value: float) -> None:
+        self.state[self.offset] = value
+
+    @property  # type: ignore[override]
+    def updated(self) -> float:
+        return self.state[self.offset + 1]
+
+    @updated.setter
+    def updated(self, value: float) -> None:
+        self.state[self.offset + 1] = value
+
+
+class SharedKeyLimit(KeyLimit):
+    """ A KeyLimit whose buckets and cooldown live in shared memory """
+
+    def __init__(self, limit: KeyLimit, state: Any, offset: int) -> None:
+        self.requests = None if limit.requests is None else SharedTokenBucket(
+            limit.requests.capacity, limit.requests.rate, state, offset)
+        self.tokens = None if limit.tokens is None else SharedTokenBucket(
+            limit.tokens.capacity, limit.tokens.rate, state, offset + 2)
+        self.state: Any = state
+        self.offset: int = offset
+
+    @property  # type: ignore[override]
+    def cooldown_until(self) -> float:
+        return self.state[self.offset + 4]
+
+    @cooldown_until.setter
+    def cooldown_until(self, value: float) -> None:
+        self.state[self.offset + 4] = value
+
+
+class SharedQuota:
+    """ The rate limits of a KeyGroup in shared memory
+
+    Created in the parent from its keys, then attached to the KeyGroup of
+    each worker. The KeyGroups of the workers share one lock, so reserving
+    quota is atomic across processes. time.monotonic is system-wide, so the
+    buckets refill the same in every process.
+
+    Attributes:
+        names: The key names, the limits of the i-th take FIELDS slots of
+            state from i * FIELDS
+        state: (request tokens, request updated, token tokens, token
+            updated, cooldown until) of each key
+        lock: Shared by the KeyGroups of the workers
+    """
+
+    FIELDS = 5
+
+    def __init__(self, keys: KeyGroup, context: Any) -> None:
+        self.names: List[str] = sorted(keys.limits)
+        self.state: Any = context.RawArray('d', len(self.names) * self.FIELDS)
+        self.lock: Any = context.RLock()
+        with keys.lock:
+            for i, name in enumerate(self.names):
+                limit = keys.limits[name]
+                offset = i * self.FIELDS
+                for bucket, at in ((limit.requests, offset), (limit.tokens,
+                                                              offset + 2)):
+                    if bucket is not None:
+                        self.state[at] = bucket.tokens
+                        self.state[at + 1] = bucket.updated
+                self.state[offset + 4] = limit.cooldown_until
+
+    def attach(self, keys: KeyGroup) -> None:
+        """ Back the limits of a KeyGroup by the shared state """
+
+        with keys.lock:
+            for i, name in enumerate(self.names):
+                if name in keys.limits:
+                    keys.limits[name] = SharedKeyLimit(keys.limits[name],
+                                                       self.state,
+                                                       i * self.FIELDS)
+            keys.lock = self.lock
+
+
+def quota_of(bucket: Optional[TokenBucket]) -> Optional[int]:
+    """ The per minute quota of a bucket of a KeyLimit """
+
+    return None if bucket is None else int(bucket.capacity)
+
+
+class WorkerSpec:
+    """ What a worker needs to rebuild the ChatManager of the parent
+
+    Attributes:
+        keys: (name, key, rpm, tpm) of each key
+        strategy: The name of the key strategy
+        config: The resolved ChatConfig of the parent, ChatSetup included
+        retry: The RetryPolicy of the parent
+        coalesce: Whether identical requests share one call
+    """
+
+    def __init__(self, cm: ChatManager) -> None:
+        self.keys: List[Tuple[str, str, Optional[int], Optional[int]]] = []
+        for name, key in cm.keys.keys.items():
+            limit = cm.keys.limits[name]
+            self.keys.append((name, key.key, quota_of(limit.requests),
+                              quota_of(limit.tokens)))
+        # e.g. strategy_rate_limit -> rate-limit
+        name = cm.keys.strategy.__name__
+        self.strategy: str = name[len('strategy_'):].replace('_', '-')
+        self.config: ChatConfig = cm.config.resolve()
+        self.retry: RetryPolicy = cm.retry
+        self.coalesce: bool = cm.coalesce
+
+    def build(self) -> ChatManager:
+        cm = ChatManager(self.config)
+        for name, key, rpm, tpm in self.keys:
+            cm.add_key(name, key, rpm, tpm)
+        cm.set_key_strategy(self.strategy)
+        cm.retry = self.retry
+        cm.coalesce = self.coalesce
+        return cm
+
+
+# the ChatManager of the worker process
+worker: Optional[ChatManager] = None
+
+
+def init_worker(spec: WorkerSpec, factory: Optional[Callable[[], ChatManager]],
+                quota: Optional[SharedQuota]) -> None:
+    global worker
+    worker = factory() if factory is not None else spec.build()
+    if quota is not None:
+        quota.attach(worker.keys)
+
+
+def run_shard(shard: List[ChatMessage], concurrency: int) -> List[Result]:
+    """ Send a shard on a new event loop of the worker """
+
+    assert (worker is not None)
+    cm = worker
+
+    async def main() -> List[Result]:
+        try:
+            # the parent saves the pairs, keep nothing here
+            return await cm.asend_many(shard, concurrency,
+                                       Session('shard', window=0))
+        finally:
+            await cm.aclose()
+
+    results = asyncio.run(main())
+    for result in results:
+        if isinstance(result, ChatError):
+            # exceptions of openai do not always survive pickling
+            result.error = None
+    return results
+
+
+class ShardedRunner:
+    """ Send messages from a pool of worker processes
+
+    The messages are cut into shards of shard_size and handed to the
+    workers, at most two shards per worker in flight, so the input can be
+    an unbounded iterator. Each worker sends its shard with at most
+    concurrency requests in flight. The pairs are pushed to the session of
+    the parent as the shards come back.
+
+    A worker rebuilds the keys, key strategy, config and retry policy of the
+    parent, or calls factory (a picklable function) to build its
+    ChatManager. Caches, schedulers, routers and ledgers of the parent are
+    not carried over. With the rate-limit strategy, the quota of the keys is
+    shared by all workers.
+
+    Attributes:
+        cm: The ChatManager of the parent
+        processes: The number of worker processes
+        concurrency: The maximum number of in-flight requests per worker
+        shard_size: The number of messages of a shard
+        factory: Builds the ChatManager of a worker, None to copy cm
+        context: The multiprocessing start method
+    """
+
+    def __init__(self,
+                 cm: ChatManager,
+                 processes: Optional[int] = None,
+                 concurrency: int = 64,
+                 shard_size: int = 256,
+                 factory: Optional[Callable[[], ChatManager]] = None,
+                 context: str = 'spawn') -> None:
+        assert (concurrency > 0), "concurrency must be positive"
+        assert (shard_size > 0), "shard_size must be positive"
+        self.cm: ChatManager = cm
+        self.processes: int = processes or multiprocessing.cpu_count()
+        self.concurrency: int = concurrency
+        self.shard_size: int = shard_size
+        self.factory: Optional[Callable[[], ChatManager]] = factory
+        self.context: str = context
+
+    def imap(
+        self,
+        msgs: Iterable[ChatMessage],
+        session: Union[str, Session,
+                       None] = None) -> Iterator[Tuple[int, Result]]:
+        """Send messages and yield the results as their shards finish
+
+        Args:
+            msgs: The messages to send
+            session: The session (or its name) of the parent to save the
+                pairs to instead of cur_session
+
+        Returns:
+            An iterator of (index in msgs, result), in shard completion order
+        """
+
+        target = self.cm._target_session(session)
+        assert (self.cm.is_ready(target)), "ChatManager is not ready"
+        assert (target is not None)
+
+        context = multiprocessing.get_context(self.context)
+        quota: Optional[SharedQuota] = None
+        if self.cm.keys.is_rate_limited():
+            quota = SharedQuota(self.cm.keys, context)
+        with futures.ProcessPoolExecutor(self.processes,
+                                         mp_context=context,
+                                         initializer=init_worker,
+                                         initargs=(WorkerSpec(self.cm),
+                                                   self.factory,
+                                                   quota)) as pool:
+            pending: Dict[futures.Future, Tuple[int, List[ChatMessage]]] = {}
+            for start, shard in self.shards(msgs):
+                if len(pending) >= 2 * self.processes:
+                    yield from self.collect(pending, target)
+                pending[pool.submit(run_shard, shard,
+                                    self.concurrency)] = (start, shard)
+            while pending:
+                yield from self.collect(pending, target)
+
+    def run(self,
+            msgs: Iterable[ChatMessage],
+            session: Union[str, Session, None] = None) -> List[Result]:
+        """ Send messages, the results are in the order of msgs """
+
+        results: Dict[int, Result] = dict(self.imap(msgs, session))
+        return [results[_] for _ in range(len(results))]
+
+    def shards(
+            self, msgs: Iterable[ChatMessage]
+    ) -> Iterator[Tuple[int, List[ChatMessage]]]:
+        """ (index of the first message, messages) of each shard """
+
+        shard: List[ChatMessage] = []
+        start = 0
+        for msg in msgs:
+            shard.append(msg)
+            if len(shard) == self.shard_size:
+                yield start, shard
+                start += len(shard)
+                shard = []
+        if shard:
+            yield start, shard
+
+    def collect(self, pending: Dict[futures.Future, Tuple[int,
+                                                          List[ChatMessage]]],
+                session: Session) -> Iterator[Tuple[int, Result]]:
+        """ Wait for a shard to finish, save and yield its results """
+
+        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            start, shard = pending.pop(future)
+            for i, (msg, result) in enumerate(zip(shard, future.result())):
+                session.push(
+                    msg, result if isinstance(result, ChatResponse) else None)
+                yield start + i, result
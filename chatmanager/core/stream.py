@@ -0,0 +1,384 @@
+"""
+Incremental delivery of streamed completions
+"""
+
+import asyncio
+import queue
+import time
+from concurrent import futures
+from typing import (Optional, List, Dict, Callable, Any, Iterator,
+                    AsyncIterator, Tuple, Sequence, Awaitable, Union)
+
+from chatmanager.util import (num_tokens_from_messages, num_tokens_from_string,
+                              logger)
+from .session import ChatMessage, ChatResponse
+from .retry import ChatError
+
+
+class StreamCollector:
+    """Accumulate the chunks of a streamed completion into a ChatResponse
+
+    {
+      "id": "chatcmpl-123",
+      "object": "chat.completion.chunk",
+      "created": 1694268190,
+      "model": "gpt-3.5-turbo-0613",
+      "choices": [
+        {
+          "index": 0,
+          "delta": {"content": "Hello"},
+          "finish_reason": null
+        }
+      ]
+    }
+
+    Attributes:
+        msg: The messages sent
+        on_finish: Called with the complete response once the stream ends
+        response: The complete response, available once the stream ends
+        error: The failure if the stream broke off
+        finished: Whether the stream has ended
+        first_token_at: The perf_counter time of the first content delta
+    """
+
+    def __init__(
+        self,
+        msg: List[Dict[str, str]],
+        on_finish: Optional[Callable[[Optional[ChatResponse]], None]] = None
+    ) -> None:
+        self.msg: List[Dict[str, str]] = msg
+        self.on_finish: Optional[Callable[[Optional[ChatResponse]],
+                                          None]] = on_finish
+        self.response: Optional[ChatResponse] = None
+        self.error: Optional[ChatError] = None
+        self.finished: bool = False
+        self.first_token_at: Optional[float] = None
+
+        self.meta: Dict[str, Any] = {}
+        self.contents: Dict[int, List[str]] = {}
+        self.finish_reasons: Dict[int, Optional[str]] = {}
+        self.usage: Optional[Dict[str, int]] = None
+
+    def feed(self, chunk: Any) -> str:
+        """ Record a chunk, return the content delta of the first choice """
+
+        for k in ['id', 'created', 'model']:
+            if k not in self.meta and k in chunk:
+                self.meta[k] = chunk[k]
+
+        if chunk.get('usage'):
+            self.usage = dict(chunk['usage'])
+
+        delta = ''
+        for choice in chunk.get('choices', []):
+            index = choice.get('index', 0)
+            content = choice.get('delta', {}).get('content') or ''
+            self.contents.setdefault(index, []).append(content)
+            if choice.get('finish_reason'):
+                self.finish_reasons[index] = choice['finish_reason']
+            if index == 0:
+                delta += content
+        if delta and self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return delta
+
+    def finish(self,
+               error: Optional[Exception] = None) -> Optional[ChatResponse]:
+        """ Build the complete response and call on_finish
+
+        Args:
+            error: The exception that broke off the stream, the response is
+                None then
+        """
+
+        if self.finished:
+            return self.response
+        self.finished = True
+
+        if error is None:
+            self.response = ChatResponse(self.build())
+        else:
+            logger.warning("stream broke off: %s", error)
+            self.error = ChatError.from_exception(error, 1)
+        if self.on_finish is not None:
+            self.on_finish(self.response)
+        return self.response
+
+    def close(self) -> None:
+        """ Abandon the stream before it ends
+
+        The request is accounted as failed with a ChatError of kind
+        cancelled. Called when the stream is garbage collected.
+        """
+
+        if self.finished:
+            return
+        self.finished = True
+        self.error = ChatError('cancelled',
+                               'the stream was closed before it ended', None, 1)
+        if self.on_finish is not None:
+            self.on_finish(None)
+
+    def __del__(self) -> None:
+        # an abandoned stream still releases the quota its request holds
+        if not getattr(self, 'finished', True):
+            self.close()
+
+    def build(self) -> Dict[str, Any]:
+        """ Construct the body of a non-streamed completion """
+
+        model = self.meta.get('model', '')
+        choices: List[Dict[str, Any]] = []
+        for index in sorted(self.contents):
+            choices.append({
+                'index': index,
+                'message': {
+                    'role': 'assistant',
+                    'content': ''.join(self.contents[index]),
+                },
+                'finish_reason': self.finish_reasons.get(index),
+            })
+
+        usage = self.usage
+        if usage is None:
+            # the server did not report usage, count it locally
+            try:
+                prompt = num_tokens_from_messages(self.msg, model)
+                completion = sum(
+                    num_tokens_from_string(_['message']['content'], model)
+                    for _ in choices)
+            except NotImplementedError:
+                prompt = num_tokens_from_messages(self.msg)
+                completion = sum(
+                    num_tokens_from_string(_['message']['content'])
+                    for _ in choices)
+            except Exception as e:
+                # the tokenizer is unavailable, the content is still valid
+                logger.warning("failed to count tokens: %s", e)
+                prompt, completion = 0, 0
+            usage = {
+                'prompt_tokens': prompt,
+                'completion_tokens': completion,
+                'total_tokens': prompt + completion,
+            }
+
+        return {
+            'id': self.meta.get('id', ''),
+            'created': self.meta.get('created', 0),
+            'model': model,
+            'object': 'chat.completion',
+            'choices': choices,
+            'usage': usage,
+        }
+
+
+class ChatStream(StreamCollector):
+    """Iterate over the content deltas of a streamed completion
+
+    The deltas of the first choice are yielded as they arrive. After the
+    iteration ends, response holds the complete ChatResponse.
+    """
+
+    def __init__(
+        self,
+        msg: List[Dict[str, str]],
+        chunks: Iterator[Any],
+        on_finish: Optional[Callable[[Optional[ChatResponse]], None]] = None
+    ) -> None:
+        super().__init__(msg, on_finish)
+        self.chunks: Iterator[Any] = chunks
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        while not self.finished:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.finish()
+                break
+            except Exception as e:
+                self.finish(e)
+                break
+
+            if (delta := self.feed(chunk)):
+                return delta
+
+        raise StopIteration
+
+    def collect(self) -> Optional[ChatResponse]:
+        """ Consume the remaining stream and return the complete response """
+
+        for _ in self:
+            pass
+        return self.response
+
+    def close(self) -> None:
+        super().close()
+        if (close := getattr(self.chunks, 'close', None)) is not None:
+            close()
+
+
+class AsyncChatStream(StreamCollector):
+    """Asynchronously iterate over the content deltas of a streamed completion
+    """
+
+    def __init__(
+        self,
+        msg: List[Dict[str, str]],
+        chunks: AsyncIterator[Any],
+        on_finish: Optional[Callable[[Optional[ChatResponse]], None]] = None
+    ) -> None:
+        super().__init__(msg, on_finish)
+        self.chunks: AsyncIterator[Any] = chunks
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self
+
+    async def __anext__(self) -> str:
+        while not self.finished:
+            try:
+                chunk = await self.chunks.__anext__()
+            except StopAsyncIteration:
+                self.finish()
+                break
+            except Exception as e:
+                self.finish(e)
+                break
+
+            if (delta := self.feed(chunk)):
+                return delta
+
+        raise StopAsyncIteration
+
+    async def collect(self) -> Optional[ChatResponse]:
+        """ Consume the remaining stream and return the complete response """
+
+        async for _ in self:
+            pass
+        return self.response
+
+    async def aclose(self) -> None:
+        """ Same as close, also closing the connection """
+
+        self.close()
+        if (aclose := getattr(self.chunks, 'aclose', None)) is not None:
+            await aclose()
+
+
+class ChatStreamGroup:
+    """Stream several messages concurrently with a thread pool
+
+    Iterating yields (index, delta) tuples in arrival order, index is the
+    position of the message in msgs. After the iteration ends, responses
+    holds the complete responses (or ChatError) in the order of msgs.
+
+    Attributes:
+        msgs: The messages to send
+        responses: The complete responses
+    """
+
+    def __init__(self, msgs: Sequence[ChatMessage],
+                 open_stream: Callable[[ChatMessage],
+                                       Union[ChatStream, ChatError,
+                                             None]], thread_num: int) -> None:
+        self.msgs: Sequence[ChatMessage] = msgs
+        self.responses: List[Union[ChatResponse, ChatError,
+                                   None]] = [None for _ in msgs]
+
+        self.queue: queue.Queue = queue.Queue()
+        self.remaining: int = len(msgs)
+        self.executor = futures.ThreadPoolExecutor(thread_num)
+        for index, msg in enumerate(msgs):
+            self.executor.submit(self.worker, index, msg, open_stream)
+        self.executor.shutdown(wait=False)
+
+    def worker(
+        self, index: int, msg: ChatMessage,
+        open_stream: Callable[[ChatMessage], Union[ChatStream, ChatError, None]]
+    ) -> None:
+        try:
+            stream = open_stream(msg)
+            if not isinstance(stream, ChatStream):
+                self.responses[index] = stream
+                return
+            for delta in stream:
+                self.queue.put((index, delta))
+            self.responses[index] = stream.response or stream.error
+        finally:
+            self.queue.put((index, None))
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        while self.remaining > 0:
+            index, delta = self.queue.get()
+            if delta is None:
+                self.remaining -= 1
+                continue
+            yield index, delta
+
+    def collect(self) -> List[Union[ChatResponse, ChatError, None]]:
+        """ Consume the remaining streams and return the complete responses """
+
+        for _ in self:
+            pass
+        return self.responses
+
+
+async def stream_many(
+    msgs: Sequence[ChatMessage],
+    open_stream: Callable[[ChatMessage], Awaitable[Union[AsyncChatStream,
+                                                         ChatError, None]]],
+    concurrency: int,
+    responses: Optional[List[Union[ChatResponse, ChatError, None]]] = None
+) -> AsyncIterator[Tuple[int, str]]:
+    """Stream several messages concurrently on the running event loop
+
+    Args:
+        msgs: The messages to send
+        open_stream: Start the stream of a message
+        concurrency: The maximum number of in-flight requests
+        responses: If given, filled with the complete responses or ChatError
+
+    Yields:
+        (index, delta) tuples in arrival order
+    """
+
+    assert (concurrency > 0), "concurrency must be positive"
+
+    channel: asyncio.Queue = asyncio.Queue()
+    pending = iter(enumerate(msgs))
+
+    async def worker() -> None:
+        stream: Union[AsyncChatStream, ChatError, None] = None
+        try:
+            for index, msg in pending:
+                stream = await open_stream(msg)
+                if not isinstance(stream, AsyncChatStream):
+                    if responses is not None:
+                        responses[index] = stream
+                    continue
+                async for delta in stream:
+                    await channel.put((index, delta))
+                if responses is not None:
+                    responses[index] = stream.response or stream.error
+        finally:
+            if isinstance(stream, AsyncChatStream):
+                # cancelled while reading, release what the stream holds
+                stream.close()
+            await channel.put(None)
+
+    workers = [
+        asyncio.ensure_future(worker())
+        for _ in range(min(concurrency, len(msgs)))
+    ]
+    remaining = len(workers)
+    try:
+        while remaining > 0:
+            if (item := await channel.get()) is None:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        for _ in workers:
+            _.cancel()
@@ -0,0 +1,168 @@
+"""
+Per-request timings and token counts, aggregated per key and per session
+"""
+
+import threading
+from typing import Dict, Optional, List, Callable, Any
+
+from chatmanager.util import logger
+
+
+class RequestTrace:
+    """ What happened to one request
+
+    The durations are in seconds, None if the step did not happen (e.g. no
+    key is selected for a cache hit).
+
+    Attributes:
+        session: The name of the session the pair is saved to
+        key_name: The name of the key used by the last attempt
+        attempts: The number of requests sent
+        queue_wait: From send/asend being called to the request starting
+        key_wait: Spent selecting keys, rate-limit waits included
+        latency: Spent in the network, summed over the attempts
+        first_token: From the request starting to the first content delta
+            of its stream
+        total: From the request starting to its response
+        prompt_tokens: The prompt tokens used, 0 if no request was sent
+        completion_tokens: The completion tokens used, 0 if no request was
+            sent
+        cached: Whether the response came from the cache
+        shared: Whether the response came from a coalesced call
+        error: The kind of the failure, None if it succeeded
+    """
+
+    __slots__ = ('session', 'key_name', 'attempts', 'queue_wait', 'key_wait',
+                 'latency', 'first_token', 'total', 'prompt_tokens',
+                 'completion_tokens', 'cached', 'shared', 'error')
+
+    def __init__(self, session: str = '') -> None:
+        self.session: str = session
+        self.key_name: Optional[str] = None
+        self.attempts: int = 0
+        self.queue_wait: Optional[float] = None
+        self.key_wait: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self.total: Optional[float] = None
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.cached: bool = False
+        self.shared: bool = False
+        self.error: Optional[str] = None
+
+    def step(self, key_name: str, key_wait: float, latency: float) -> None:
+        """ Account for an attempt """
+
+        self.key_name = key_name
+        self.attempts += 1
+        self.key_wait = (self.key_wait or 0.0) + key_wait
+        self.latency = (self.latency or 0.0) + latency
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {_: getattr(self, _) for _ in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f'RequestTrace({self.as_dict()})'
+
+
+class Counters:
+    """ The running totals of a key or a session
+
+    Attributes:
+        requests: The number of requests
+        failures: The number of requests that failed
+        retries: The number of attempts beyond the first
+        cached: The number of requests answered by the cache
+        prompt_tokens: The prompt tokens used
+        completion_tokens: The completion tokens used
+        latency: The network time, summed
+        latency_max: The longest network time of a request
+    """
+
+    __slots__ = ('requests', 'failures', 'retries', 'cached', 'prompt_tokens',
+                 'completion_tokens', 'latency', 'latency_max')
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.failures: int = 0
+        self.retries: int = 0
+        self.cached: int = 0
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.latency: float = 0.0
+        self.latency_max: float = 0.0
+
+    def add(self, trace: RequestTrace) -> None:
+        self.requests += 1
+        self.failures += trace.error is not None
+        self.retries += max(trace.attempts - 1, 0)
+        self.cached += trace.cached
+        self.prompt_tokens += trace.prompt_tokens
+        self.completion_tokens += trace.completion_tokens
+        if trace.latency is not None:
+            self.latency += trace.latency
+            self.latency_max = max(self.latency_max, trace.latency)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {_: getattr(self, _) for _ in self.__slots__}
+
+
+class Telemetry:
+    """ Collect the trace of every request
+
+    Recording a trace only updates a few counters under a lock, cheap
+    enough to leave on. Hooks are called with each trace on the thread that
+    finished the request, keep them fast or hand the trace off.
+
+    Attributes:
+        hooks: Called with every RequestTrace
+        keys: The counters of each key name
+        sessions: The counters of each session name
+    """
+
+    def __init__(self) -> None:
+        self.hooks: List[Callable[[RequestTrace], None]] = []
+        self.keys: Dict[str, Counters] = dict()
+        self.sessions: Dict[str, Counters] = dict()
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[RequestTrace], None]) -> None:
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[RequestTrace], None]) -> None:
+        self.hooks.remove(hook)
+
+    def record(self, trace: RequestTrace) -> None:
+        with self.lock:
+            if trace.key_name:
+                if (counters := self.keys.get(trace.key_name)) is None:
+                    counters = self.keys[trace.key_name] = Counters()
+                counters.add(trace)
+            if (counters := self.sessions.get(trace.session)) is None:
+                counters = self.sessions[trace.session] = Counters()
+            counters.add(trace)
+
+        for hook in self.hooks:
+            try:
+                hook(trace)
+            except Exception as e:
+                logger.warning("telemetry hook failed: %s", e)
+
+    def stats(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """ A snapshot of the counters, {'keys': {...}, 'sessions': {...}} """
+
+        with self.lock:
+            return {
+                'keys': {
+                    k: v.as_dict() for k, v in self.keys.items()
+                },
+                'sessions': {
+                    k: v.as_dict() for k, v in self.sessions.items()
+                },
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.keys.clear()
+            self.sessions.clear()
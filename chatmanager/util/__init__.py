@@ -1 +1,4 @@
-from .common import num_tokens_from_messages
+from .common import (num_tokens_from_message, num_tokens_from_messages,
+                     num_tokens_from_messages_batch, num_tokens_from_string)
+from .log import logger
+from .typecheck import typechecked
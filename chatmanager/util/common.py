@@ -1,19 +1,43 @@
-from typing import List, Dict
-
-import tiktoken
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Tuple, Iterable, TYPE_CHECKING
 
 from chatmanager.config import ChatSetup
+from .log import logger
 
+if TYPE_CHECKING:
+    import tiktoken
+
+# the number of (encoding, string) -> token count entries memoized
+TOKEN_CACHE_SIZE = 1 << 16
+
+_token_cache: 'OrderedDict[Tuple[str, str], int]' = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> 'tiktoken.Encoding':
+    """Return the encoding of a model, loaded once per model.
+
+    tiktoken is imported on the first call, it is slow to import.
+    """
+    import tiktoken
 
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages: List[Dict[str, str]],
-                             model: str = ChatSetup.model):
-    """Return the number of tokens used by a list of messages."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        logger.warning("model %s not found. Using cl100k_base encoding.", model)
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+@lru_cache(maxsize=None)
+def message_format(model: str) -> Tuple[str, int, int]:
+    """Return (model, tokens_per_message, tokens_per_name) used for counting.
+
+    The model is replaced by the snapshot it is counted as.
+    """
     if model in {
             "gpt-3.5-turbo-0613",
             "gpt-3.5-turbo-16k-0613",
@@ -22,31 +46,109 @@ def num_tokens_from_messages(messages: List[Dict[str, str]],
             "gpt-4-0613",
             "gpt-4-32k-0613",
     }:
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
+        # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        # if there's a name, the role is omitted
+        return model, 4, -1
     elif "gpt-3.5-turbo" in model:
-        print(
-            "Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613."
+        logger.warning(
+            "gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613."
         )
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return message_format("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
-        print(
-            "Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613."
+        logger.warning(
+            "gpt-4 may update over time. Returning num tokens assuming gpt-4-0613."
         )
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return message_format("gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+
+
+def _lookup(encoding: 'tiktoken.Encoding', string: str) -> int:
+    """Return the memoized token count of a string, -1 if not memoized."""
+    with _token_cache_lock:
+        num = _token_cache.get((encoding.name, string))
+        if num is None:
+            return -1
+        _token_cache.move_to_end((encoding.name, string))
+        return num
+
+
+def _store(encoding: 'tiktoken.Encoding', strings: Iterable[str],
+           nums: Iterable[int]) -> None:
+    with _token_cache_lock:
+        for string, num in zip(strings, nums):
+            _token_cache[(encoding.name, string)] = num
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def _count(encoding: 'tiktoken.Encoding', string: str) -> int:
+    if (num := _lookup(encoding, string)) < 0:
+        num = len(encoding.encode(string))
+        _store(encoding, [string], [num])
+    return num
+
+
+def num_tokens_from_message(message: Dict[str, str],
+                            model: str = ChatSetup.model) -> int:
+    """Return the number of tokens used by a single message.
+
+    The 3 tokens priming the reply are not included.
+    """
+    model, tokens_per_message, tokens_per_name = message_format(model)
+    encoding = get_encoding(model)
+
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += _count(encoding, value)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def num_tokens_from_messages(messages: List[Dict[str, str]],
+                             model: str = ChatSetup.model) -> int:
+    """Return the number of tokens used by a list of messages.
+
+    The token count of each string is memoized, so a growing conversation
+    only encodes the new turns.
+    """
+    num_tokens = sum(num_tokens_from_message(_, model) for _ in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
+
+
+def num_tokens_from_messages_batch(messages_lst: List[List[Dict[str, str]]],
+                                   model: str = ChatSetup.model,
+                                   num_threads: int = 8) -> List[int]:
+    """Return the number of tokens used by each list of messages.
+
+    The strings not memoized yet are encoded in one encode_batch call,
+    which runs on num_threads threads.
+    """
+    model, _, _ = message_format(model)
+    encoding = get_encoding(model)
+
+    pending = []
+    seen = set()
+    for messages in messages_lst:
+        for message in messages:
+            for value in message.values():
+                if value not in seen and _lookup(encoding, value) < 0:
+                    seen.add(value)
+                    pending.append(value)
+
+    if pending:
+        encoded = encoding.encode_batch(pending, num_threads=num_threads)
+        _store(encoding, pending, [len(_) for _ in encoded])
+
+    return [num_tokens_from_messages(_, model) for _ in messages_lst]
+
+
+def num_tokens_from_string(string: str, model: str = ChatSetup.model) -> int:
+    """Return the number of tokens of a string."""
+    return _count(get_encoding(model), string)
@@ -0,0 +1,5 @@
+import logging
+
+# without any handler configured, warnings go to stderr through
+# logging.lastResort
+logger = logging.getLogger('chatmanager')
@@ -0,0 +1,317 @@
+"""
+A local stand-in for the chat completions API, for load tests without
+network or cost
+
+    python -m chatmanager.util.mock_server --port 8000 --latency 0.2
+
+then point ChatSetup.api_base to http://127.0.0.1:8000/v1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Any, Callable, List
+
+
+def constant(seconds: float) -> Callable[[], float]:
+    """ Latency distribution: always seconds """
+
+    return lambda: seconds
+
+
+def uniform(low: float, high: float) -> Callable[[], float]:
+    """ Latency distribution: uniform between low and high seconds """
+
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Callable[[], float]:
+    """ Latency distribution: log-normal with a long tail, like real APIs """
+
+    return lambda: median * random.lognormvariate(0, sigma)
+
+
+class MockServer:
+    """ Serve /v1/chat/completions on a local port in a background thread
+
+    The reply echoes the last message, one chunk per word when streamed.
+    Usage is reported as one token per word.
+
+    Attributes:
+        host: The host to bind
+        port: The port to bind, 0 for any free port
+        latency: Return the seconds to wait before each response
+        chunk_latency: The seconds to wait between streamed chunks
+        error_rate: The fraction of requests answered with a 500
+        rate_limit_rate: The fraction of requests answered with a 429
+        retry_after: The retry-after header of a 429, None to omit it
+        requests: The number of requests received
+        status_counts: The number of responses of each status
+    """
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 latency: Callable[[], float] = constant(0.0),
+                 chunk_latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0,
+                 retry_after: Optional[float] = None) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.latency: Callable[[], float] = latency
+        self.chunk_latency: float = chunk_latency
+        self.error_rate: float = error_rate
+        self.rate_limit_rate: float = rate_limit_rate
+        self.retry_after: Optional[float] = retry_after
+        self.requests: int = 0
+        self.status_counts: Dict[int, int] = dict()
+        self.lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    def start(self) -> 'MockServer':
+        mock = self
+
+        class Handler(MockHandler):
+            server_mock = mock
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self) -> 'MockServer':
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def count(self, status: int) -> None:
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def pick_status(self) -> int:
+        with self.lock:
+            self.requests += 1
+        r = random.random()
+        if r < self.rate_limit_rate:
+            return 429
+        if r < self.rate_limit_rate + self.error_rate:
+            return 500
+        return 200
+
+
+def completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    """ The response to a request body, echoing the last message """
+
+    messages = body.get('messages') or [{'content': ''}]
+    content = messages[-1].get('content', '')
+    prompt_tokens = sum(len(_.get('content', '').split()) for _ in messages)
+    completion_tokens = len(content.split())
+    return {
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'mock'),
+        'choices': [{
+            'index': 0,
+            'message': {
+                'role': 'assistant',
+                'content': content
+            },
+            'finish_reason': 'stop'
+        } for _ in range(body.get('n') or 1)],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+    }
+
+
+def chunks(response: Dict[str, Any],
+           include_usage: bool) -> List[Dict[str, Any]]:
+    """ Split a response into the chunks of a stream """
+
+    base = {
+        'id': response['id'],
+        'object': 'chat.completion.chunk',
+        'created': response['created'],
+        'model': response['model'],
+    }
+    content = response['choices'][0]['message']['content']
+    words = content.split(' ') if content else []
+    lst = [
+        dict(base,
+             choices=[{
+                 'index': 0,
+                 'delta': {
+                     'role': 'assistant',
+                     'content': ''
+                 },
+                 'finish_reason': None
+             }])
+    ]
+    for i, word in enumerate(words):
+        lst.append(
+            dict(base,
+                 choices=[{
+                     'index': 0,
+                     'delta': {
+                         'content': word if i == 0 else ' ' + word
+                     },
+                     'finish_reason': None
+                 }]))
+    lst.append(
+        dict(base, choices=[{
+            'index': 0,
+            'delta': {},
+            'finish_reason': 'stop'
+        }]))
+    if include_usage:
+        lst.append(dict(base, choices=[], usage=response['usage']))
+    return lst
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Answer chat completion requests on behalf of a MockServer """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not let Nagle hold the
+    # body back until the client acks the headers
+    disable_nagle_algorithm = True
+    server_mock: MockServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        """ List one model, enough for health checks """
+
+        self.server_mock.count(200)
+        if not self.path.rstrip('/').endswith('/models'):
+            self.reply(404, error('not found', 'invalid_request_error'))
+            return
+        self.reply(200, {
+            'object': 'list',
+            'data': [{
+                'id': 'mock',
+                'object': 'model'
+            }]
+        })
+
+    def do_POST(self) -> None:
+        mock = self.server_mock
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.reply(404, error('not found', 'invalid_request_error'))
+            return
+        try:
+            body = json.loads(raw or b'{}')
+        except ValueError:
+            self.reply(400, error('invalid json', 'invalid_request_error'))
+            return
+
+        time.sleep(max(mock.latency(), 0.0))
+        status = mock.pick_status()
+        mock.count(status)
+        if status == 429:
+            headers = {}
+            if mock.retry_after is not None:
+                headers['retry-after'] = str(mock.retry_after)
+            self.reply(429, error('rate limit reached', 'rate_limit_error'),
+                       headers)
+            return
+        if status == 500:
+            self.reply(500, error('internal error', 'server_error'))
+            return
+
+        response = completion(body)
+        if not body.get('stream'):
+            self.reply(200, response)
+            return
+
+        include_usage = bool((body.get('stream_options') or
+                              {}).get('include_usage'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for i, chunk in enumerate(chunks(response, include_usage)):
+            if i and mock.chunk_latency:
+                time.sleep(mock.chunk_latency)
+            self.wfile.write(b'data: ' + json.dumps(chunk).encode() + b'\n\n')
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def reply(self,
+              status: int,
+              payload: Dict[str, Any],
+              headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def error(message: str, kind: str) -> Dict[str, Any]:
+    return {'error': {'message': message, 'type': kind, 'code': None}}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='median seconds before each response')
+    parser.add_argument('--sigma',
+                        type=float,
+                        default=0.0,
+                        help='log-normal spread of the latency, 0 for none')
+    parser.add_argument('--chunk-latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=None)
+    args = parser.parse_args()
+
+    latency = lognormal(args.latency, args.sigma) if args.sigma else constant(
+        args.latency)
+    mock = MockServer(args.host, args.port, latency, args.chunk_latency,
+                      args.error_rate, args.rate_limit_rate, args.retry_after)
+    mock.start()
+    print(f'serving on {mock.api_base}')
+    try:
+        assert (mock.thread is not None)
+        mock.thread.join()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""
+Runtime type checking of the public interface, an opt-in debug mode
+"""
+
+import os
+from typing import Any, Callable, TypeVar
+
+T = TypeVar('T', bound=Callable[..., Any])
+
+# set CHATMANAGER_TYPECHECK=1 before chatmanager is imported to check the
+# arguments of the decorated functions on every call
+TYPECHECK: bool = os.environ.get('CHATMANAGER_TYPECHECK', '') not in ('', '0')
+
+
+def typechecked(func: T) -> T:
+    """ typeguard.typechecked in debug mode, func as it is otherwise
+
+    typeguard is only imported in debug mode.
+    """
+
+    if not TYPECHECK:
+        return func
+    from typeguard import typechecked as check
+    return check(func)
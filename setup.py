@@ -19,6 +19,9 @@ setup(
         'tiktoken',
         'typeguard',
     ],
+    extras_require={
+        'semantic': ['numpy'],
+    },
     tests_require=[
         'pytest',
     ],
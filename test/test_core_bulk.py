@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+import pytest
+
+from chatmanager import ChatManager, ChatSetup
+from chatmanager.core.bulk import BulkJob, main
+from chatmanager.util.mock_server import MockServer
+
+
+def manager():
+    cm = ChatManager()
+    cm.add_key('key1', 'sk-xxx1')
+    return cm
+
+
+def write_input(path, num):
+    with open(path, 'w') as f:
+        for i in range(num):
+            if i % 2:
+                f.write(json.dumps({'id': f'q{i}', 'prompt': f'hello {i}'}))
+            else:
+                f.write(
+                    json.dumps({
+                        'id': f'q{i}',
+                        'messages': [{
+                            'role': 'user',
+                            'content': f'hello {i}'
+                        }]
+                    }))
+            f.write('\n')
+        f.write('not json\n')
+
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(_) for _ in f]
+
+
+class TestBulkJob:
+
+    def testA(self, monkeypatch, tmp_path):
+        src, dst = str(tmp_path / 'in.jsonl'), str(tmp_path / 'out.jsonl')
+        write_input(src, 30)
+
+        with MockServer() as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+
+            # crash after 12 results, the checkpoint is saved every 5
+            write = BulkJob.write
+
+            def crash(self, lineno, record):
+                if self.sent == 12:
+                    raise KeyboardInterrupt
+                write(self, lineno, record)
+
+            monkeypatch.setattr(BulkJob, 'write', crash)
+            job = BulkJob(manager(),
+                          src,
+                          dst,
+                          concurrency=4,
+                          checkpoint_interval=5)
+            with pytest.raises(KeyboardInterrupt):
+                job.run()
+            monkeypatch.setattr(BulkJob, 'write', write)
+            first = mock.requests
+            assert (len(read_output(dst)) == 12)
+
+            cm = manager()
+            job = BulkJob(cm, src, dst, concurrency=4, checkpoint_interval=5)
+
+            async def arun():
+                stats = await job.arun()
+                # the manager of the caller is left open
+                assert (all(
+                    not _.asession.closed for _ in cm.clients.clients.values()))
+                await cm.aclose()
+                return stats
+
+            stats = asyncio.run(arun())
+            # at most the in-flight requests after the checkpoint are resent
+            assert (stats['skipped'] >= 10)
+            assert (mock.requests - first == 30 - stats['skipped'])
+
+        records = read_output(dst)
+        assert (len(records) == 31)
+        responses = {
+            _['id']: _['response']['choices'][0]['message']['content']
+            for _ in records
+            if 'response' in _
+        }
+        assert (responses == {f'q{i}': f'hello {i}' for i in range(30)})
+        assert ([_['error']['kind'] for _ in records if 'error' in _
+                ] == ['invalid_request'])
+
+        # a finished job sends nothing
+        assert (BulkJob(manager(), src, dst).run()['sent'] == 0)
+
+    def testB(self, monkeypatch, tmp_path, capsys):
+        src, dst = str(tmp_path / 'in.jsonl'), str(tmp_path / 'out.jsonl')
+        write_input(src, 5)
+        with MockServer() as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            main([src, dst, '--key', 'k1=sk-1', '--key', 'k2=sk-2'])
+        assert (json.loads(capsys.readouterr().out) == {
+            'sent': 6,
+            'failed': 1,
+            'skipped': 0
+        })
+        assert (len(read_output(dst)) == 6)
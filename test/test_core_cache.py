@@ -0,0 +1,167 @@
+import time
+
+import openai
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.cache import (ResponseCache, MemoryCache, DiskCache,
+                                    request_key)
+
+from test_core_chat import fake_response
+
+
+class TestResponseCache:
+
+    def testA(self, monkeypatch, tmp_path):
+        calls = []
+
+        def create(api_key, api_base, **kwargs):
+            calls.append(kwargs)
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        path = str(tmp_path / 'cache.db')
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        cm.cache = ResponseCache(MemoryCache(), DiskCache(path))
+
+        msg = ChatMessage()
+        msg.push_user("hi")
+        assert (cm.send(msg).get_msg() == "hi")
+        assert (cm.send(msg).get_msg() == "hi")
+        assert (len(calls) == 1)
+        assert (len(cm.cur_session.repo) == 2)
+        assert (cm.cache.stats()['hits'] == 1)
+        assert (cm.cache.stats()['misses'] == 1)
+
+        # a different temperature is a different request
+        monkeypatch.setattr(ChatSetup, 'temperature', 0.5)
+        cm.send(msg)
+        assert (len(calls) == 2)
+        monkeypatch.setattr(ChatSetup, 'temperature', None)
+        cm.cache.close()
+
+        # the disk tier survives the process
+        cm.cache = ResponseCache(MemoryCache(), DiskCache(path))
+        assert (cm.send(msg).get_msg() == "hi")
+        assert (len(calls) == 2)
+        assert (cm.cache.stats()['disk_hits'] == 1)
+        cm.cache.close()
+
+    def testB(self, tmp_path):
+        key = request_key({'model': 'm', 'messages': [], 'request_timeout': 1})
+        assert (key == request_key({'messages': [], 'model': 'm'}))
+
+        memory = MemoryCache(max_entries=2, ttl=0.2)
+        memory.set('a', {'v': 1})
+        memory.set('b', {'v': 2})
+        memory.get('a')
+        memory.set('c', {'v': 3})
+        assert (memory.get('b') is None)
+        assert (memory.get('a') == {'v': 1})
+        time.sleep(0.3)
+        assert (memory.get('a') is None)
+
+        disk = DiskCache(str(tmp_path / 'cache.db'), max_entries=10)
+        for i in range(DiskCache.EVICT_INTERVAL):
+            disk.set(str(i), {'v': i})
+        assert (len(disk) == 10)
+        assert (disk.get(str(DiskCache.EVICT_INTERVAL - 1)) is not None)
+        disk.close()
+
+
+class TestCoalesce:
+
+    def testA(self, monkeypatch):
+        import threading
+
+        calls = []
+        release = threading.Event()
+
+        def create(api_key, api_base, **kwargs):
+            calls.append(kwargs)
+            release.wait(5)
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+
+        msg = ChatMessage()
+        msg.push_user("hi")
+
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+        responses = cm.send([msg for _ in range(10)], thread_num=10)
+        assert (len(calls) == 1)
+        assert ([r.get_msg() for r in responses] == ["hi"] * 10)
+        assert (len(cm.cur_session.repo) == 10)
+
+        # independent samples
+        cm.coalesce = False
+        calls.clear()
+        cm.send([msg for _ in range(10)], thread_num=10)
+        assert (len(calls) == 10)
+
+    def testB(self, monkeypatch):
+        import asyncio
+
+        calls = []
+
+        async def acreate(api_key, api_base, **kwargs):
+            calls.append(kwargs)
+            await asyncio.sleep(0.05)
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+
+        msgs = []
+        for i in range(20):
+            msg = ChatMessage()
+            msg.push_user(str(i % 2))
+            msgs.append(msg)
+
+        responses = asyncio.run(cm.asend(msgs))
+        assert (len(calls) == 2)
+        assert ([r.get_msg() for r in responses
+                ] == [str(i % 2) for i in range(20)])
+
+    def testC(self):
+        import asyncio
+
+        from chatmanager.core.coalesce import SingleFlight
+
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        async def main():
+            leader = asyncio.create_task(flight.ado('k', call))
+            await asyncio.sleep(0)
+            followers = [
+                asyncio.create_task(flight.ado('k', call)) for _ in range(3)
+            ]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            # the followers are not cancelled with the leader, one of them
+            # calls again and the others share its result
+            results = await asyncio.gather(*followers)
+            assert (leader.cancelled())
+            return results
+
+        results = asyncio.run(main())
+        assert (len(calls) == 2)
+        assert (sorted(shared for _, shared in results) == [False, True, True])
+        assert ({result for result, _ in results} == {2})
+        assert (flight.futures == {})
@@ -0,0 +1,290 @@
+import asyncio
+import dataclasses
+
+import openai
+import pytest
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup, ChatConfig
+
+
+def fake_response(content):
+    return {
+        "id": "chatcmpl-123",
+        "created": 1677652288,
+        "model": "gpt-3.5-turbo-0613",
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content,
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": 9,
+            "completion_tokens": 12,
+            "total_tokens": 21
+        }
+    }
+
+
+class TestAsyncSend:
+
+    def testA(self, monkeypatch):
+        in_flight = 0
+        peak = 0
+        used_keys = []
+
+        async def acreate(api_key, api_base, **kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            used_keys.append(api_key)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        cm.add_key('key2', 'sk-xxx2')
+
+        msgs = []
+        for i in range(20):
+            msg = ChatMessage()
+            msg.push_user(str(i))
+            msgs.append(msg)
+
+        responses = asyncio.run(cm.asend(msgs, concurrency=4))
+        assert ([r.get_msg() for r in responses] == [str(i) for i in range(20)])
+        assert (peak == 4)
+        assert (used_keys.count('sk-xxx1') == 10)
+        assert (used_keys.count('sk-xxx2') == 10)
+        assert (cm.cur_session is not None)
+        assert (len(cm.cur_session.repo) == 20)
+
+        response = asyncio.run(cm.asend(msgs[0]))
+        assert (response.get_msg() == '0')
+
+
+class TestKeyIsolation:
+
+    def testA(self, monkeypatch):
+        from chatmanager.core import client
+
+        sessions = {}
+
+        def create(api_key, api_base, **kwargs):
+            # the pooled session of the key is bound to the calling thread
+            sessions.setdefault(api_key, set()).add(id(client.active.session))
+            return fake_response(api_key)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai, 'api_key', None)
+        monkeypatch.setattr(openai, 'requestssession', None)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        for i in range(4):
+            cm.add_key(f'key{i}', f'sk-xxx{i}')
+
+        msg = ChatMessage()
+        msg.push_user("hi")
+        responses = cm.send([msg for _ in range(40)], thread_num=8)
+        assert (len(responses) == 40)
+        assert ({r.get_msg() for r in responses
+                } == {f'sk-xxx{i}' for i in range(4)})
+        assert (openai.api_key is None)
+        assert (all(len(_) == 1 for _ in sessions.values()))
+        assert (openai.requestssession is client.session_router())
+        assert (len(cm.clients.clients) == 4)
+
+        cm.remove_key('key0')
+        assert (len(cm.clients.clients) == 3)
+
+
+def fake_chunks(content):
+    yield {
+        "id": "chatcmpl-123",
+        "created": 1,
+        "model": "gpt-3.5-turbo-0613",
+        "choices": [{
+            "index": 0,
+            "delta": {
+                "role": "assistant"
+            }
+        }]
+    }
+    for ch in content:
+        yield {
+            "id": "chatcmpl-123",
+            "created": 1,
+            "model": "gpt-3.5-turbo-0613",
+            "choices": [{
+                "index": 0,
+                "delta": {
+                    "content": ch
+                }
+            }]
+        }
+    yield {
+        "id": "chatcmpl-123",
+        "created": 1,
+        "model": "gpt-3.5-turbo-0613",
+        "choices": [{
+            "index": 0,
+            "delta": {},
+            "finish_reason": "stop"
+        }]
+    }
+    yield {
+        "id": "chatcmpl-123",
+        "created": 1,
+        "model": "gpt-3.5-turbo-0613",
+        "choices": [],
+        "usage": {
+            "prompt_tokens": 9,
+            "completion_tokens": len(content),
+            "total_tokens": 9 + len(content)
+        }
+    }
+
+
+class TestStream:
+
+    def testA(self, monkeypatch):
+        bodies = []
+
+        def create(api_key, api_base, stream=False, **kwargs):
+            assert (stream)
+            bodies.append(kwargs)
+            return fake_chunks(kwargs['messages'][-1]['content'])
+
+        async def acreate(api_key, api_base, stream=False, **kwargs):
+            assert (stream)
+
+            async def gen():
+                for chunk in fake_chunks(kwargs['messages'][-1]['content']):
+                    yield chunk
+
+            return gen()
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+
+        msg = ChatMessage()
+        msg.push_user("hello")
+
+        # single message
+        stream = cm.send(msg, stream=True)
+        assert (list(stream) == list("hello"))
+        assert (stream.response.get_msg() == "hello")
+        assert (stream.response.token_usage() == 14)
+        assert (cm.cur_session.repo[-1][1] is stream.response)
+        assert (bodies[-1]['stream_options'] == {'include_usage': True})
+
+        # a server rejecting stream_options, usage is counted locally
+        stream = cm.send(msg,
+                         stream=True,
+                         config=ChatConfig(stream_usage=False))
+        assert (list(stream) == list("hello"))
+        assert ('stream_options' not in bodies[-1])
+        assert ('stream_usage' not in bodies[-1])
+
+        # fan-out
+        msgs = []
+        for i in range(5):
+            m = ChatMessage()
+            m.push_user(f"msg{i}")
+            msgs.append(m)
+        group = cm.send(msgs, stream=True, thread_num=3)
+        deltas = {}
+        for index, delta in group:
+            deltas[index] = deltas.get(index, '') + delta
+        assert (deltas == {i: f"msg{i}" for i in range(5)})
+        assert ([r.get_msg() for r in group.responses
+                ] == [f"msg{i}" for i in range(5)])
+
+        # async
+        async def consume():
+            stream = await cm.asend(msg, stream=True)
+            single = [_ async for _ in stream]
+            responses = [None] * 5
+            deltas = {}
+            async for index, delta in cm.astream_many(msgs, 2, responses):
+                deltas[index] = deltas.get(index, '') + delta
+            return single, deltas, responses
+
+        single, deltas, responses = asyncio.run(consume())
+        assert (single == list("hello"))
+        assert (deltas == {i: f"msg{i}" for i in range(5)})
+        assert ([r.get_msg() for r in responses
+                ] == [f"msg{i}" for i in range(5)])
+        assert (len(cm.cur_session.repo) == 13)
+
+
+class TestConfig:
+
+    def testA(self, monkeypatch):
+        bodies = []
+
+        def create(api_key, api_base, **kwargs):
+            bodies.append(dict(kwargs, api_base=api_base))
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        async def acreate(api_key, api_base, **kwargs):
+            return create(api_key, api_base, **kwargs)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+        monkeypatch.setattr(ChatSetup, 'temperature', 0.5)
+
+        config = ChatConfig(model='gpt-4', n=2, seed=7)
+        cm = ChatManager(config)
+        cm.coalesce = False
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        msg = ChatMessage()
+        msg.push_user('hi')
+
+        # the manager config over ChatSetup
+        cm.send(msg)
+        assert ({
+            _: bodies[-1].get(_) for _ in ('model', 'n', 'seed', 'temperature')
+        } == {
+            'model': 'gpt-4',
+            'n': 2,
+            'seed': 7,
+            'temperature': 0.5
+        })
+        assert (bodies[-1]['api_base'] == ChatSetup.api_base)
+        assert ('max_tokens' not in bodies[-1])
+
+        # the request config over the manager config, on both paths
+        override = ChatConfig(max_tokens=16,
+                              stop=['\n'],
+                              response_format={'type': 'json_object'},
+                              api_base='http://localhost:1/v1',
+                              extra={'logit_bias': {
+                                  '50256': -100
+                              }})
+        cm.send([msg, msg], config=override)
+        asyncio.run(cm.asend(msg, config=override))
+        for body in bodies[1:]:
+            assert (body['model'] == 'gpt-4' and body['n'] == 2)
+            assert (body['max_tokens'] == 16 and body['stop'] == ['\n'])
+            assert (body['response_format'] == {'type': 'json_object'})
+            assert (body['logit_bias'] == {'50256': -100})
+            assert (body['api_base'] == 'http://localhost:1/v1')
+        assert (len(bodies) == 4)
+        assert (cm.config == config)
+
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            config.n = 3  # type: ignore
+        assert (config.replace(n=3).n == 3 and config.n == 2)
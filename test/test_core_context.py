@@ -0,0 +1,114 @@
+import openai
+
+from chatmanager import ChatManager, ChatMessage
+from chatmanager.core.context import ContextTrimmer
+from chatmanager.util import common
+
+from test_core_chat import fake_response
+from test_util_common import FakeEncoding
+
+
+def conversation(turns):
+    msg = ChatMessage()
+    msg.push_system("be brief")
+    for i in range(turns):
+        msg.push_user(f"question {i}")
+        msg.push_assistant(f"answer {i}")
+    return msg
+
+
+class TestContextTrimmer:
+
+    def testA(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        # 6 tokens for the system prompt, 6 per turn, 3 for the reply
+        msg = conversation(10)
+        assert (msg.token_usage() == 6 + 20 * 6 + 3)
+        assert (ContextTrimmer(200).trim(msg) is msg)
+
+        trimmed = ContextTrimmer(6 + 4 * 6 + 3).trim(msg)
+        assert (trimmed.token_usage() <= 33)
+        assert (trimmed.drain()[0] == {'role': 'system', 'content': 'be brief'})
+        assert ([_['content'] for _ in trimmed.drain()[1:]
+                ] == ['question 8', 'answer 8', 'question 9', 'answer 9'])
+        # the original is left untouched
+        assert (len(msg.drain()) == 21)
+
+        # the last message is kept even if it alone exceeds the budget
+        trimmed = ContextTrimmer(5, keep_system=False).trim(msg)
+        assert (trimmed.drain() == [{
+            'role': 'assistant',
+            'content': 'answer 9'
+        }])
+
+    def testB(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        summarized = []
+
+        def summarize(messages):
+            summarized.append(messages)
+            return f"{len(messages)} messages"
+
+        trimmer = ContextTrimmer(6 + 2 * 6 + 3 + 10,
+                                 summarize=summarize,
+                                 summary_tokens=10)
+        trimmed = trimmer.trim(conversation(10))
+        assert ([_['content'] for _ in trimmed.drain()] == [
+            'be brief', 'Summary of the earlier conversation: 18 messages',
+            'question 9', 'answer 9'
+        ])
+
+        # the same dropped turns are summarized once
+        trimmer.trim(conversation(10))
+        assert (len(summarized) == 1)
+
+    def testC(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        sent = []
+
+        def create(api_key, api_base, **kwargs):
+            sent.append(kwargs['messages'])
+            return fake_response("ok")
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        cm = ChatManager()
+        cm.add_key('key1', 'sk-xxx1')
+        cm.set_session('s1')
+        cm.trimmer = ContextTrimmer(6 + 6 + 3)
+        cm.send(conversation(5))
+        assert ([_['content'] for _ in sent[0]] == ['be brief', 'answer 4'])
+        assert (cm.cur_session.repo[0][0].drain() == sent[0])
+
+    def testD(self, monkeypatch):
+        from chatmanager.config import ChatConfig
+
+        encoding = FakeEncoding()
+        models = []
+
+        def get_encoding(model):
+            models.append(model)
+            return encoding
+
+        monkeypatch.setattr(common, 'get_encoding', get_encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+        monkeypatch.setattr(
+            openai.ChatCompletion, 'create',
+            lambda api_key, api_base, **kwargs: fake_response("ok"))
+
+        # the trimming budget is counted with the model of the request
+        cm = ChatManager(ChatConfig(model='gpt-3.5-turbo-0613'))
+        cm.add_key('key1', 'sk-xxx1')
+        cm.set_session('s1')
+        cm.trimmer = ContextTrimmer(6 + 6 + 3)
+        cm.send(conversation(5), config=ChatConfig(model='gpt-4-0613'))
+        assert (models and set(models) == {'gpt-4-0613'})
@@ -40,3 +40,80 @@ class TestKeyStrategy:
         assert (k := cm.keys.get_key())
         name = cm.keys.get_key_name(k)
         assert (name == 'key1')
+
+
+class TestRateLimit:
+
+    def testA(self):
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1', rpm=2)
+        cm.add_key('key2', 'sk-xxx2', rpm=60, tpm=600)
+        cm.set_key_strategy('rate-limit')
+
+        # key2 has more headroom, then key1 once key2 is below 1/2
+        names = [cm.keys.get_key_name(cm.keys.get_key()) for _ in range(3)]
+        assert (names.count('key2') >= 2)
+
+        # tokens are reserved from the tpm bucket
+        name, wait = cm.keys.reserve(500)
+        assert (name is not None and wait == 0)
+        cm.keys.report_usage('key2', 500, 100)
+        assert (cm.keys.limits['key2'].tokens.tokens > 400)
+
+        # a 429 rests the key for Retry-After seconds
+        class RateLimitError(Exception):
+            http_status = 429
+            headers = {'retry-after': '30'}
+
+        cm.keys.report_error('key2', RateLimitError())
+        cm.keys.report_error('key1', RateLimitError())
+        name, wait = cm.keys.reserve(1)
+        assert (name is None)
+        assert (29 < wait <= 30)
+
+    def testB(self):
+        cm = ChatManager()
+        cm.add_key('key1', 'sk-xxx1', rpm=600)
+        cm.set_key_strategy('rate-limit')
+
+        # drain the bucket, the next call waits for the refill (0.1s)
+        cm.keys.limits['key1'].requests.tokens = 0
+        start = time.monotonic()
+        assert (cm.keys.get_key() == 'sk-xxx1')
+        assert (time.monotonic() - start >= 0.09)
+
+
+class TestConcurrentKey:
+
+    def testA(self):
+        from concurrent import futures
+
+        cm = ChatManager()
+        for i in range(50):
+            cm.add_key(f'key{i}', f'sk-xxx{i}')
+
+        for strategy in ['roll-polling', 'least-used', 'random', 'rest-time']:
+            cm.keys.set_strategy(strategy)
+            before = sum(cm.keys.use_cnt.values())
+            with futures.ThreadPoolExecutor(8) as executor:
+                keys = list(
+                    executor.map(lambda _: cm.keys.get_key(), range(1000)))
+            assert (all(keys))
+            assert (sum(cm.keys.use_cnt.values()) - before == 1000)
+
+        # least-used keeps the counts balanced
+        cm = ChatManager()
+        for i in range(50):
+            cm.add_key(f'key{i}', f'sk-xxx{i}')
+        cm.keys.set_strategy('least-used')
+        cm.keys.get_key('key7')
+        with futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: cm.keys.get_key(), range(500)))
+        counts = cm.keys.use_cnt.values()
+        assert (max(counts) - min(counts) <= 1)
+
+        assert (cm.keys.get_key_name('sk-xxx3') == 'key3')
+        cm.keys.remove_key('key3')
+        assert (cm.keys.get_key_name('sk-xxx3') is None)
+        assert (not cm.keys.key_value_exist('sk-xxx3'))
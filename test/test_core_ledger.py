@@ -0,0 +1,148 @@
+import asyncio
+import gc
+
+import openai
+import pytest
+
+from chatmanager import ChatManager, ChatMessage
+from chatmanager.core.ledger import Ledger, Reservation
+from chatmanager.core.retry import ChatError
+from chatmanager.util import common
+
+from test_core_chat import fake_response, fake_chunks
+from test_util_common import FakeEncoding
+
+
+class TestLedger:
+
+    def testA(self, monkeypatch, tmp_path):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        calls = []
+
+        def create(api_key, api_base, **kwargs):
+            calls.append(api_key)
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        async def acreate(api_key, api_base, **kwargs):
+            return create(api_key, api_base, **kwargs)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        path = str(tmp_path / 'ledger.json')
+        ledger = Ledger(prices={'gpt-3.5': (1.0, 2.0)},
+                        expected_completion=10,
+                        path=path,
+                        snapshot_interval=0)
+        # each request is estimated at 8 + 10 tokens and uses 9 + 12
+        ledger.set_budget(hard=50)
+        cm = ChatManager()
+        cm.coalesce = False
+        cm.ledger = ledger
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        msg = ChatMessage()
+        msg.push_user("hi")
+
+        assert (cm.send(msg) and cm.send(msg))
+        error = cm.send(msg)
+        assert (isinstance(error, ChatError) and error.kind == 'budget')
+        error = asyncio.run(cm.asend(msg))
+        assert (isinstance(error, ChatError) and error.kind == 'budget')
+        assert (len(calls) == 2)
+
+        snapshot = ledger.snapshot()
+        assert (snapshot['total']['prompt_tokens'] == 18)
+        assert (snapshot['total']['completion_tokens'] == 24)
+        assert (abs(snapshot['total']['cost'] - 2 * 0.033) < 1e-9)
+        assert (snapshot['keys']['key1']['requests'] == 2)
+        assert (snapshot['sessions']['s1']['requests'] == 2)
+        assert (snapshot['models']['gpt-3.5-turbo']['requests'] == 2)
+        assert (ledger.total.reserved_tokens == 0)
+
+        # the usage survives a restart
+        restarted = Ledger(path=path)
+        assert (restarted.snapshot() == snapshot)
+
+        # a soft budget throttles, a session budget only limits its session
+        restarted.throttle = 0.5
+        restarted.set_budget(soft=40)
+        restarted.set_budget(hard=10, session='s2')
+        held = restarted.reserve('s1', 'gpt-3.5-turbo', 8)
+        assert (isinstance(held, Reservation) and held.delay == 0.5)
+        assert (restarted.reserve('s2', 'gpt-3.5-turbo', 8).kind == 'budget')
+        restarted.settle(held, 'key1', None)
+        assert (restarted.total.reserved_tokens == 0)
+        assert (restarted.total.requests == 2)
+
+    def testB(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        def create(api_key, api_base, stream=False, **kwargs):
+            return fake_chunks(kwargs['messages'][-1]['content'])
+
+        async def acreate(api_key, api_base, stream=False, **kwargs):
+            if not stream:
+                await asyncio.sleep(10)
+
+            async def gen():
+                for chunk in fake_chunks(kwargs['messages'][-1]['content']):
+                    await asyncio.sleep(0.01)
+                    yield chunk
+
+            return gen()
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        ledger = Ledger()
+        ledger.set_budget(hard=1000)
+        cm = ChatManager()
+        cm.coalesce = False
+        cm.ledger = ledger
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        cm.keys.set_limit('key1', tpm=6000)
+        bucket = cm.keys.limits['key1'].tokens
+        msg = ChatMessage()
+        msg.push_user("hello")
+
+        # a cancelled request releases the ledger and the key quota
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(cm.asend(msg), 0.05))
+        assert (ledger.total.reserved_tokens == 0)
+        assert (bucket.tokens > 5000)
+
+        # so does an abandoned stream, closed or garbage collected
+        stream = cm.send(msg, stream=True)
+        assert (next(stream) == 'h' and ledger.total.reserved_tokens > 0)
+        stream.close()
+        assert (ledger.total.reserved_tokens == 0)
+        assert (stream.error.kind == 'cancelled')
+        assert (cm.cur_session.repo[-1][1] is None)
+        stream = cm.send(msg, stream=True)
+        next(stream)
+        del stream
+        gc.collect()
+        assert (ledger.total.reserved_tokens == 0)
+
+        # and a stream cut off by closing stream_many
+        async def consume():
+            msgs = [msg] * 4
+            deltas = cm.astream_many(msgs, 2)
+            assert (await deltas.__anext__())
+            await deltas.aclose()
+            await asyncio.sleep(0)
+            await cm.clients.aclose()
+
+        asyncio.run(consume())
+        assert (ledger.total.reserved_tokens == 0)
+        assert (ledger.total.requests == 0)
+        assert (cm.send(msg, stream=True).collect().get_msg() == "hello")
+        assert (ledger.total.requests == 1)
+        assert ('total budget' in ledger.reserve('s1', 'gpt-3.5', 2000).message)
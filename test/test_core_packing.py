@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import openai
+
+from chatmanager import ChatManager, ChatMessage, ChatResponse, ChatConfig
+from chatmanager.core.packing import PromptPacker, apportion
+from chatmanager.util import common
+
+from test_core_chat import fake_response
+from test_util_common import FakeEncoding
+
+
+def prompts(n):
+    msgs = []
+    for i in range(n):
+        msg = ChatMessage()
+        msg.push_user(f"label {i}")
+        msgs.append(msg)
+    return msgs
+
+
+class TestPromptPacker:
+
+    def testA(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        packer = PromptPacker(max_tokens=1000, max_prompts=4)
+        assert (packer.pack(prompts(10)) == [[0, 1, 2, 3], [4, 5, 6, 7], [8,
+                                                                          9]])
+        # the instruction alone takes most of a small budget
+        packer = PromptPacker(max_tokens=50, max_prompts=4)
+        assert (all(len(_) == 1 for _ in packer.pack(prompts(3))))
+
+        packed = packer.combine(prompts(2))
+        assert (json.loads(
+            packed.drain()[-1]['content']) == ['label 0', 'label 1'])
+        response = fake_response('```json\n["a", {"b": 1}]\n```')
+        split = packer.split(ChatResponse(response), prompts(2))
+        assert ([_.get_msg() for _ in split] == ['a', '{"b": 1}'])
+        assert (sum(_.prompt_tokens for _ in split) == 9)
+        assert (sum(_.completion_tokens for _ in split) == 12)
+        assert (packer.split(ChatResponse(fake_response('["a"]')), prompts(2))
+                is None)
+
+        assert (apportion(10, [1, 1, 1]) == [3, 3, 4])
+        assert (apportion(5, [0, 0]) == [2, 3])
+
+
+class TestPackedSend:
+
+    def testA(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        sizes = []
+        bodies = []
+        garbled = False
+
+        def create(api_key, api_base, **kwargs):
+            bodies.append(kwargs)
+            content = kwargs['messages'][-1]['content']
+            if len(kwargs['messages']) == 1:
+                return fake_response(content.upper())
+            items = json.loads(content)
+            sizes.append(len(items))
+            if garbled:
+                return fake_response("sorry")
+            return fake_response(json.dumps([_.upper() for _ in items]))
+
+        async def acreate(api_key, api_base, **kwargs):
+            return create(api_key, api_base, **kwargs)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+        cm = ChatManager()
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        cm.packer = PromptPacker(max_prompts=8)
+
+        msgs = prompts(20)
+        expected = [f"LABEL {i}" for i in range(20)]
+        responses = cm.send(msgs, thread_num=3)
+        assert ([_.get_msg() for _ in responses] == expected)
+        assert (sorted(sizes) == [4, 8, 8])
+        # each prompt is saved with its own answer
+        assert ([(m.drain()[0]['content'], r.get_msg())
+                 for m, r in cm.cur_session.repo
+                ] == [(f"label {i}", f"LABEL {i}") for i in range(20)])
+
+        responses = asyncio.run(cm.asend(msgs, concurrency=2))
+        assert ([_.get_msg() for _ in responses] == expected)
+        assert (len(sizes) == 6)
+
+        # an answer that cannot be split falls back to single requests
+        garbled = True
+        responses = cm.send(msgs[:5])
+        assert ([_.get_msg() for _ in responses] == expected[:5])
+        assert (sizes[-1] == 5)
+        assert (len(cm.cur_session.repo) == 45)
+
+        # the parameters sized for one prompt are scaled to the pack
+        garbled = False
+        bodies.clear()
+        config = ChatConfig(max_tokens=16,
+                            n=3,
+                            response_format={'type': 'json_object'})
+        cm.send(msgs[:4], config=config)
+        assert (len(bodies) == 1)
+        assert (bodies[0]['max_tokens'] == 64 and bodies[0]['n'] == 1)
+        assert ('response_format' not in bodies[0])
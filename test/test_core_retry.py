@@ -0,0 +1,119 @@
+import openai
+
+from chatmanager import ChatManager, ChatMessage
+from chatmanager.core.retry import ChatError, CircuitBreaker, RetryPolicy
+
+from test_core_chat import fake_response
+
+
+def make_manager(key_num):
+    cm = ChatManager()
+    cm.set_session('s1')
+    for i in range(key_num):
+        cm.add_key(f'key{i}', f'sk-xxx{i}')
+    cm.retry = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.05)
+    return cm
+
+
+def make_msg():
+    msg = ChatMessage()
+    msg.push_user("hi")
+    return msg
+
+
+class TestRetry:
+
+    def testA(self, monkeypatch):
+        """ a revoked key fails over to another key """
+
+        def create(api_key, api_base, **kwargs):
+            if api_key == 'sk-xxx0':
+                raise openai.error.AuthenticationError("invalid key",
+                                                       http_status=401)
+            return fake_response(api_key)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        cm = make_manager(2)
+
+        responses = cm.send([make_msg() for _ in range(4)], thread_num=1)
+        assert ([r.get_msg() for r in responses] == ['sk-xxx1'] * 4)
+        assert ('key0' in cm.keys.suspended)
+        assert (all(r is not None for _, r in cm.cur_session.repo))
+
+    def testB(self, monkeypatch):
+        """ transient errors are retried, invalid requests are not """
+
+        calls = []
+
+        def create(api_key, api_base, **kwargs):
+            calls.append(api_key)
+            content = kwargs['messages'][-1]['content']
+            if content == 'bad':
+                raise openai.error.InvalidRequestError("bad request",
+                                                       None,
+                                                       http_status=400)
+            if len(calls) < 3:
+                raise openai.error.RateLimitError(
+                    "slow down",
+                    http_status=429,
+                    headers={'retry-after-ms': '10'})
+            return fake_response(content)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        cm = make_manager(1)
+
+        response = cm.send(make_msg())
+        assert (response.get_msg() == 'hi')
+        assert (len(calls) == 3)
+
+        msg = ChatMessage()
+        msg.push_user('bad')
+        response = cm.send(msg)
+        assert (isinstance(response, ChatError))
+        assert (not response)
+        assert (response.kind == 'invalid_request')
+        assert (response.http_status == 400)
+        assert (response.attempts == 1)
+        assert (cm.cur_session.repo[-1][1] is None)
+
+    def testC(self, monkeypatch):
+        """ a failing api_base is taken out of rotation """
+
+        def create(api_key, api_base, **kwargs):
+            raise openai.error.APIError("boom", http_status=502)
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+        cm = make_manager(2)
+        cm.breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+
+        response = cm.send(make_msg())
+        assert (response.kind == 'server' and response.attempts == 3)
+        response = cm.send(make_msg())
+        assert (response.kind == 'circuit_open')
+        assert (response.attempts == 0)
+
+    def testD(self, monkeypatch):
+        """ no key left is a ChatError, also under python -O """
+
+        cm = make_manager(1)
+        monkeypatch.setattr(cm.keys, 'get_key', lambda **kwargs: None)
+
+        response = cm.send(make_msg())
+        assert (isinstance(response, ChatError) and response.kind == 'no_key')
+        assert (response.attempts == 0)
+
+
+class TestPolicy:
+
+    def testA(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=4)
+        error = openai.error.ServiceUnavailableError("down", http_status=503)
+        for attempt in range(1, 5):
+            delay = policy.delay(attempt, error)
+            assert (0 <= delay <= min(4, 2**(attempt - 1)))
+        assert (policy.delay(5, error) is None)
+
+        error = openai.error.RateLimitError("slow down",
+                                            http_status=429,
+                                            headers={'retry-after': '3'})
+        assert (policy.delay(1, error) == 3)
@@ -0,0 +1,93 @@
+import contextlib
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.retry import RetryPolicy
+from chatmanager.core.router import Router
+from chatmanager.util.mock_server import MockServer, constant
+
+
+def messages(num):
+    msgs = []
+    for i in range(num):
+        msg = ChatMessage()
+        msg.push_user(f"hello {i}")
+        msgs.append(msg)
+    return msgs
+
+
+def manager(router):
+    cm = ChatManager()
+    cm.coalesce = False
+    cm.retry = RetryPolicy(max_attempts=10, base_delay=0.01)
+    cm.router = router
+    cm.set_session('s1')
+    return cm
+
+
+class TestRouter:
+
+    def testA(self):
+        with MockServer(latency=constant(0.005)) as fast, MockServer(
+                latency=constant(0.1)) as slow:
+            router = Router()
+            router.add_endpoint('fast', fast.api_base,
+                                {ChatSetup.model: 'local-model'})
+            router.add_endpoint('slow', slow.api_base)
+            router.add_key('fast', 'key1', 'sk-1')
+            router.add_key('slow', 'key2', 'sk-2')
+            cm = manager(router)
+
+            responses = cm.send(messages(60), thread_num=4)
+            assert (all(responses))
+            # the latency EWMA steers most of the traffic to the fast one
+            assert (fast.requests > 3 * slow.requests)
+            assert ({_.model for _ in responses}
+                    <= {'local-model', ChatSetup.model})
+            assert (router.endpoints['fast'].latency
+                    < router.endpoints['slow'].latency)
+            assert (router.endpoints['fast'].inflight == 0)
+            cm.clients.close()
+
+    def testB(self):
+        with MockServer() as good, MockServer(error_rate=1.0) as bad:
+            router = Router(threshold=3, eject_time=60)
+            router.add_endpoint('good', good.api_base)
+            router.add_endpoint('bad', bad.api_base)
+            router.add_key('good', 'key1', 'sk-1')
+            router.add_key('bad', 'key2', 'sk-2')
+            cm = manager(router)
+
+            responses = cm.send(messages(30), thread_num=2)
+            assert (all(responses))
+            # the bad endpoint is ejected and then left alone
+            assert (router.endpoints['bad'].ejected_until > 0)
+            assert (bad.requests <= 6)
+
+            # a passing health check puts it back on probation
+            router.check(lambda endpoint: True)
+            assert (router.endpoints['bad'].ejected_until == 0)
+            assert (router.endpoints['bad'].probation)
+            assert (router.probe(router.endpoints['good']))
+            bad.stop()
+            assert (not router.probe(router.endpoints['bad']))
+            cm.clients.close()
+
+    def testC(self):
+        import asyncio
+
+        with MockServer(latency=constant(1.0)) as slow:
+            router = Router()
+            router.add_endpoint('slow', slow.api_base)
+            router.add_key('slow', 'key1', 'sk-1')
+            cm = manager(router)
+
+            async def main():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(cm.asend(messages(1)[0]), 0.2)
+                await cm.aclose()
+
+            asyncio.run(main())
+            # a cancelled request is not left counted in flight
+            assert (router.endpoints['slow'].inflight == 0)
+            assert (router.endpoints['slow'].latency is None)
+            cm.clients.close()
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.scheduler import Scheduler, Waiter
+from chatmanager.util.mock_server import MockServer, constant
+
+
+def queue(scheduler, order, name, tenant, tag):
+    with scheduler.lock:
+        scheduler.enqueue(name, tenant, Waiter(lambda: order.append(tag)))
+
+
+class TestScheduler:
+
+    def testA(self):
+        scheduler = Scheduler(capacity=1)
+        scheduler.add_class('interactive', priority=10)
+        scheduler.add_class('bulk', priority=0)
+        scheduler.acquire('bulk')
+
+        order = []
+        for i in range(3):
+            queue(scheduler, order, 'bulk', 'batch', f'b{i}')
+        queue(scheduler, order, 'interactive', 'user', 'i0')
+        # each release hands the slot to the next waiter
+        for name in ['bulk', 'interactive', 'bulk', 'bulk']:
+            scheduler.release(name)
+        assert (order == ['i0', 'b0', 'b1', 'b2'])
+
+    def testB(self):
+        scheduler = Scheduler(capacity=1)
+        scheduler.set_weight('a', 3)
+        scheduler.acquire()
+
+        order = []
+        for i in range(8):
+            queue(scheduler, order, 'default', 'a', 'a')
+            queue(scheduler, order, 'default', 'b', 'b')
+        for _ in range(16):
+            scheduler.release()
+        # a gets 3 slots for every slot of b until it runs out
+        assert (order[:8].count('a') == 6)
+        assert (sorted(order) == ['a'] * 8 + ['b'] * 8)
+
+    def testC(self):
+        scheduler = Scheduler(capacity=4)
+        scheduler.add_class('bulk', concurrency=2)
+        peak = [0]
+
+        def work():
+            with scheduler.slot('bulk', 'batch'):
+                peak[0] = max(peak[0], scheduler.classes['bulk'].running)
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for _ in threads:
+            _.start()
+        for _ in threads:
+            _.join()
+        assert (peak[0] == 2)
+        assert (scheduler.stats()['bulk'] == {'running': 0, 'waiting': 0})
+
+        async def run():
+            scheduler.acquire('bulk')
+            scheduler.acquire('bulk')
+            task = asyncio.create_task(scheduler.aacquire('bulk'))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            scheduler.release('bulk')
+            async with scheduler.aslot('bulk'):
+                assert (scheduler.classes['bulk'].running == 2)
+
+        asyncio.run(run())
+        assert (scheduler.running == 1)
+
+    def testD(self, monkeypatch):
+        with MockServer(latency=constant(0.05)) as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = ChatManager()
+            cm.coalesce = False
+            cm.add_key('key1', 'sk-xxx1')
+            cm.set_session('main')
+            cm.scheduler = Scheduler(capacity=4)
+            cm.scheduler.add_class('interactive', priority=10)
+            cm.scheduler.add_class('bulk', concurrency=3)
+
+            msgs = []
+            for i in range(60):
+                msg = ChatMessage()
+                msg.push_user(f"bulk {i}")
+                msgs.append(msg)
+            bulk = threading.Thread(target=cm.send,
+                                    args=(msgs, 32),
+                                    kwargs={
+                                        'session': 'batch',
+                                        'priority': 'bulk'
+                                    })
+            bulk.start()
+            time.sleep(0.1)
+
+            latencies = []
+            for i in range(5):
+                msg = ChatMessage()
+                msg.push_user(f"interactive {i}")
+                start = time.perf_counter()
+                cm.send(msg, priority='interactive')
+                latencies.append(time.perf_counter() - start)
+            bulk.join()
+
+            # the bulk job never holds the slot kept for interactive traffic
+            assert (max(latencies) < 0.5)
+            assert (len(cm.get_session('batch').repo) == 60)
+            cm.clients.close()
@@ -0,0 +1,152 @@
+import time
+
+import openai
+
+from chatmanager import ChatManager, ChatMessage, ChatConfig
+from chatmanager.core import semantic
+from chatmanager.core.semantic import SemanticCache, HashingEmbedder
+
+from test_core_chat import fake_response
+
+
+def body(content, system=None, model='m'):
+    messages = [{'role': 'system', 'content': system}] if system else []
+    return {
+        'model': model,
+        'messages': messages + [{
+            'role': 'user',
+            'content': content
+        }]
+    }
+
+
+class TestSemanticCache:
+
+    def testA(self, monkeypatch):
+        calls = []
+
+        def create(api_key, api_base, **kwargs):
+            calls.append(kwargs)
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        cm = ChatManager()
+        cm.coalesce = False
+        cm.set_session('s1')
+        cm.add_key('key1', 'sk-xxx1')
+        cm.semantic_cache = SemanticCache(HashingEmbedder(), threshold=0.9)
+
+        def send(content, config=None):
+            msg = ChatMessage()
+            msg.push_user(content)
+            return cm.send(msg, config=config)
+
+        assert (send("What is the capital of France?").get_msg() ==
+                "What is the capital of France?")
+        # a near duplicate gets the stored answer
+        assert (send("what is the capital of france").get_msg() ==
+                "What is the capital of France?")
+        assert (len(calls) == 1)
+        assert (len(cm.cur_session.repo) == 2)
+        assert (cm.cur_session.repo[-1][0].drain()[-1]['content'] ==
+                "what is the capital of france")
+
+        # not similar enough, or not the same request otherwise
+        send("What is the capital of Spain?")
+        send("What is the capital of France?", ChatConfig(temperature=0.5))
+        assert (len(calls) == 3)
+        assert (cm.semantic_cache.stats() == {
+            'hits': 1,
+            'misses': 3,
+            'entries': 3
+        })
+
+    def testB(self, tmp_path):
+        # a pluggable embedder, by topic
+        topics = ['weather', 'sport', 'music']
+
+        def embed(text):
+            return [1.0 if _ in text else 0.0 for _ in topics]
+
+        for use_numpy in (False, True):
+            cache = SemanticCache(embed,
+                                  threshold=0.99,
+                                  max_entries=2,
+                                  use_numpy=use_numpy)
+            cache.set(body('weather today'), {'v': 1})
+            cache.set(body('sport news'), {'v': 2})
+            assert (cache.get(body('the weather tomorrow')) == {'v': 1})
+            assert (cache.get(body('weather today', system='s')) is None)
+            assert (cache.get(body('weather today', model='n')) is None)
+
+            # sport is the least recently used
+            cache.set(body('music'), {'v': 3})
+            assert (len(cache) == 2)
+            assert (cache.get(body('sport')) is None)
+            assert (cache.get(body('weather')) == {'v': 1})
+
+            # only a final user turn with text is cached
+            request = body('weather')
+            request['messages'].append({'role': 'assistant', 'content': 'x'})
+            cache.set(request, {'v': 4})
+            assert (cache.get(request) is None)
+
+            path = str(tmp_path / f'semantic{use_numpy}')
+            cache.save(path)
+            for mmap in (False, True):
+                loaded = SemanticCache(embed,
+                                       threshold=0.99,
+                                       max_entries=2,
+                                       path=path,
+                                       mmap=mmap,
+                                       use_numpy=use_numpy)
+                assert (len(loaded) == 2)
+                assert (loaded.get(body('music')) == {'v': 3})
+                assert (loaded.get(body('weather')) == {'v': 1})
+                # the loaded rows are reused and grown past
+                loaded.set(body('sport'), {'v': 2})
+                assert (loaded.get(body('sport')) == {'v': 2})
+                assert (loaded.get(body('music')) is None)
+
+        cache = SemanticCache(embed, threshold=0.99, ttl=0.1)
+        cache.set(body('weather'), {'v': 1})
+        time.sleep(0.2)
+        assert (cache.get(body('weather')) is None)
+        assert (len(cache) == 0)
+        cache.set(body('sport'), {'v': 2})
+        assert (len(cache.free) == 0)
+
+    def testC(self, monkeypatch, tmp_path):
+        import shutil
+
+        topics = ['weather', 'sport']
+
+        def embed(text):
+            return [1.0 if _ in text else 0.0 for _ in topics]
+
+        path = str(tmp_path / 'semantic')
+        cache = SemanticCache(embed, threshold=0.99, path=path)
+        cache.set(body('weather'), {'v': 1})
+        cache.set(body('sport'), {'v': 2})
+        cache.save()
+        shutil.copy(path + '.json', path + '.json.old')
+
+        # a crash after the vectors of the next save are replaced
+        cache.get(body('weather'))
+        cache.save()
+        shutil.copy(path + '.json.old', path + '.json')
+        loaded = SemanticCache(embed, threshold=0.99, path=path)
+        assert (len(loaded) == 0)
+        assert (loaded.get(body('weather')) is None)
+
+        # an intact file is not hashed on load, unless verify is set
+        hashed = []
+        digest = semantic.file_digest
+        monkeypatch.setattr(semantic, 'file_digest',
+                            lambda _: hashed.append(_) or digest(_))
+        cache.save()
+        hashed.clear()
+        assert (len(SemanticCache(embed, path=path)) == 2 and not hashed)
+        assert (len(SemanticCache(embed, path=path, verify=True)) == 2)
+        assert (hashed == [path + '.f32'])
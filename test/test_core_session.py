@@ -0,0 +1,237 @@
+import io
+import json
+import pickle
+
+import openai
+
+from chatmanager import ChatManager, ChatMessage
+from chatmanager.core.session import Session, SessionStore, ChatResponse
+
+from chatmanager.util import common
+
+from test_core_chat import fake_response
+from test_util_common import FakeEncoding
+
+
+class TestSessionStore:
+
+    def testA(self, monkeypatch, tmp_path):
+
+        def create(api_key, api_base, **kwargs):
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        path = str(tmp_path / 'session.jsonl')
+        cm = ChatManager()
+        cm.add_key('key1', 'sk-xxx1')
+        cm.set_session('s1', SessionStore(path), window=2)
+
+        for i in range(5):
+            msg = ChatMessage()
+            msg.push_user(str(i))
+            cm.send(msg)
+        cm.cur_session.push(ChatMessage(), None)
+
+        # only the window is in memory, the store has the full history
+        assert (len(cm.cur_session.repo) == 2)
+        with open(path) as f:
+            lines = f.readlines()
+        assert (len(lines) == 6)
+
+        exported = json.loads(
+            cm.cur_session.export(lambda m, r: r.get_msg() if r else None))
+        assert (exported == ['0', '1', '2', '3', '4', None])
+
+        f = io.StringIO()
+        assert (cm.cur_session.export_to(f, lambda m, r: m.drain()) == 6)
+        assert (json.loads(f.getvalue().splitlines()[3]) == [{
+            'role': 'user',
+            'content': '3'
+        }])
+
+        session = Session.load('s1', SessionStore(path), window=3)
+        assert ([r.get_msg() if r else None for _, r in session.repo
+                ] == ['3', '4', None])
+
+    def testB(self, tmp_path):
+        path = str(tmp_path / 'session.jsonl.gz')
+        store = SessionStore(path, flush_interval=10)
+        assert (store.compress)
+        session = Session('s1', store)
+        for i in range(3):
+            msg = ChatMessage()
+            msg.push_user(str(i))
+            session.push(msg, None)
+        store.close()
+
+        session = Session.load('s1', SessionStore(path))
+        assert ([m.drain()[0]['content'] for m, _ in session.repo
+                ] == ['0', '1', '2'])
+
+
+class TestSessionRegistry:
+
+    def testA(self, monkeypatch):
+
+        def create(api_key, api_base, **kwargs):
+            return fake_response(kwargs['messages'][-1]['content'])
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', create)
+
+        cm = ChatManager()
+        cm.add_key('key1', 'sk-xxx1')
+        cm.coalesce = False
+        for i in range(1000):
+            cm.set_session(f'user{i}')
+        cm.set_session('main')
+        assert (len(cm.sessions) == 1001)
+        assert (cm.get_session('user500').name == 'user500')
+
+        msgs = []
+        for i in range(20):
+            msg = ChatMessage()
+            msg.push_user(str(i))
+            msgs.append(msg)
+
+        # each batch goes to its own session, cur_session is left alone
+        cm.send(msgs[:10], thread_num=8, session='user1')
+        cm.send(msgs[10:], thread_num=8, session=cm.get_session('user2'))
+        cm.send(msgs[0], session='new')
+        assert (len(cm.get_session('user1').repo) == 10)
+        assert (len(cm.get_session('user2').repo) == 10)
+        assert (len(cm.get_session('new').repo) == 1)
+        assert (len(cm.cur_session.repo) == 0)
+
+        # concurrent pushes into the shared current session
+        cm.send(msgs * 10, thread_num=16)
+        assert (len(cm.cur_session.repo) == 200)
+
+
+class TestChatResponse:
+
+    def testA(self):
+        payload = fake_response("hello")
+        response = ChatResponse(payload)
+        assert (not hasattr(response, '__dict__'))
+        assert (response.extra is None)
+        assert (response.response == payload)
+        assert (response.get_msg() == "hello" and response.get_msg(1) is None)
+        assert (response.choice_num() == 1)
+        assert (response.token_usage() == payload['usage']['total_tokens'])
+        assert (response.token_usage('prompt_tokens') == 9)
+        assert (response.get_choice(0) == payload['choices'][0])
+
+    def testB(self):
+        payload = fake_response(None)
+        payload['system_fingerprint'] = 'fp_1'
+        payload['choices'][0]['message']['tool_calls'] = [{
+            'id': 'call_1',
+            'type': 'function',
+            'function': {
+                'name': 'f',
+                'arguments': '{}'
+            }
+        }]
+        payload['choices'][0]['logprobs'] = None
+        response = ChatResponse(payload)
+        # the fields not kept in slots survive the round trip, null ones
+        # are dropped
+        del payload['choices'][0]['logprobs']
+        assert (response.response == payload)
+        assert (response.get_msg() is None)
+
+    def testC(self):
+        from chatmanager.util.mock_server import completion
+
+        payload = completion({
+            'model': 'gpt-3.5-turbo',
+            'messages': [{
+                'role': 'user',
+                'content': 'hi'
+            }],
+            'n': 2
+        })
+        payload['system_fingerprint'] = 'fp_1'
+        for choice in payload['choices']:
+            choice['logprobs'] = None
+            choice['message']['refusal'] = None
+        response = ChatResponse(payload)
+        # a realistic completion keeps nothing aside
+        assert (response.extra is None)
+        assert (response.response['object'] == 'chat.completion')
+        assert (response.response['system_fingerprint'] == 'fp_1')
+        assert (response.get_msg(1) == 'hi')
+
+
+class TestChatMessage:
+
+    def testA(self, monkeypatch, tmp_path):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        # a follow-up only stores its new messages
+        msg = ChatMessage()
+        msg.push_system("be brief")
+        turns = [msg]
+        for i in range(50):
+            msg = msg.fork()
+            msg.push_user(f"question {i}")
+            msg.push_assistant(f"answer {i}")
+            turns.append(msg)
+        nodes = set()
+        for turn in turns:
+            node = turn.tail
+            while node is not None:
+                nodes.add(id(node))
+                node = node.parent
+        assert (len(nodes) == 101)
+        assert (len(msg.drain()) == 101)
+        assert (turns[1].drain() == msg.drain()[:3])
+
+        # the tokens of a shared prefix are counted once
+        assert (turns[25].token_usage() == 6 + 50 * 6 + 3)
+        encoding.encoded.clear()
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+        assert (msg.token_usage() == 6 + 100 * 6 + 3)
+        # the 50 new messages and their two roles
+        assert (len(encoding.encoded) == 50 + 2)
+        assert ('question 0' not in encoding.encoded)
+
+        # editing a message leaves the ones sharing its history untouched
+        follow = ChatMessage(turns[1])
+        follow.set_repo(0, {"role": "system", "content": "be verbose"})
+        follow.del_msg(lambda _: _['role'] == 'assistant')
+        assert (follow.drain() == [{
+            "role": "system",
+            "content": "be verbose"
+        }, {
+            "role": "user",
+            "content": "question 0"
+        }])
+        assert (turns[1].drain()[0]['content'] == "be brief")
+        # repo is the drained list, an in-place change updates the chain
+        assert (follow.repo is follow.drain())
+        follow.repo.append({"role": "assistant", "content": "answer 0"})
+        follow.repo[0] = {"role": "system", "content": "be brief"}
+        assert (follow.token_usage() == turns[1].token_usage())
+        assert (ChatMessage(follow).drain() == turns[1].drain())
+        follow.repo = [{"role": "user", "content": "kept"}]
+        assert (follow.repo == [{"role": "user", "content": "kept"}])
+        checked = []
+        turns[3].fork().del_msg(lambda _: checked.append(_) or False)
+        assert (checked == turns[3].drain())
+        copied = ChatMessage()
+        copied.push_msg(turns[2])
+        assert (copied.tail is turns[2].tail)
+        assert (pickle.loads(pickle.dumps(msg)).drain() == msg.drain())
+
+        # a reloaded conversation shares its prefixes again
+        store = SessionStore(str(tmp_path / 's.jsonl'))
+        for turn in turns:
+            store.append(turn, None)
+        loaded = [_ for _, _r in store]
+        assert ([_.drain() for _ in loaded] == [_.drain() for _ in turns])
+        assert (loaded[-1].node_at(3) is loaded[1].tail)
+        store.close()
@@ -0,0 +1,61 @@
+import multiprocessing
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.key import KeyGroup
+from chatmanager.core.shard import ShardedRunner, SharedQuota
+from chatmanager.util.mock_server import MockServer
+
+
+class TestSharedQuota:
+
+    def testA(self):
+        parent = KeyGroup()
+        parent.add_key('k1', 'sk-1', rpm=10)
+        parent.set_strategy('rate-limit')
+        quota = SharedQuota(parent, multiprocessing.get_context('spawn'))
+
+        workers = []
+        for _ in range(2):
+            keys = KeyGroup()
+            keys.add_key('k1', 'sk-1', rpm=10)
+            keys.set_strategy('rate-limit')
+            quota.attach(keys)
+            workers.append(keys)
+
+        # the workers draw from one quota of 10 requests
+        names = [workers[i % 2].reserve(0)[0] for i in range(10)]
+        assert (names == ['k1'] * 10)
+        name, wait = workers[0].reserve(0)
+        assert (name is None and wait > 0)
+        assert (workers[1].reserve(0)[0] is None)
+        workers[1].report_error('k1',
+                                type('E', (Exception,), {'http_status': 429})())
+        assert (workers[0].limits['k1'].cooldown_until > 0)
+
+
+class TestShardedRunner:
+
+    def testA(self, monkeypatch):
+        with MockServer() as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = ChatManager()
+            cm.add_key('key1', 'sk-1', rpm=6000)
+            cm.add_key('key2', 'sk-2', rpm=6000)
+            cm.set_key_strategy('rate-limit')
+            cm.set_session('s1')
+
+            msgs = []
+            for i in range(40):
+                msg = ChatMessage()
+                msg.push_user(f"hello {i}")
+                msgs.append(msg)
+
+            runner = ShardedRunner(cm, processes=2, concurrency=4, shard_size=8)
+            responses = runner.run(iter(msgs))
+            assert ([_.get_msg() for _ in responses
+                    ] == [f"hello {i}" for i in range(40)])
+            assert (mock.requests == 40)
+            # the pairs are merged into the session of the parent
+            assert (sorted(
+                _[1].get_msg() for _ in cm.cur_session.repo) == sorted(
+                    f"hello {i}" for i in range(40)))
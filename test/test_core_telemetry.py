@@ -0,0 +1,78 @@
+import asyncio
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.cache import ResponseCache, MemoryCache
+from chatmanager.core.retry import RetryPolicy
+from chatmanager.util.mock_server import MockServer, constant
+
+
+def manager():
+    cm = ChatManager()
+    cm.retry = RetryPolicy(max_attempts=10, base_delay=0.01)
+    cm.add_key('key1', 'sk-xxx1')
+    cm.add_key('key2', 'sk-xxx2')
+    cm.set_session('s1')
+    return cm
+
+
+class TestTelemetry:
+
+    def testA(self, monkeypatch):
+        with MockServer(latency=constant(0.01)) as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = manager()
+            traces = []
+            cm.telemetry.add_hook(traces.append)
+            cm.cache = ResponseCache(MemoryCache())
+
+            msgs = []
+            for i in range(8):
+                msg = ChatMessage()
+                msg.push_user(f"hello {i}")
+                msgs.append(msg)
+            cm.send(msgs, thread_num=2)
+            cm.send(msgs[0], session='s2')
+
+            assert (len(traces) == 9)
+            for trace in traces[:8]:
+                assert (trace.session == 's1' and trace.attempts == 1)
+                assert (trace.key_name in ('key1', 'key2'))
+                assert (trace.latency >= 0.01 and trace.total >= trace.latency)
+                assert (trace.queue_wait >= 0 and trace.key_wait >= 0)
+                assert (trace.prompt_tokens == 2)
+            # with 2 threads the later messages wait in the queue
+            assert (max(_.queue_wait for _ in traces[:8]) >= 0.02)
+            assert (traces[8].cached and traces[8].prompt_tokens == 0)
+
+            stats = cm.telemetry.stats()
+            assert (stats['sessions']['s1']['requests'] == 8)
+            assert (stats['sessions']['s1']['prompt_tokens'] == 16)
+            assert (stats['sessions']['s2']['cached'] == 1)
+            assert (sum(_['requests'] for _ in stats['keys'].values()) == 8)
+            cm.clients.close()
+
+    def testB(self, monkeypatch):
+        with MockServer(rate_limit_rate=0.5, retry_after=0) as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = manager()
+            traces = []
+            cm.telemetry.add_hook(traces.append)
+            cm.coalesce = False
+
+            msg = ChatMessage()
+            msg.push_user("one two three")
+
+            async def run():
+                await cm.asend([msg] * 10)
+                stream = await cm.asend(msg, stream=True)
+                await stream.collect()
+                await cm.aclose()
+
+            asyncio.run(run())
+            assert (len(traces) == 11)
+            assert (sum(_.attempts for _ in traces) == mock.requests)
+            stats = cm.telemetry.stats()['sessions']['s1']
+            assert (stats['retries'] == mock.requests - 11)
+            assert (traces[-1].first_token is not None)
+            assert (traces[-1].completion_tokens == 3)
+            cm.clients.close()
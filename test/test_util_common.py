@@ -0,0 +1,56 @@
+from chatmanager import ChatMessage
+from chatmanager.util import common
+
+
+class FakeEncoding:
+    """ One token per word, records what is encoded """
+
+    name = 'fake'
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+    def encode_batch(self, texts, num_threads=8):
+        self.encoded.extend(texts)
+        return [_.split() for _ in texts]
+
+
+class TestTokenCount:
+
+    def testA(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        msg = ChatMessage()
+        msg.push_system("you are an assistant")
+        msg.push_user("how are you")
+        # 2 messages * 3 + 2 roles + 4 + 3 words + 3 for the reply
+        assert (msg.token_usage() == 18)
+
+        # only the new turn is encoded
+        encoding.encoded.clear()
+        msg.push_assistant("fine thanks")
+        assert (msg.token_usage() == 18 + 3 + 1 + 2)
+        assert (encoding.encoded == ["assistant", "fine thanks"])
+
+    def testB(self, monkeypatch):
+        encoding = FakeEncoding()
+        monkeypatch.setattr(common, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(common, '_token_cache', common.OrderedDict())
+
+        msgs = []
+        for i in range(10):
+            msg = ChatMessage()
+            msg.push_system("shared system prompt")
+            msg.push_user(f"question {i}")
+            msgs.append(msg)
+
+        usage = ChatMessage.batch_token_usage(msgs)
+        assert (usage == [msg.token_usage() for msg in msgs])
+        # every distinct string is encoded once
+        assert (len(encoding.encoded) == len(set(encoding.encoded)) == 13)
@@ -0,0 +1,59 @@
+import asyncio
+
+from chatmanager import ChatManager, ChatMessage, ChatSetup
+from chatmanager.core.retry import RetryPolicy
+from chatmanager.util.mock_server import MockServer
+
+
+def manager(key_num):
+    cm = ChatManager()
+    cm.coalesce = False
+    cm.retry = RetryPolicy(max_attempts=10, base_delay=0.01)
+    for i in range(key_num):
+        cm.add_key(f'key{i}', f'sk-{i}')
+    cm.set_session('s1')
+    return cm
+
+
+class TestMockServer:
+
+    def testA(self, monkeypatch):
+        with MockServer(rate_limit_rate=0.3, retry_after=0) as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = manager(2)
+
+            msgs = []
+            for i in range(20):
+                msg = ChatMessage()
+                msg.push_user(f"hello {i}")
+                msgs.append(msg)
+
+            responses = cm.send(msgs, thread_num=8)
+            assert ([_.get_msg() for _ in responses
+                    ] == [f"hello {i}" for i in range(20)])
+            assert (mock.status_counts[200] == 20)
+            assert (mock.requests == 20 + mock.status_counts.get(429, 0))
+            cm.clients.close()
+
+    def testB(self, monkeypatch):
+        with MockServer() as mock:
+            monkeypatch.setattr(ChatSetup, 'api_base', mock.api_base)
+            cm = manager(1)
+
+            msg = ChatMessage()
+            msg.push_user("one two three")
+            stream = cm.send(msg, stream=True)
+            assert ("".join(stream) == "one two three")
+            assert (stream.response.token_usage() == 6)
+
+            async def run():
+                stream = await cm.asend(msg, stream=True)
+                deltas = [_ async for _ in stream]
+                response = await cm.asend(msg)
+                await cm.aclose()
+                return deltas, response
+
+            deltas, response = asyncio.run(run())
+            assert (deltas == ["one", " two", " three"])
+            assert (response.get_msg() == "one two three")
+            cm.clients.close()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from chatmanager.util import typecheck
+
+
+class TestTypecheck:
+
+    def testA(self):
+        code = ("import sys, chatmanager; "
+                "print(' '.join(sorted(sys.modules)))")
+        env = dict(os.environ, CHATMANAGER_TYPECHECK='0')
+        out = subprocess.run([sys.executable, '-c', code],
+                             env=env,
+                             check=True,
+                             capture_output=True,
+                             text=True).stdout
+        loaded = set(out.split())
+        assert ('chatmanager' in loaded)
+        for heavy in ('openai', 'tiktoken', 'typeguard', 'aiohttp', 'requests'):
+            assert (heavy not in loaded)
+
+    def testB(self, monkeypatch):
+
+        def f(x: int) -> int:
+            return x
+
+        monkeypatch.setattr(typecheck, 'TYPECHECK', False)
+        assert (typecheck.typechecked(f) is f)
+        assert (f('a') == 'a')
+
+        monkeypatch.setattr(typecheck, 'TYPECHECK', True)
+        from typeguard import TypeCheckError
+        checked = typecheck.typechecked(f)
+        assert (checked(1) == 1)
+        with pytest.raises(TypeCheckError):
+            checked('a')